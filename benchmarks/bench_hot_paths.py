@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Hot path benchmarks
+
+        Times the code every request or frame goes through, against simulated (in-memory) pins so the
+        numbers are reproducible on any machine, Raspberry Pi or not.
+
+        Usage:
+            python benchmarks/bench_hot_paths.py --output results.json
+            python benchmarks/bench_hot_paths.py --baseline results.json --threshold 0.15
+            python benchmarks/bench_hot_paths.py --filter colour_to_rgb_tuple
+
+        Each case reports the best of --repeat runs in nanoseconds per operation. With --baseline, any
+        case more than --threshold (fractional) slower than the baseline is listed as a regression and
+        the script exits with status 1.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+sys.path[:0] = [SRC_DIR, REPO_DIR]
+os.chdir(SRC_DIR)  # The templates and the log file are relative to here
+
+import src.config  # noqa: E402 (sets up the import chain)
+from src.config import CONFIG, logger  # noqa: E402
+
+WORK_DIR = tempfile.mkdtemp(prefix="raspiled-bench-")
+CONFIG["simulate"] = 1
+CONFIG["state_file"] = os.path.join(WORK_DIR, "state.json")
+logger.setLevel(logging.WARNING)  # Logging every request would swamp what we are timing
+
+import ledstrip  # noqa: E402
+import raspiled_listener  # noqa: E402
+from dither import TemporalDither  # noqa: E402
+from ledstrip import LEDStrip  # noqa: E402
+from timeline import Timeline  # noqa: E402
+from twisted.web.test.requesthelper import DummyChannel  # noqa: E402
+
+
+COLOUR_SYNTAXES = OrderedDict((
+    ("named", "salmon"),
+    ("hex_6", "#19BECA"),
+    ("hex_3", "#1BC"),
+    ("rgb", "rgb(25,190,202)"),
+    ("hsv", "hsv(184,88,79)"),
+    ("hs", "hs(184,88)"),
+    ("brightness", "v50"),
+    ("kelvin", "4321K"),
+))
+
+
+def make_request(**params):
+    request = raspiled_listener.SmartRequest(DummyChannel(), False)
+    request.method = b"GET"
+    request.args = dict((name.encode("utf-8"), [value.encode("utf-8")]) for name, value in params.items())
+    return request
+
+
+class NoSleep(object):
+    """
+    Lets fade_to_rgb run flat out, so we time generating the frames rather than waiting between them
+    """
+
+    def __enter__(self):
+        self.original_sleep = ledstrip.sleep
+        ledstrip.sleep = lambda seconds: None
+
+    def __exit__(self, *exc_info):
+        ledstrip.sleep = self.original_sleep
+
+
+def build_cases(resource):
+    """
+    @return: OrderedDict of case name : (callable, operations per call)
+    """
+    led_strip = resource.led_strip
+    current_rgb = (120, 60, 30)
+    cases = OrderedDict()
+    for syntax, colour in COLOUR_SYNTAXES.items():
+        if syntax == "named":  # Named colours are looked up by the callers, colour_to_rgb_tuple doesn't know them
+            cases["colour_to_rgb_tuple.named"] = (lambda colour=colour: LEDStrip.named_colour_to_rgb(colour), 1)
+        else:
+            cases["colour_to_rgb_tuple.{}".format(syntax)] = (lambda colour=colour: LEDStrip.colour_to_rgb_tuple(colour, current_rgb), 1)
+    cases["kelvin_to_rgb"] = (lambda: LEDStrip.kelvin_to_rgb(4321), 1)
+    cases["convert_to_colour_list"] = (lambda: LEDStrip.convert_to_colour_list(["red,#00FF00", "rgb(1,2,3)", "4000K"]), 1)
+
+    def fade_frames():
+        with NoSleep():
+            led_strip.fade_to_rgb(255, 128, 0, fade=1000, check=False)  # 50 frames
+            led_strip.fade_to_rgb(0, 64, 255, fade=1000, check=False)
+    cases["fade_to_rgb.frame"] = (fade_frames, 100)
+
+    def oklab_fade_frames():
+        with NoSleep():
+            led_strip.fade_to_rgb(255, 128, 0, fade=1000, check=False, interpolation="oklab")  # 50 frames, from a cached table
+            led_strip.fade_to_rgb(0, 64, 255, fade=1000, check=False, interpolation="oklab")
+    cases["fade_to_rgb.frame.oklab"] = (oklab_fade_frames, 100)
+
+    rotate = Timeline.colour_loop([(255, 0, 0), (0, 255, 0), (0, 0, 255)], 1.0, fade=True)
+    frame_times = [frame * ledstrip.FRAME_SECONDS for frame in range(150)]
+
+    def timeline_frames():
+        for frame_time in frame_times:
+            led_strip.set_rgb(*rotate.colour_at(frame_time))
+    cases["timeline.frame"] = (timeline_frames, len(frame_times))
+
+    oklab_rotate = Timeline.colour_loop([(255, 0, 0), (0, 255, 0), (0, 0, 255)], 1.0, fade=True, interpolation="oklab")
+
+    def oklab_timeline_frames():
+        for frame_time in frame_times:
+            led_strip.set_rgb(*oklab_rotate.colour_at(frame_time))
+    cases["timeline.frame.oklab"] = (oklab_timeline_frames, len(frame_times))
+
+    dither = TemporalDither()
+
+    def dithered_timeline_frames():
+        led_strip.dither = dither
+        try:
+            for frame_time in frame_times:
+                led_strip.set_rgb(*rotate.colour_at(frame_time), dither=True)
+        finally:
+            led_strip.dither = None
+    cases["timeline.frame.dither"] = (dithered_timeline_frames, len(frame_times))
+
+    cases["information__status"] = (lambda: resource.information__status(make_request()), 1)
+    cases["render_json_with_status"] = (lambda: resource.render_json_with_status(make_request(), context={"action": "set", "success": True}), 1)
+    cases["render_GET.set"] = (lambda: resource.render_GET(make_request(set="#19BECA")), 1)
+    cases["render_GET.preset"] = (lambda: resource.render_GET(make_request(preset="party")), 1)  # Starts (and stops the last) sequence thread
+    cases["render_GET.status"] = (lambda: resource.render_GET(make_request(status="")), 1)
+    cases["render_GET.page"] = (lambda: resource.render_GET(make_request()), 1)
+    cases.update(build_batch_cases())
+    return cases
+
+
+BATCH_SIZE = 1000  # Colours per batch conversion
+
+
+def build_batch_cases():
+    """
+    Each colour conversion over BATCH_SIZE colours: the scalar LEDStrip helper in a loop, then colour_arrays in one call.
+    Checks they agree first.
+
+    @return: OrderedDict of case name : (callable, operations per call), timed per colour
+    """
+    try:
+        import numpy as np
+        import colour_arrays
+    except ImportError:  # NumPy is optional
+        logger.warning("NumPy is not installed, skipping the batch colour conversion cases")
+        return OrderedDict()
+    rgbs = [((i * 37) % 256, (i * 91) % 256, (i * 53) % 256) for i in range(BATCH_SIZE)]
+    hsvs = [LEDStrip.rgb_to_hsv(*rgb) for rgb in rgbs]
+    hexes = [LEDStrip.rgb_to_hex(*rgb) for rgb in rgbs]
+    kelvins = [1000 + i * 39 for i in range(BATCH_SIZE)]
+    rgb_array = np.array(rgbs, dtype=np.float64)  # Effects hold their colours in arrays already
+    hsv_array = np.array(hsvs, dtype=np.float64)
+    kelvin_array = np.array(kelvins, dtype=np.float64)
+    conversions = OrderedDict((  # name : (scalar loop, batch call)
+        ("hex_to_rgb", (lambda: [LEDStrip.hex_to_rgb(hex_value) for hex_value in hexes], lambda: colour_arrays.hex_to_rgb(hexes))),
+        ("rgb_to_hex", (lambda: [LEDStrip.rgb_to_hex(*rgb) for rgb in rgbs], lambda: colour_arrays.rgb_to_hex(rgb_array))),
+        ("hsv_to_rgb", (lambda: [LEDStrip.hsv_to_rgb(*hsv) for hsv in hsvs], lambda: colour_arrays.hsv_to_rgb(hsv_array))),
+        ("rgb_to_hsv", (lambda: [LEDStrip.rgb_to_hsv(*rgb) for rgb in rgbs], lambda: colour_arrays.rgb_to_hsv(rgb_array))),
+        ("kelvin_to_rgb", (lambda: [LEDStrip.kelvin_to_rgb(kelvin) for kelvin in kelvins], lambda: colour_arrays.kelvin_to_rgb(kelvin_array))),
+        ("contrast_from_bg", (lambda: [LEDStrip.contrast_from_bg(hex_value) for hex_value in hexes], lambda: colour_arrays.contrast_from_bg(rgb_array))),
+    ))
+    cases = OrderedDict()
+    for name, (scalar_loop, batch) in conversions.items():
+        batch_results = batch()
+        if isinstance(batch_results, np.ndarray):
+            batch_results = [tuple(row) for row in batch_results.tolist()]
+        if [tuple(result) if isinstance(result, (list, tuple)) else result for result in scalar_loop()] != batch_results:
+            raise AssertionError("colour_arrays.{} does not match LEDStrip.{}".format(name, name))
+        cases["batch.{}.scalar_loop".format(name)] = (scalar_loop, BATCH_SIZE)
+        cases["batch.{}.array".format(name)] = (batch, BATCH_SIZE)
+    return cases
+
+
+def measure(func, operations, repeat=5, min_seconds=0.2):
+    """
+    @return: <float> best nanoseconds per operation over repeat runs of at least min_seconds
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_seconds:
+            break
+        number *= 2
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / (number * operations) * 1e9
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each case against the baseline
+    @return: [<unicode> case name, ] of the cases which regressed by more than threshold
+    """
+    regressions = []
+    print("{:<34} {:>14} {:>14} {:>8}".format("case", "baseline ns", "now ns", "change"), file=sys.stderr)
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            print("{:<34} {:>14} {:>14.1f} {:>8}".format(name, "-", result["ns_per_op"], "new"), file=sys.stderr)
+            continue
+        change = result["ns_per_op"] / base["ns_per_op"] - 1.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<34} {:>14.1f} {:>14.1f} {:>+7.1%}{}".format(name, base["ns_per_op"], result["ns_per_op"], change, flag), file=sys.stderr)
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--output", help="Write the results JSON here (default: stdout)")
+    arg_parser.add_argument("--baseline", help="A results JSON to compare against")
+    arg_parser.add_argument("--threshold", type=float, default=0.15, help="Fractional slowdown counted as a regression (default 0.15)")
+    arg_parser.add_argument("--filter", default="", help="Only run cases whose name contains this")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--min-seconds", type=float, default=0.2, help="Minimum duration of each timed run")
+    args = arg_parser.parse_args()
+
+    resource = raspiled_listener.RaspiledControlResource()
+    resource.rate_limiter = None  # Otherwise every render_GET after the first burst is timing a 429
+    results = OrderedDict()
+    try:
+        for name, (func, operations) in build_cases(resource).items():
+            if args.filter not in name:
+                continue
+            results[name] = {"ns_per_op": round(measure(func, operations, args.repeat, args.min_seconds), 1)}
+    finally:
+        resource.led_strip.stop_current_sequence()
+    report = OrderedDict((
+        ("meta", OrderedDict((
+            ("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")),
+            ("revision", git_revision()),
+            ("python", platform.python_version()),
+            ("implementation", platform.python_implementation()),
+            ("machine", platform.machine()),
+            ("platform", platform.platform()),
+        ))),
+        ("results", results),
+    ))
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report_json + "\n")
+    else:
+        print(report_json)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regression(s) over {:.0%}: {}".format(len(regressions), args.threshold, ", ".join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
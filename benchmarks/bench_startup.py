@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Startup benchmark
+
+        Measures, in fresh interpreters:
+            import: how long `import raspiled_listener` takes
+            first_request: from spawning the listener to its first HTTP response
+
+        Usage:
+            python benchmarks/bench_startup.py [--runs 5] [--port 9191]
+
+        Prints a JSON report. first_request needs nothing else on the port; the pigpio daemon is optional
+        (the listener starts in degraded mode without one).
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from six.moves.urllib.request import urlopen
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+PRELUDE = "import sys; sys.path[:0] = [{src!r}, {repo!r}]; import src.config; ".format(src=SRC_DIR, repo=REPO_DIR)
+
+
+def time_import():
+    started = time.time()
+    subprocess.check_call([sys.executable, "-c", PRELUDE + "import raspiled_listener"], cwd=SRC_DIR)
+    return time.time() - started
+
+
+def time_first_request(port, timeout=30.0):
+    code = PRELUDE + "import raspiled_listener as L; L.RESOLVED_USER_SETTINGS['pi_port'] = {}; L.start_if_not_running()".format(port)
+    started = time.time()
+    listener = subprocess.Popen([sys.executable, "-c", code], cwd=SRC_DIR, stdin=subprocess.DEVNULL)
+    try:
+        while time.time() - started < timeout:
+            try:
+                urlopen("http://localhost:{}/?status".format(port), timeout=1).read()
+                return time.time() - started
+            except IOError:
+                time.sleep(0.005)
+        raise RuntimeError("The listener did not answer on port {} within {}s".format(port, timeout))
+    finally:
+        listener.terminate()
+        listener.wait()
+
+
+def summarise(samples):
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(samples) * 1000.0, 1),
+        "min_ms": round(min(samples) * 1000.0, 1),
+        "max_ms": round(max(samples) * 1000.0, 1),
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--port", type=int, default=9191, help="A free port to run the listener on")
+    args = arg_parser.parse_args()
+    report = {
+        "import": summarise([time_import() for _run in range(args.runs)]),
+        "first_request": summarise([time_first_request(args.port) for _run in range(args.runs)]),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
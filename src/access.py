@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Access control
+
+        Who may use the admin endpoints (the whitelist), and how often anyone may ask the strip to do
+        something (the rate limiter).
+
+        The whitelist lives in ./.whitelist, one IP address or CIDR range per line of its [DEFAULT]
+        section, e.g.
+            [DEFAULT]
+            ip1 = 127.0.0.1
+            lan = 192.168.0.0/24
+        It is parsed once into networks and only re-read when the file's modification time changes, so
+        checking a client costs a stat() and a dict lookup, and edits take effect without a restart.
+
+        The rate limiter gives each client a token bucket: a burst of actions go straight through, after
+        which the client gets a steady rate_per_second. Anything faster is answered with a 429, so one
+        misbehaving client cannot flood pigpio with writes and starve the render loop.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import configparser
+import ipaddress
+import os
+import threading
+
+import six
+
+from src.config import logger
+from metrics import REGISTRY, monotonic
+
+
+DEFAULT_WHITELIST = ("127.0.0.1", "::1")  # Written out as the whitelist if there isn't one yet
+MAX_CACHED_CLIENTS = 1024  # Max number of client addresses to remember whitelist answers for
+
+RATE_LIMITED = REGISTRY.counter("raspiled_rate_limited_total", "Actions refused because the client was sending them too fast")
+
+
+def parse_address(address):
+    """
+    @param address: <unicode> An IPv4 or IPv6 address. IPv4 mapped IPv6 addresses (::ffff:1.2.3.4) come back as IPv4
+    @return: <IPv4Address> / <IPv6Address>, or None if it isn't an IP address
+    """
+    try:
+        ip = ipaddress.ip_address(six.ensure_text(address or "").strip())
+    except ValueError:
+        return None
+    return getattr(ip, "ipv4_mapped", None) or ip
+
+
+def parse_network(entry):
+    """
+    @param entry: <unicode> An IP address or CIDR range e.g. "192.168.0.0/24"
+    @return: <IPv4Network> / <IPv6Network>
+    @raise ValueError: If it isn't one
+    """
+    return ipaddress.ip_network(six.ensure_text(entry).strip(), strict=False)  # 192.168.0.1/24 means the whole /24
+
+
+class Whitelist(object):
+    """
+    The IP addresses and CIDR ranges allowed to use the admin endpoints, kept in memory and reloaded
+    whenever the whitelist file changes
+    """
+
+    def __init__(self, path, defaults=DEFAULT_WHITELIST):
+        """
+        @param path: <unicode> The whitelist file. Created holding the defaults if it doesn't exist
+        @keyword defaults: (<unicode> address or range, ) Who is allowed if the file cannot be read
+        """
+        self.path = path
+        self.defaults = tuple(defaults)
+        self.networks = ()
+        self.loads = 0  # How many times the file has been parsed
+        self._mtime = None
+        self._verdicts = {}  # <unicode> client address : <Bool> allowed
+        self._lock = threading.Lock()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _write_defaults(self):
+        parser = configparser.ConfigParser(defaults={"ip{}".format(number): entry for number, entry in enumerate(self.defaults, 1)})
+        try:
+            with open(self.path, "w") as whitelist_file:
+                parser.write(whitelist_file)
+        except (IOError, OSError) as e:
+            logger.error("Whitelist: could not write %s (%s: %s)", self.path, e.__class__.__name__, e)
+
+    def _read_entries(self):
+        """
+        @return: [<unicode> address or range, ] every value in the whitelist file, or the defaults if it cannot be read
+        """
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            if not parser.read(self.path):
+                return list(self.defaults)
+        except configparser.Error as e:
+            logger.error("Whitelist: could not parse %s (%s), allowing only %s", self.path, e, ", ".join(self.defaults))
+            return list(self.defaults)
+        entries = list(parser.defaults().values())
+        for section in parser.sections():
+            entries.extend(value for name, value in parser.items(section) if name not in parser.defaults())
+        return entries
+
+    def reload(self):
+        """
+        Parses the whitelist file into networks, now
+        """
+        if self._file_mtime() is None:
+            self._write_defaults()
+        mtime = self._file_mtime()
+        networks = []
+        for entry in self._read_entries():
+            try:
+                networks.append(parse_network(entry))
+            except ValueError:
+                logger.warning("Whitelist: ignoring '%s' in %s, which isn't an IP address or CIDR range", entry, self.path)
+        with self._lock:
+            self.networks = tuple(networks)
+            self._verdicts = {}
+            self._mtime = mtime
+            self.loads += 1
+        logger.info("Whitelist: loaded %s address(es) / range(s) from %s", len(networks), self.path)
+
+    def allows(self, address):
+        """
+        @param address: <unicode> The client's IP address
+        @return: <Bool> Whether it is in the whitelist
+        """
+        if self.loads == 0 or self._file_mtime() != self._mtime:
+            self.reload()
+        verdicts = self._verdicts
+        try:
+            return verdicts[address]
+        except KeyError:
+            pass
+        ip = parse_address(address)
+        allowed = ip is not None and any(ip in network for network in self.networks if network.version == ip.version)
+        if len(verdicts) >= MAX_CACHED_CLIENTS:
+            verdicts.clear()
+        verdicts[address] = allowed
+        return allowed
+
+    __contains__ = allows
+
+
+class TokenBucketLimiter(object):
+    """
+    Limits how often each client may do something: burst at once, then rate_per_second
+
+        A client's bucket holds up to burst tokens and refills at rate_per_second. Each action takes a token;
+        with none left it is refused. Buckets are only kept for clients who have used some of their tokens.
+    """
+
+    def __init__(self, rate_per_second, burst, max_clients=MAX_CACHED_CLIENTS, clock=monotonic):
+        """
+        @param rate_per_second: <float> Steady rate each client may act at. 0 or less switches the limiter off
+        @param burst: <int> How many actions a client may make at once
+        @keyword max_clients: <int> How many clients' buckets to keep before forgetting the fullest
+        @keyword clock: callable() -> <float> seconds
+        """
+        self.rate_per_second = float(rate_per_second or 0)
+        self.burst = max(float(burst or 0), 1.0)
+        self.max_clients = max_clients
+        self.clock = clock
+        self._buckets = {}  # client : [<float> tokens, <float> when they were counted]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate_per_second > 0
+
+    def _prune(self, now):
+        """
+        Forgets the buckets which have refilled (they are no different from a client we've never seen), and
+        if that isn't enough, the fullest half
+        """
+        refilled = [client for client, (tokens, counted) in self._buckets.items() if tokens + (now - counted) * self.rate_per_second >= self.burst]
+        for client in refilled:
+            del self._buckets[client]
+        if len(self._buckets) >= self.max_clients:
+            by_fullness = sorted(self._buckets, key=lambda client: self._buckets[client][0] + (now - self._buckets[client][1]) * self.rate_per_second)
+            for client in by_fullness[len(by_fullness) // 2:]:
+                del self._buckets[client]
+
+    def allow(self, client):
+        """
+        Takes a token from client's bucket if it has one
+
+        @param client: <hashable> e.g. the client's IP address
+        @return: (<Bool> allowed, <float> seconds until the next token, 0 if allowed)
+        """
+        if not self.enabled:
+            return True, 0.0
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._prune(now)
+                bucket = self._buckets[client] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_per_second)
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                return True, 0.0
+            bucket[0] = tokens
+        RATE_LIMITED.inc()
+        return False, (1.0 - tokens) / self.rate_per_second
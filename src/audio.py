@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Music mode
+
+        Turns sound into colour: bass drives red, mids drive green and treble drives blue.
+
+        Audio arrives as 16 bit PCM in fixed-size blocks (1024 samples at 44.1kHz is ~23ms, about one
+        frame) from one of:
+            alsa                ALSA capture via arecord, on the default device
+            alsa:<device>       ...or a specific one, e.g. alsa:plughw:1,0
+            /path/to/song.wav   A 16 bit PCM WAV file, played out in real time (handy for testing)
+            fifo:/path/to/fifo  Raw signed 16 bit little-endian PCM from a pipe, e.g. from a music player
+            -                   The same, on stdin
+
+        Each block is windowed, FFT'd and summed into frequency bands with NumPy, into buffers allocated
+        once up front, then mapped onto a colour as soon as the block arrives. So the lights lag the
+        sound by less than one block.
+
+        NumPy is only imported when music mode is used.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import fcntl
+import io
+import os
+import select
+import struct
+import subprocess
+import sys
+
+import numpy as np
+
+from src.config import logger
+
+
+SAMPLE_RATE = 44100
+BLOCK_SIZE = 1024  # Samples per block, per channel
+BAND_EDGES_HZ = (20.0, 250.0, 2000.0, 16000.0)  # Bass, mids, treble -> red, green, blue
+READ_POLL_SECONDS = 0.1  # How often a blocked read checks whether it should give up
+PEAK_DECAY = 0.995  # Per block. The automatic gain forgets loud passages over ~5 seconds
+NOISE_FLOOR = 1e-6  # Power below which we call it silence
+BAND_RANGE = 0.01  # A band's gain never goes above that of the loudest band by more than this factor (20dB), so leakage stays dark
+ATTACK = 0.6  # How quickly the colour follows the music getting louder (0-1 per block)
+RELEASE = 0.15  # ...and quieter
+
+
+def read_wav_header(wav_file):
+    """
+    Reads a WAV file's header, leaving the file positioned at the start of the samples
+
+    @return: (<int> sample rate, <int> channels)
+    @raise ValueError: If it isn't a 16 bit PCM WAV file
+    """
+    riff, _size, wave_id = struct.unpack("<4sI4s", wav_file.read(12))
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        raise ValueError("Not a WAV file")
+    audio_format = None
+    while True:
+        chunk_header = wav_file.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError("WAV file has no data")
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+        if chunk_id == b"data":
+            break
+        if chunk_id == b"fmt ":
+            audio_format, channels, sample_rate, _byte_rate, _block_align, bits = struct.unpack("<HHIIHH", wav_file.read(16))
+            chunk_size -= 16
+        wav_file.seek(chunk_size + (chunk_size & 1), io.SEEK_CUR)  # Chunks are padded to an even length
+    if audio_format != 1 or bits != 16:
+        raise ValueError("Only 16 bit PCM WAV files are supported")
+    return sample_rate, channels
+
+
+class PCMSource(object):
+    """
+    Reads signed 16 bit little-endian PCM, a block at a time, into buffers allocated once
+    """
+
+    def __init__(self, stream, sample_rate=SAMPLE_RATE, channels=1, block_size=BLOCK_SIZE, realtime=False, process=None, name=""):
+        """
+        @param stream: An unbuffered binary file (must have readinto() and fileno())
+        @keyword realtime: <Bool> True if the stream is a file which needs playing out at the sample rate,
+                           False if it's live and only delivers samples as they happen
+        @keyword process: <subprocess.Popen> producing the stream, to stop when we close
+        """
+        self.stream = stream
+        self.sample_rate = int(sample_rate)
+        self.channels = max(1, int(channels))
+        self.block_size = int(block_size)
+        self.realtime = realtime
+        self.process = process
+        self.name = name
+        self._raw = bytearray(self.block_size * self.channels * 2)
+        self._raw_view = memoryview(self._raw)
+        self._samples = np.frombuffer(self._raw, dtype="<i2").reshape(self.block_size, self.channels)  # Shares _raw's memory
+        self.mono = np.zeros(self.block_size, dtype=np.float64)
+
+    def __repr__(self):
+        return "PCMSource '{}' {}Hz x{}".format(self.name, self.sample_rate, self.channels)
+
+    @property
+    def block_seconds(self):
+        return self.block_size / float(self.sample_rate)
+
+    def read_block(self, should_stop=None):
+        """
+        Fills self.mono with the next block of samples, mixed down to mono in the range -1 to 1
+
+        @keyword should_stop: callable() returning True if we should give up waiting for samples
+        @return: <np.ndarray> self.mono, or None at the end of the stream (or if told to stop)
+        """
+        filled = 0
+        wanted = len(self._raw)
+        while filled < wanted:
+            if should_stop is not None and should_stop():
+                return None
+            if not self.realtime:  # Live streams might not deliver for a while, so don't block forever
+                readable, _, _ = select.select([self.stream], [], [], READ_POLL_SECONDS)
+                if not readable:
+                    continue
+            count = self.stream.readinto(self._raw_view[filled:])
+            if not count:
+                return None
+            filled += count
+        np.mean(self._samples, axis=1, out=self.mono)
+        self.mono *= 1.0 / 32768.0
+        return self.mono
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        try:
+            self.stream.close()
+        except (IOError, OSError):
+            pass
+
+
+def open_source(spec, sample_rate=SAMPLE_RATE, channels=1, block_size=BLOCK_SIZE):
+    """
+    Opens a PCM source from its description (see the module docs)
+
+    @return: <PCMSource>
+    @raise ValueError / IOError / OSError: If it can't be opened
+    """
+    spec = (spec or "alsa").strip()
+    logger.info("Music: opening audio source '%s'", spec)
+    if spec == "alsa" or spec.startswith("alsa:"):
+        command = ["arecord", "-q", "-t", "raw", "-f", "S16_LE", "-r", str(sample_rate), "-c", str(channels)]
+        device = spec[len("alsa:"):]
+        if device:
+            command += ["-D", device]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=0)
+        return PCMSource(process.stdout, sample_rate, channels, block_size, process=process, name=spec)
+    if spec == "-":
+        stdin = getattr(sys.stdin, "buffer", sys.stdin)
+        return PCMSource(getattr(stdin, "raw", stdin), sample_rate, channels, block_size, name="stdin")
+    if spec.startswith("fifo:"):
+        # Opening a FIFO blocks until something writes to it, so open it non-blocking then switch to blocking reads
+        fifo_descriptor = os.open(spec[len("fifo:"):], os.O_RDONLY | os.O_NONBLOCK)
+        fcntl.fcntl(fifo_descriptor, fcntl.F_SETFL, fcntl.fcntl(fifo_descriptor, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return PCMSource(io.FileIO(fifo_descriptor, "rb"), sample_rate, channels, block_size, name=spec)
+    if spec.lower().endswith(".wav"):
+        wav_file = io.open(spec, "rb", buffering=0)
+        try:
+            wav_sample_rate, wav_channels = read_wav_header(wav_file)
+        except (ValueError, struct.error):
+            wav_file.close()
+            raise
+        return PCMSource(wav_file, wav_sample_rate, wav_channels, block_size, realtime=True, name=spec)
+    raise ValueError("Unknown audio source '{}'. Use alsa, alsa:<device>, a .wav file, fifo:<path> or -".format(spec))
+
+
+class MusicVisualiser(object):
+    """
+    Maps blocks of samples onto colours
+
+        Every buffer is allocated here, so process() allocates nothing but the (r, g, b) tuple it returns.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, block_size=BLOCK_SIZE, band_edges=BAND_EDGES_HZ, colour_matrix=None):
+        """
+        @keyword band_edges: (<float> Hz, ) n + 1 edges of n frequency bands
+        @keyword colour_matrix: (3, n) array of how much each band contributes to red, green and blue.
+                                Defaults to band i -> channel i, for three bands
+        """
+        self.block_size = int(block_size)
+        n_bins = self.block_size // 2 + 1
+        n_bands = len(band_edges) - 1
+        self.window = np.hanning(self.block_size)
+        self._windowed = np.zeros(self.block_size, dtype=np.float64)
+        self._spectrum = np.zeros(n_bins, dtype=np.complex128)
+        self._power = np.zeros(n_bins, dtype=np.float64)
+        # Each band is the mean power of the FFT bins it covers, done as one matrix product
+        frequencies = np.fft.rfftfreq(self.block_size, 1.0 / sample_rate)
+        self._band_matrix = np.zeros((n_bands, n_bins), dtype=np.float64)
+        for band, (low, high) in enumerate(zip(band_edges, band_edges[1:])):
+            in_band = (frequencies >= low) & (frequencies < high)
+            self._band_matrix[band, in_band] = 1.0 / max(1, np.count_nonzero(in_band))
+        self.bands = np.zeros(n_bands, dtype=np.float64)
+        self._peaks = np.full(n_bands, NOISE_FLOOR, dtype=np.float64)
+        self._levels = np.zeros(n_bands, dtype=np.float64)
+        self._smoothed = np.zeros(n_bands, dtype=np.float64)
+        self._rising = np.zeros(n_bands, dtype=bool)
+        self._rates = np.zeros(n_bands, dtype=np.float64)
+        if colour_matrix is None:
+            colour_matrix = np.eye(3, n_bands)
+        self.colour_matrix = np.asarray(colour_matrix, dtype=np.float64)
+        self.rgb = np.zeros(3, dtype=np.float64)
+        try:  # NumPy 2 can write the FFT into our buffer
+            np.fft.rfft(self._windowed, out=self._spectrum)
+            self._fft_in_place = True
+        except TypeError:
+            self._fft_in_place = False
+
+    def analyse(self, samples):
+        """
+        @param samples: <np.ndarray> block_size floats
+        @return: <np.ndarray> the power in each band (self.bands)
+        """
+        np.multiply(samples, self.window, out=self._windowed)
+        if self._fft_in_place:
+            spectrum = np.fft.rfft(self._windowed, out=self._spectrum)
+        else:
+            spectrum = np.fft.rfft(self._windowed)
+        np.abs(spectrum, out=self._power)
+        np.square(self._power, out=self._power)
+        np.dot(self._band_matrix, self._power, out=self.bands)
+        return self.bands
+
+    def process(self, samples):
+        """
+        @param samples: <np.ndarray> block_size floats
+        @return: (r, g, b) floats 0-255
+        """
+        bands = self.analyse(samples)
+        # Automatic gain: each band relative to its recent peak, so quiet and loud music both fill the range
+        self._peaks *= PEAK_DECAY
+        np.maximum(self._peaks, bands, out=self._peaks)
+        np.maximum(self._peaks, NOISE_FLOOR, out=self._peaks)
+        np.maximum(self._peaks, self._peaks.max() * BAND_RANGE, out=self._levels)
+        np.divide(bands, self._levels, out=self._levels)
+        np.sqrt(self._levels, out=self._levels)  # Closer to how loud it sounds
+        # Snap up with the beat, fade down more gently
+        np.greater(self._levels, self._smoothed, out=self._rising)
+        self._rates.fill(RELEASE)
+        np.copyto(self._rates, ATTACK, where=self._rising)
+        self._levels -= self._smoothed
+        self._levels *= self._rates
+        self._smoothed += self._levels
+        np.dot(self.colour_matrix, self._smoothed, out=self.rgb)
+        np.clip(self.rgb, 0.0, 1.0, out=self.rgb)
+        self.rgb *= 255.0
+        return float(self.rgb[0]), float(self.rgb[1]), float(self.rgb[2])
+
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Batch colour conversions
+
+        Array versions of the colour helpers on LEDStrip (hex_to_rgb, rgb_to_hex, hsv_to_rgb, rgb_to_hsv,
+        kelvin_to_rgb and contrast_from_bg). Each takes N colours at once as NumPy arrays and does the
+        same floating point operations, in the same order, as its scalar counterpart, so element for
+        element the answers are identical. Presets, gradients and pixel effects that would otherwise call
+        the scalar helpers in a Python loop should use these instead.
+
+        Colours go in and come out as arrays of shape (N, 3): one row of r, g, b (or h, s, v) per colour.
+
+        The scalar helpers stay pure Python: for one colour they are several times quicker than a one
+        row array, and they keep NumPy optional for plain PWM strips.
+        python benchmarks/bench_hot_paths.py --filter batch compares the two.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import math
+
+import numpy as np
+import six
+
+
+# libm's log and pow, applied element by element in C. NumPy's own SIMD versions can differ from them in the last
+# bit, which would stop these matching the scalar helpers exactly.
+_log = np.frompyfunc(math.log, 1, 1)
+_pow = np.frompyfunc(math.pow, 2, 1)
+
+LUMINANCE_WEIGHTS = np.array((0.2126, 0.7152, 0.0722), dtype=np.float64)  # Rec. 709, as contrast_from_bg
+CONTRAST_TRIGGER = 0.45  # Luminance at or above which a background needs dark text
+
+
+def _rgb_rows(rgb):
+    """
+    @param rgb: An (r, g, b) iterable, or an iterable of them
+    @return: <np.ndarray> float64 of shape (N, 3)
+    """
+    rows = np.asarray(rgb, dtype=np.float64)
+    if rows.ndim == 1:
+        rows = rows.reshape(1, -1)
+    if rows.ndim != 2 or rows.shape[1] != 3:
+        raise ValueError("Expected colours of shape (N, 3), got {}".format(rows.shape))
+    return rows
+
+
+def hex_to_rgb(hex_values):
+    """
+    Converts 6 digit hex strings, with or without a leading #, into RGB
+
+    @param hex_values: [<unicode>, ] e.g. ["#FF8000", "19beca"]
+    @return: <np.ndarray> int64 of shape (N, 3)
+    @raise ValueError: If any of them isn't 6 hex digits
+    """
+    digits = [six.ensure_text(hex_value).lstrip("#") for hex_value in hex_values]
+    if any(len(hex_digits) != 6 for hex_digits in digits):
+        raise ValueError("Hex colours must have 6 digits")
+    packed = bytearray.fromhex("".join(digits))  # One pass over every colour, in C
+    return np.frombuffer(bytes(packed), dtype=np.uint8).reshape(-1, 3).astype(np.int64)
+
+
+def rgb_to_hex(rgb):
+    """
+    Converts RGB rows (0-255, fractions are truncated) into hex strings
+
+    @param rgb: (N, 3) array-like
+    @return: [<unicode>, ] e.g. ["#ff8000", ]
+    """
+    channels = np.trunc(_rgb_rows(rgb)).astype(np.int64)
+    packed = (channels[:, 0] << 16) | (channels[:, 1] << 8) | channels[:, 2]
+    return ["#%06x" % value for value in packed.tolist()]
+
+
+def hsv_to_rgb(hsv, hue_scale_factor=360.0, sat_scale_factor=100.0, val_scale_factor=100.0):
+    """
+    Converts HSV rows into RGB, as LEDStrip.hsv_to_rgb (i.e. colorsys) does one at a time
+
+    @param hsv: (N, 3) array-like of hue, saturation, value
+    @keyword hue_scale_factor: Hue range scale, e.g. 360 for degrees or 1 for 0-1
+    @keyword sat_scale_factor: Saturation range scale, e.g. 100 for percent
+    @keyword val_scale_factor: Value range scale, e.g. 100 for percent
+    @return: <np.ndarray> int64 of shape (N, 3), 0-255
+    """
+    rows = _rgb_rows(hsv)
+    h = rows[:, 0] / float(hue_scale_factor)
+    s = rows[:, 1] / float(sat_scale_factor)
+    v = rows[:, 2] / float(val_scale_factor)
+    sector = np.trunc(h * 6.0)
+    fraction = (h * 6.0) - sector
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * fraction)
+    t = v * (1.0 - s * (1.0 - fraction))
+    sector = np.mod(sector, 6).astype(np.intp)  # Python's %, so negative hues wrap round the same way
+    rgb = np.empty(rows.shape, dtype=np.float64)
+    rgb[:, 0] = np.choose(sector, (v, q, p, p, t, v))
+    rgb[:, 1] = np.choose(sector, (t, v, v, q, p, p))
+    rgb[:, 2] = np.choose(sector, (p, p, t, v, v, q))
+    return np.rint(rgb * 255.0).astype(np.int64)  # rint rounds halves to even, like round()
+
+
+def rgb_to_hsv(rgb, hue_scale_factor=360.0, sat_scale_factor=100.0, val_scale_factor=100.0):
+    """
+    Converts RGB rows (0-255) into HSV, as LEDStrip.rgb_to_hsv (i.e. colorsys) does one at a time
+
+    @param rgb: (N, 3) array-like
+    @return: <np.ndarray> int64 of shape (N, 3) of hue, saturation, value in the scales given
+    """
+    rows = _rgb_rows(rgb) / 255.0
+    r, g, b = rows[:, 0], rows[:, 1], rows[:, 2]
+    max_c = rows.max(axis=1)
+    min_c = rows.min(axis=1)
+    range_c = max_c - min_c
+    grey = range_c == 0
+    with np.errstate(divide="ignore", invalid="ignore"):  # Greys (and black) are masked out below
+        s = range_c / max_c
+        rc = (max_c - r) / range_c
+        gc = (max_c - g) / range_c
+        bc = (max_c - b) / range_c
+    h = np.where(r == max_c, bc - gc, np.where(g == max_c, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.mod(h / 6.0, 1.0)
+    h[grey] = 0.0
+    s[grey] = 0.0
+    hsv = np.empty(rows.shape, dtype=np.float64)
+    hsv[:, 0] = h * float(hue_scale_factor)
+    hsv[:, 1] = s * float(sat_scale_factor)
+    hsv[:, 2] = max_c * float(val_scale_factor)
+    return np.rint(hsv).astype(np.int64)
+
+
+def _libm(func, *args):
+    """
+    @return: <np.ndarray> float64 of func (_log or _pow) applied to each element of args
+    """
+    return func(*args).astype(np.float64)
+
+
+def kelvin_to_rgb(colour_temperatures):
+    """
+    Converts colour temperatures in Kelvin into RGB, as LEDStrip.kelvin_to_rgb does one at a time.
+    Temperatures are rounded to the nearest Kelvin and clamped to 1000-40000K.
+
+    @param colour_temperatures: array-like of numbers
+    @return: <np.ndarray> float64 of shape (N, 3), 0-255
+    """
+    temperatures = np.clip(np.rint(np.asarray(colour_temperatures, dtype=np.float64).reshape(-1)), 1000, 40000)
+    tmp_internal = temperatures / 100.0
+    warm = tmp_internal <= 66
+    cool = ~warm
+    mid = warm & (tmp_internal > 19) & (tmp_internal < 66)  # Blue has its own formula between 1900K and 6600K
+    rgb = np.empty((len(temperatures), 3), dtype=np.float64)
+    rgb[:, 0] = 255.0
+    rgb[cool, 0] = 329.698727446 * _libm(_pow, tmp_internal[cool] - 60, -0.1332047592)
+    rgb[warm, 1] = 99.4708025861 * _libm(_log, tmp_internal[warm]) - 161.1195681661
+    rgb[cool, 1] = 288.1221695283 * _libm(_pow, tmp_internal[cool] - 60, -0.0755148492)
+    rgb[:, 2] = np.where(tmp_internal >= 66, 255.0, 0.0)
+    rgb[mid, 2] = 138.5177312231 * _libm(_log, tmp_internal[mid] - 10) - 305.0447927307
+    np.clip(rgb, 0, 255, out=rgb)
+    return rgb
+
+
+def relative_luminance(rgb):
+    """
+    @param rgb: (N, 3) array-like, 0-255
+    @return: <np.ndarray> float64 of N luminances, 0-1
+    """
+    weighted = LUMINANCE_WEIGHTS * _libm(_pow, _rgb_rows(rgb) / 255.0, 2.2)
+    return weighted[:, 0] + weighted[:, 1] + weighted[:, 2]  # Summed in the same order as the scalar version
+
+
+def contrast_from_bg(rgb, dark_default="000000", light_default="FFFFFF", hashed="#"):
+    """
+    Suggests a readable foreground colour for each background, as LEDStrip.contrast_from_bg does one at a time
+
+    @param rgb: (N, 3) array-like of background colours, 0-255
+    @keyword dark_default: <str> Foreground for bright backgrounds
+    @keyword light_default: <str> Foreground for dark backgrounds
+    @keyword hashed: <str> The prefix to slam in front of the output e.g. "#"
+    @return: [<unicode>, ] one foreground colour per background
+    """
+    if not hashed:
+        hashed = ""
+    elif hashed is True:
+        hashed = "#"
+    dark = "%s%s" % (hashed, dark_default)
+    light = "%s%s" % (hashed, light_default)
+    return [dark if is_light else light for is_light in (relative_luminance(rgb) >= CONTRAST_TRIGGER).tolist()]
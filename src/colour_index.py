@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Nearest named colour
+
+        Names whatever colour the strip is showing, and works out which colour temperature it is closest
+        to, for the status report. The named colours (CSS4) and the Kelvin steps are converted into OKLab
+        once, the first time a colour is looked up, and built into k-d trees. Distances in OKLab track how
+        different colours look, and a lookup visits O(log n) nodes instead of scanning every colour.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import re
+
+from named_colours import packed_colours
+from transitions import rgb_to_oklab
+
+
+KELVIN_MATCH_DISTANCE = 0.02  # OKLab distance within which a colour counts as that colour temperature (about one just noticeable difference)
+RE_KELVIN_NAME = re.compile(r"^([0-9]+)k$")
+
+
+class KDTree(object):
+    """
+    A static 3-d tree of points, each with a value, for nearest neighbour lookups
+    """
+
+    def __init__(self, points, values):
+        """
+        :param points: [(x, y, z), ]
+        :param values: [<anything>, ] one per point. Where points tie, the one listed first wins
+        """
+        self.size = len(points)
+        self._root = self._build(list(zip(points, range(len(points)), values)), depth=0)
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def _build(cls, entries, depth):
+        """
+        @return: (point, order, value, axis, left subtree, right subtree), or None if there are no entries
+        """
+        if not entries:
+            return None
+        axis = depth % 3
+        entries.sort(key=lambda entry: entry[0][axis])
+        median = len(entries) // 2
+        point, order, value = entries[median]
+        return (point, order, value, axis, cls._build(entries[:median], depth + 1), cls._build(entries[median + 1:], depth + 1))
+
+    def nearest(self, point):
+        """
+        @param point: (x, y, z)
+        @return: (value, <float> distance) of the nearest point, or (None, None) if the tree is empty
+        """
+        best = [None, float("inf"), None]  # order, squared distance, value
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            node_point, order, value, axis, left, right = node
+            distance = (node_point[0] - point[0]) ** 2 + (node_point[1] - point[1]) ** 2 + (node_point[2] - point[2]) ** 2
+            if distance < best[1] or (distance == best[1] and order < best[0]):
+                best[:] = [order, distance, value]
+            offset = point[axis] - node_point[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            if offset * offset <= best[1]:  # The nearest point could be on the far side of the split
+                stack.append(far)
+            stack.append(near)  # Searched first
+        if best[0] is None:
+            return None, None
+        return best[2], best[1] ** 0.5
+
+
+def _build_indexes():
+    """
+    @return: (<KDTree> of named colours, <KDTree> of Kelvin steps (int values))
+    """
+    names, name_points, kelvin_entries = [], [], []
+    colours = packed_colours()
+    for name in sorted(colours):  # So where two colours are the same (e.g. grey / gray), the answer doesn't vary
+        packed = colours[name]
+        lab = rgb_to_oklab((packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF))
+        kelvin_match = RE_KELVIN_NAME.match(name)
+        if kelvin_match:
+            kelvin_entries.append((int(kelvin_match.group(1)), lab))
+        else:
+            names.append(name)
+            name_points.append(lab)
+    kelvin_entries.sort()  # Identical steps (e.g. 9600K / 9700K) resolve to the lower temperature
+    kelvins = [kelvin for kelvin, lab in kelvin_entries]
+    kelvin_points = [lab for kelvin, lab in kelvin_entries]
+    return KDTree(name_points, names), KDTree(kelvin_points, kelvins)
+
+
+_indexes = None  # (<KDTree> of named colours, <KDTree> of Kelvin steps), built by indexes()
+
+
+def indexes():
+    """
+    @return: (<KDTree> of named colours, <KDTree> of Kelvin steps), built the first time they are needed
+    """
+    global _indexes
+    if _indexes is None:
+        _indexes = _build_indexes()
+    return _indexes
+
+
+def nearest_named_colour(rgb):
+    """
+    @param rgb: (r, g, b) 0-255
+    @return: (<unicode> name, <float> OKLab distance) e.g. ("salmon", 0.0)
+    """
+    return indexes()[0].nearest(rgb_to_oklab(rgb))
+
+
+def nearest_kelvin(rgb):
+    """
+    @param rgb: (r, g, b) 0-255
+    @return: (<int> colour temperature in Kelvin, <float> OKLab distance)
+    """
+    return indexes()[1].nearest(rgb_to_oklab(rgb))
@@ -7,12 +7,11 @@ import logging
 import os
 import six
 
+from src.logging_pipeline import setup_logging
+
 
 logger = logging.getLogger("raspiled")
 logger.setLevel(logging.INFO)
-logging_handler = logging.FileHandler(filename="./raspiled_py3.log", encoding='utf-8', mode='a+')
-logging_handler.setFormatter(logging.Formatter(fmt='[%(asctime)s RASPILED] %(message)s', datefmt='%H:%M:%S'))
-logger.addHandler(logging_handler)
 
 
 def ordereddict_to_int(ordered_dict):
@@ -46,90 +45,204 @@ DEFAULTS = {
     'pig_port': 8888,  # the port pigpio daemon is listening on for pin control commands
     'latitude': 52.2053,  # If you wish to sync your sunrise/sunset to the real sun, enter your latitude as a decimal
     'longitude': 0.1218,  # If you wish to sync your sunrise/sunset to the real sun, enter your longitude as a decimal
+    'solar_sunrise': 0,  # Seconds. If set, the server runs a sunrise this long, timed to finish at the real sunrise
+    'solar_sunset': 0,  # Seconds. If set, the server runs a sunset this long, starting at the real sunset
+    'circadian': 0,  # 1 = follow the sun's colour temperature through the day from startup (warm at night, cool at midday)
+    'circadian_day_kelvin': 6500,
+    'circadian_night_kelvin': 2000,
+    'state_file': 'raspiled_state.json',  # Where the strip's state is saved, so it can be resumed after a restart
+    'jobs_file': 'raspiled_jobs.json',  # Where scheduled jobs are saved, relative to this directory
+    'scheduler_catch_up_seconds': 3600,  # At startup, run jobs missed by up to this many seconds while the listener was down
+    'fade_interpolation': 'linear',  # How fades and rotates blend colours: linear (straight through RGB) or oklab (perceptual, stays bright mid-fade)
+    'rate_limit_per_second': 10,  # Actions each web client may request per second, after an initial burst (0 = unlimited). Faster requests get a 429
+    'rate_limit_burst': 20,  # Actions a web client may request at once
+    'discovery': 1,  # 1 = announce this listener on the LAN (SSDP, UDP port 1900) and find the others, listed at ?network
+    'discovery_probe_concurrency': 4,  # Max number of newly discovered listeners to ask for their details at once
+    'timesync': 1,  # 1 = keep to a clock shared with the other listeners, so ?rotate=...&sync=1 runs in step on all of them
+    'timesync_port': 9091,  # UDP port we answer other listeners' time requests on
+    'timesync_leader': '',  # host[:port] of the listener whose clock to follow. Blank = the one with the lowest USN on the network
+    'sync_lead_seconds': 1.0,  # How far ahead a synchronised sequence is scheduled, so every listener hears about it in time
+    'config_reload': 1,  # 1 = watch this file, and apply changes to pins, calibration, pi_port, coordinates etc. without restarting
+    'fleet_hosts': '',  # Fleet controller mode: comma delimited host[:port] list of Pis to drive together, e.g. 192.168.0.40,192.168.0.41:8888
+
+    'dither': 0,  # 1 = temporally dither fades and sequences, for smoother slow fades near black (e.g. the end of a sunset)
+    'dither_bits': 2,  # Extra bits of brightness resolution dithering adds (1-4). More bits flicker more slowly, so can be visible
 
     # Initial default values for your output pins. You can override them in your raspiled.conf file
     'red_pin': '27',
     'green_pin': '17',
     'blue_pin': '22',
 
+    # Music mode
+    'audio_source': 'alsa',  # alsa, alsa:<device> (e.g. alsa:plughw:1,0), fifo:<path> of raw S16_LE PCM, or a .wav file
+    'audio_sample_rate': 44100,
+    'audio_channels': 1,
+    'audio_block_size': 1024,  # Samples per block. 1024 at 44.1kHz is ~23ms, about one frame
+
+    # Addressable pixel strip (WS281x / APA102). Leave pixel_count at 0 if you only have an RGB PWM strip
+    'pixel_count': 0,
+    'pixel_type': 'ws281x',  # ws281x or apa102
+    'pixel_order': '',  # The order your chips expect the colour channels in, e.g. GRB. Blank = the usual for pixel_type: GRB for ws281x, BGR for apa102
+    'pixel_sink': 'spi:0.0',  # spi:<bus>.<device>, or a file / FIFO path to write raw frames to
+
     # Relative intensity correction for your colour channels
     'calibrate_r': 1.0,
     'calibrate_g': 0.63,
     'calibrate_b': 1.0,
 
+    # Logging
+    "log_file": "./raspiled_py3.log",
+    "log_level": "INFO",  # DEBUG, INFO, WARNING, ERROR or CRITICAL. Change it at runtime with ?loglevel=debug
+    "log_max_bytes": 1048576,  # Rotate the log file once it gets this big
+    "log_backups": 3,  # How many rotated log files to keep
+    "log_repeat_seconds": 10,  # Log a repeated message (e.g. pigpio errors every frame) at most once per this many seconds
+
     # Debug
-    "debug": 0
+    "debug": 0,
+    "frame_trace_seconds": 300,  # How many seconds of frame timings to keep for /frames (0 = off). ~36 bytes per frame, 50 frames a second
+    "simulate": 0,  # 1 = drive in-memory pins instead of a Raspberry Pi, e.g. for benchmarks or UI development
 }
 
 
 config_path = os.path.expanduser(RASPILED_DIR + '/raspiled.conf')
 parser = configparser.ConfigParser(defaults=DEFAULTS)
-params = {}
 
-if os.path.exists(config_path):
+# Importing this module never prompts or writes files: interactive_setup() does that, when run from a terminal
+config_file_needs_writing = not os.path.exists(config_path)
+if not config_file_needs_writing:
     logging.info('Using config file: {}'.format(config_path))
     parser.read(config_path)
-    params = ordereddict_to_int(parser.defaults())
-    config_file_needs_writing = False
-else:
-    config_file_needs_writing = True
-    # No config file exists, give the user a chance to specify their pin configuration
-    logging.warning('No config file found. Creating default {} file.'.format(config_path))
-    logging.warning('*** Please edit this file as needed. ***')
-
-    # Allow user to customise their pin config
+params = ordereddict_to_int(parser.defaults())  # The config file over the DEFAULTS (just the DEFAULTS if there is no file yet)
+log_listener = setup_logging(logger, params.get("log_file"), max_bytes=params.get("log_max_bytes"), backups=params.get("log_backups"),
+                             level=params.get("log_level"), repeat_seconds=params.get("log_repeat_seconds"))  # Opens the file on the first log line, not now
+
+
+def port_clash_error(pi_port, pig_port):
+    """
+    Checks that our ports are sane
+    @return: <unicode> What's wrong with them, or None if they are fine
+    """
+    try:
+        if int(pi_port) == int(pig_port):
+            return "*** You cannot have the web server running on port {} while the pigpio daemon is also running on that port! ***".format(pi_port)
+    except (ValueError, TypeError):
+        return "*** You have specified an invalid port number for the Raspiled web server ({}) or the Pigpio daemon ({}) ***".format(pi_port, pig_port)
+    return None
+
+
+def read_config(path=None):
+    """
+    Reads the config file over the DEFAULTS, the same way as at startup
+
+    @keyword path: <unicode> The config file. Defaults to config_path
+    @return: <OrderedDict> of settings, just the DEFAULTS if the file doesn't exist
+    @raise configparser.Error: If the file cannot be parsed (e.g. it is only half written)
+    """
+    fresh_parser = configparser.ConfigParser(defaults=DEFAULTS)
+    fresh_parser.read(path or config_path)
+    return ordereddict_to_int(fresh_parser.defaults())
+
+
+def config_errors(settings):
+    """
+    Checks the settings we can change while running are sane, before any of them are used
+
+    @param settings: {<unicode> name: value} e.g. from read_config()
+    @return: [<unicode> What's wrong, ] Empty if they are fine
+    """
+    errors = []
+    port_error = port_clash_error(settings.get("pi_port"), settings.get("pig_port"))
+    if port_error:
+        errors.append(port_error)
+    elif not 0 < int(settings["pi_port"]) < 65536:
+        errors.append("*** The Raspiled web server port ({}) must be between 1 and 65535 ***".format(settings["pi_port"]))
+    pins = []
+    for name in ("red_pin", "green_pin", "blue_pin"):
+        try:
+            pin = int(settings.get(name))
+        except (TypeError, ValueError):
+            pin = None
+        if pin is None or not 0 <= pin <= 27:
+            errors.append("*** {} ({}) must be a GPIO pin number, 0 - 27 ***".format(name, settings.get(name)))
+        pins.append(pin)
+    if None not in pins and len(set(pins)) != len(pins):
+        errors.append("*** The pin number should be different for all pins. ***")
+    for name, lower, upper in (("calibrate_r", 0.0, 1.0), ("calibrate_g", 0.0, 1.0), ("calibrate_b", 0.0, 1.0),
+                               ("latitude", -90.0, 90.0), ("longitude", -180.0, 180.0),
+                               ("rate_limit_per_second", 0, 10000), ("rate_limit_burst", 0, 10000),
+                               ("circadian_day_kelvin", 1000, 40000), ("circadian_night_kelvin", 1000, 40000), ("dither_bits", 1, 4)):
+        try:
+            value = float(settings.get(name))
+        except (TypeError, ValueError):
+            value = None
+        if value is None or not lower <= value <= upper or (name.startswith("calibrate_") and value == 0):
+            errors.append("*** {} ({}) must be a number from {} to {} ***".format(name, settings.get(name), lower, upper))
+    return errors
+
+
+user_port_error = port_clash_error(params.get("pi_port", DEFAULTS["pi_port"]), params.get("pig_port", DEFAULTS["pig_port"]))
+if user_port_error:
+    logging.warning(user_port_error)
+
+
+def interactive_setup():
+    """
+    Asks the user for their pin and port configuration, then writes the raspiled.conf file.
+    Only does anything if there is no config file yet, or the ports in it clash.
+    Call this from an interactive terminal, never on import.
+    """
+    global parser
+    needs_writing = config_file_needs_writing
+    if needs_writing:
+        # No config file exists, give the user a chance to specify their pin configuration
+        logging.warning('No config file found. Creating default {} file.'.format(config_path))
+        logging.warning('*** Please edit this file as needed. ***')
+
+        # Allow user to customise their pin config
+        while True:
+            try:  # These will assume the default settings UNLESS you enter a different value
+                user_input_red_pin = int(input('RED pin number [{}]:'.format(DEFAULTS["red_pin"])) or DEFAULTS["red_pin"])
+                user_input_green_pin = int(input('GREEN pin number [{}]:'.format(DEFAULTS["green_pin"])) or DEFAULTS["green_pin"])
+                user_input_blue_pin = int(input('BLUE pin number [{}]:'.format(DEFAULTS["blue_pin"])) or DEFAULTS["blue_pin"])
+            except (ValueError, TypeError):
+                logging.warning('*** The input should be an integer ***')
+            else:
+                DEFAULTS['red_pin'] = user_input_red_pin
+                DEFAULTS['green_pin'] = user_input_green_pin
+                DEFAULTS['blue_pin'] = user_input_blue_pin
+                if DEFAULTS['red_pin'] == DEFAULTS['blue_pin'] or DEFAULTS['red_pin'] == DEFAULTS['green_pin'] or DEFAULTS['green_pin'] == DEFAULTS['blue_pin']:
+                    logging.warning('*** The pin number should be different for all pins. ***')
+                else:
+                    break
+
+    # Check that our ports are sane:
+    user_pi_port = params.get("pi_port", DEFAULTS["pi_port"])
+    user_pig_port = params.get("pig_port", DEFAULTS["pig_port"])
     while True:
-        try:  # These will assume the default settings UNLESS you enter a different value
-            user_input_red_pin = int(input('RED pin number [{}]:'.format(DEFAULTS["red_pin"])) or DEFAULTS["red_pin"])
-            user_input_green_pin = int(input('GREEN pin number [{}]:'.format(DEFAULTS["green_pin"])) or DEFAULTS["green_pin"])
-            user_input_blue_pin = int(input('BLUE pin number [{}]:'.format(DEFAULTS["blue_pin"])) or DEFAULTS["blue_pin"])
+        port_error = port_clash_error(user_pi_port, user_pig_port)
+        if not port_error:  # Config is fine... carry on
+            DEFAULTS["pi_port"] = user_pi_port
+            DEFAULTS["pig_port"] = user_pig_port
+            break
+        logging.warning(port_error)
+        try:
+            user_pi_port = int(input('Raspiled web server port (e.g. 9090) [{}]:'.format(DEFAULTS["pi_port"])) or DEFAULTS["pi_port"])
+            user_pig_port = int(input('Pigpio daemon port (e.g. 8888) [{}]:'.format(DEFAULTS["pig_port"])) or DEFAULTS["pig_port"])
         except (ValueError, TypeError):
             logging.warning('*** The input should be an integer ***')
         else:
-            DEFAULTS['red_pin'] = user_input_red_pin
-            DEFAULTS['green_pin'] = user_input_green_pin
-            DEFAULTS['blue_pin'] = user_input_blue_pin
-            if DEFAULTS['red_pin'] == DEFAULTS['blue_pin'] or DEFAULTS['red_pin'] == DEFAULTS['green_pin'] or DEFAULTS['green_pin'] == DEFAULTS['blue_pin']:
-                logging.warning('*** The pin number should be different for all pins. ***')
-            else:
-                config_file_needs_writing = True
-                break
-
-# Check that our ports are sane:
-user_pi_port = params.get("pi_port", DEFAULTS["pi_port"])
-user_pig_port = params.get("pig_port", DEFAULTS["pig_port"])
-while True:
-    config_is_ok = True
-    try:
-        if int(user_pi_port) == int(user_pig_port):
-            config_is_ok = False
-            raise RuntimeError(
-                "*** You cannot have the web server running on port {} while the pigpio daemon is also running on that port! ***".format(DEFAULTS["pi_port"]))
-    except RuntimeError as e:
-        logging.warning(e)
-    except (ValueError, TypeError):
-        logging.warning("*** You have specified an invalid port number for the Raspiled web server ({}) or the Pigpio daemon ({}) ***".format(DEFAULTS["pi_port"],
-                                                                                                                                           DEFAULTS[
-                                                                                                                                               "pig_port"]))
-    else:  # Config is fine... carry on
-        DEFAULTS["pi_port"] = user_pi_port
-        DEFAULTS["pig_port"] = user_pig_port
-        break
+            needs_writing = True
 
-    try:
-        user_pi_port = int(input('Raspiled web server port (e.g. 9090) [{}]:'.format(DEFAULTS["pi_port"])) or DEFAULTS["pi_port"])
-        user_pig_port = int(input('Pigpio daemon port (e.g. 8888) [{}]:'.format(DEFAULTS["pig_port"])) or DEFAULTS["pig_port"])
-    except (ValueError, TypeError):
-        logging.warning('*** The input should be an integer ***')
-    else:
-        config_file_needs_writing = True
-
-# Now write the config file if needed
-if config_file_needs_writing:
-    parser = configparser.ConfigParser(defaults=DEFAULTS)
-    with open(config_path, 'w') as f:
-        parser.write(f)
-    params = ordereddict_to_int(parser.defaults())
+    # Now write the config file if needed
+    if needs_writing:
+        parser = configparser.ConfigParser(defaults=DEFAULTS)
+        if not config_file_needs_writing:  # Keep everything else from the existing file
+            parser.read(config_path)
+            parser.defaults().update(pi_port=six.text_type(user_pi_port), pig_port=six.text_type(user_pig_port))
+        with open(config_path, 'w') as f:
+            parser.write(f)
+        params.clear()  # In place, so everything holding CONFIG sees the new settings
+        params.update(ordereddict_to_int(parser.defaults()))
 
 
 CONFIG = params
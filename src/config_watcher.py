@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Config hot reload
+
+        Watches raspiled.conf while the listener runs, so changing the pins, calibration, web port or
+        coordinates doesn't mean restarting it (dropping whatever sequence is running, and waiting for
+        pigpio all over again).
+
+        The file's modification time is polled every couple of seconds: a stat() is all it costs, and it
+        works wherever the listener does, unlike inotify. When it changes, the whole file is read and
+        checked before anything is touched. A change that fails the checks (or a file caught half
+        written) is logged and the running settings are kept; a good one is handed to apply_changes()
+        all at once, and only becomes the running config if that succeeds.
+
+        Some settings are only used as the listener starts (e.g. pig_port, which needs a new pigpio
+        connection). Changes to those are logged as needing a restart, and not applied.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import configparser
+import os
+
+from twisted.internet import task
+
+from src.config import config_errors, logger, read_config
+from metrics import REGISTRY
+
+
+POLL_INTERVAL_SECONDS = 2.0  # How often to check whether the config file has changed
+RESTART_SETTINGS = frozenset((  # Only read as we start up, so changing them needs a restart
+    "config_path", "config_reload", "pi_host", "pig_port", "fleet_hosts", "simulate",
+    "pixel_count", "pixel_type", "pixel_order", "pixel_sink",
+    "discovery", "discovery_probe_concurrency", "timesync", "timesync_port", "debug",
+    "state_file", "jobs_file", "scheduler_catch_up_seconds", "solar_sunrise", "solar_sunset", "circadian",
+    "log_file", "log_max_bytes", "log_backups", "log_repeat_seconds", "frame_trace_seconds",
+))
+
+CONFIG_RELOADS = REGISTRY.counter("raspiled_config_reloads_total", "Times the config file changed while running, by outcome (applied or rejected)", ("outcome",))
+
+
+class ConfigWatcher(object):
+    """
+    Polls the config file, and applies its changes to the running listener
+    """
+
+    def __init__(self, reactor, path, settings, apply_changes, interval_seconds=POLL_INTERVAL_SECONDS):
+        """
+        @param reactor: The Twisted reactor
+        @param path: <unicode> The config file to watch
+        @param settings: {} The running settings (i.e. CONFIG), updated in place once a change has been applied
+        @param apply_changes: callable(<{name: value}> new settings, <[name, ]> changed names) makes the changes live.
+                              It raises ValueError to refuse them, having changed nothing
+        @keyword interval_seconds: <float> How often to check the file
+        """
+        self.reactor = reactor
+        self.path = path
+        self.settings = settings
+        self.apply_changes = apply_changes
+        self.interval_seconds = interval_seconds
+        self._mtime = self._file_stat()[0]
+        self._poll_task = None
+
+    def _file_stat(self):
+        """
+        @return: (<float> modification time, <int> size), both None if the file isn't there
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None, None
+        return stat.st_mtime, stat.st_size
+
+    def start(self):
+        self._poll_task = task.LoopingCall(self.check)
+        self._poll_task.clock = self.reactor
+        self._poll_task.start(self.interval_seconds, now=False)
+
+    def stop(self):
+        if self._poll_task is not None and self._poll_task.running:
+            self._poll_task.stop()
+        self._poll_task = None
+
+    def check(self):
+        """
+        Reloads the config if the file has changed since we last looked
+        @return: <Bool> Whether any changes were applied
+        """
+        mtime, size = self._file_stat()
+        if mtime == self._mtime or not size:  # Unchanged, or gone / empty (e.g. an editor mid save): keep what we have
+            return False
+        try:
+            new_settings = read_config(self.path)
+        except configparser.Error as e:  # Most likely half written. Leave _mtime alone so we try again next time
+            logger.warning("Config: could not read %s (%s), trying again shortly", self.path, e)
+            return False
+        self._mtime = mtime
+        return self.reload(new_settings)
+
+    def reload(self, new_settings):
+        """
+        Checks new_settings, and applies whichever of them differ from the running settings, all or nothing
+        @return: <Bool> Whether any changes were applied
+        """
+        changed = [name for name, value in new_settings.items() if self.settings.get(name) != value]
+        needs_restart = sorted(name for name in changed if name in RESTART_SETTINGS)
+        if needs_restart:
+            logger.warning("Config: %s changed in %s, which only takes effect when the listener restarts", ", ".join(needs_restart), self.path)
+        changed = [name for name in changed if name not in RESTART_SETTINGS]
+        if not changed:
+            return False
+        errors = config_errors(new_settings)
+        if errors:
+            CONFIG_RELOADS.inc(labels=("rejected",))
+            logger.error("Config: not applying the changes to %s, keeping the running settings:\n%s", self.path, "\n".join(errors))
+            return False
+        running_settings = dict(self.settings)
+        self.settings.update((name, new_settings[name]) for name in changed)  # So whatever they're applied to sees them
+        try:
+            self.apply_changes(new_settings, changed)
+        except ValueError as e:
+            self.settings.clear()
+            self.settings.update(running_settings)
+            CONFIG_RELOADS.inc(labels=("rejected",))
+            logger.error("Config: not applying the changes to %s, keeping the running settings: %s", self.path, e)
+            return False
+        CONFIG_RELOADS.inc(labels=("applied",))
+        logger.info("Config: applied %s from %s", ", ".join("{}={}".format(name, new_settings[name]) for name in changed), self.path)
+        return True
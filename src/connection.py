@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Supervised pigpio connections
+
+        Keeps a connection to one pigpio daemon alive. A background worker owns every blocking socket
+        call: it writes frames, health-checks the daemon while idle, reconnects with exponential backoff
+        when the daemon goes away (e.g. pigpiod restarts), then replays the authoritative pin values so
+        the strip comes back to the colour it should be showing.
+
+        While disconnected we are in degraded mode: frames update the authoritative values and are
+        otherwise dropped, so the frame loop never blocks and the log isn't flooded.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+
+import pigpio
+import six
+
+from src.config import logger
+from metrics import REGISTRY
+
+
+HEALTH_CHECK_SECONDS = 2.0  # How often an idle worker pings the daemon
+BACKOFF_INITIAL_SECONDS = 0.5  # First reconnect wait
+BACKOFF_MAX_SECONDS = 30.0  # Reconnect waits double up to this ceiling
+LATENCY_SMOOTHING = 0.2  # Weight given to the newest sample in the rolling average latency
+PROBE_TIMEOUT_SECONDS = 0.25  # How long port_is_open() waits for a TCP handshake
+
+PIGPIO_WRITE_SECONDS = REGISTRY.histogram("raspiled_pigpio_write_seconds", "Time taken to write a frame of pin values to pigpio", ("host",))
+PIGPIO_ERRORS = REGISTRY.counter("raspiled_pigpio_errors_total", "pigpio calls or connection attempts which failed", ("host",))
+PIGPIO_RECONNECTS = REGISTRY.counter("raspiled_pigpio_reconnects_total", "Times a lost pigpio connection came back", ("host",))
+PIGPIO_FRAMES_DROPPED = REGISTRY.counter("raspiled_pigpio_frames_dropped_total", "Pin values overwritten before they were written, or dropped while disconnected", ("host",))
+
+
+def port_is_open(host, port, timeout=PROBE_TIMEOUT_SECONDS):
+    """
+    Whether something is listening on host:port. A cheap TCP connect, no subprocesses
+
+    @return: <Bool>
+    """
+    try:
+        probe = socket.create_connection((host, int(port)), timeout=timeout)
+    except (socket.error, socket.timeout, ValueError, TypeError, OverflowError):
+        return False
+    probe.close()
+    return True
+
+
+@six.python_2_unicode_compatible
+class SupervisedConnection(object):
+    """
+    A self-healing connection to the pigpio daemon on one Raspberry Pi.
+
+        submit() never blocks: the newest value for each pin overwrites any value the worker has not
+        got round to writing yet. Every value ever submitted is remembered as the authoritative state,
+        which is replayed in full after a reconnect.
+    """
+    pi = None  # <pigpio.pi> once connected
+
+    def __init__(self, host, port, connect_now=False, health_check_seconds=HEALTH_CHECK_SECONDS,
+                 backoff_initial_seconds=BACKOFF_INITIAL_SECONDS, backoff_max_seconds=BACKOFF_MAX_SECONDS):
+        """
+        @param host: <unicode> The Pi's hostname or IP
+        @param port: <int> The port its pigpio daemon listens on
+        @keyword connect_now: <Bool> Try to connect before returning, so the current pin values can be read straight away
+        """
+        self.host = host
+        self.port = int(port)
+        self.health_check_seconds = health_check_seconds
+        self.backoff_initial_seconds = backoff_initial_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self._authoritative = {}  # pin : value we want the Pi to be showing
+        self._dirty = set()  # pins waiting to be written
+        self._condition = threading.Condition()
+        self._stop_signal = False
+        self._stop_event = threading.Event()  # Lets stop() cut a backoff wait short
+        self._backoff_seconds = backoff_initial_seconds
+        self._disconnected_at = None
+        self._metric_labels = ("{}:{}".format(host, self.port),)
+        # Stats
+        self.frames_written = 0
+        self.frames_dropped = 0  # Values overwritten before they were written, or not written because we were disconnected
+        self.errors = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.last_latency_ms = None
+        self.avg_latency_ms = None
+        self.max_latency_ms = None
+        if connect_now:
+            try:
+                self._connect()
+            except IOError as e:
+                self._record_error(e)
+        self._thread = threading.Thread(target=self._run, name="raspiled-pigpio-{}:{}".format(host, port))
+        self._thread.daemon = True  # Never keep the process alive for a dead Pi
+        self._thread.start()
+
+    def __str__(self):
+        status = "CONNECTED!" if self.connected else "DISCONNECTED (degraded mode)"
+        return "RaspberryPi Pins @ {}:{}... {}".format(self.host, self.port, status)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def connected(self):
+        """
+        Whether we currently hold a live connection to the daemon
+        """
+        pi = self.pi
+        return bool(pi is not None and pi.connected)
+
+    def submit(self, pin, value):
+        """
+        Sets the authoritative value for a pin, and queues it for writing if we are connected. Never blocks
+        """
+        with self._condition:
+            self._authoritative[pin] = value
+            if not self.connected:
+                self.frames_dropped += 1  # Degraded mode: remembered for the replay, but not written
+                PIGPIO_FRAMES_DROPPED.inc(labels=self._metric_labels)
+                return
+            if pin in self._dirty:
+                self.frames_dropped += 1
+                PIGPIO_FRAMES_DROPPED.inc(labels=self._metric_labels)
+            self._dirty.add(pin)
+            self._condition.notify()
+
+    def read(self, pin):
+        """
+        Returns the authoritative value for a pin. If we have never set it, asks the Pi (blocking), or 0 if we can't
+        """
+        try:
+            return self._authoritative[pin]
+        except KeyError:
+            pass
+        pi = self.pi
+        if pi is None or not pi.connected:
+            return 0
+        try:
+            value = pi.get_PWM_dutycycle(pin)
+        except pigpio.error:  # Pin isn't currently outputting PWM
+            value = 0
+        except Exception as e:  # Socket trouble, the worker will pick it up on the next health check
+            self.last_error = "{}: {}".format(e.__class__.__name__, e)
+            return 0
+        with self._condition:
+            self._authoritative.setdefault(pin, value)
+        return value
+
+    def _connect(self):
+        """
+        Builds a fresh pigpio connection (blocks, but only the worker or the constructor)
+        """
+        self._disconnect()
+        pi = pigpio.pi(self.host, self.port, show_errors=False)
+        if not pi.connected:
+            raise IOError("Cannot connect to pigpio at {}:{}".format(self.host, self.port))
+        with self._condition:
+            self.pi = pi
+            self._dirty.update(self._authoritative)  # Replay everything: a restarted daemon has forgotten our colour
+            self._condition.notify()
+        if self._disconnected_at is not None:
+            self.reconnects += 1
+            PIGPIO_RECONNECTS.inc(labels=self._metric_labels)
+            logger.info("pigpio: reconnected to %s:%s after %.1fs, replaying %s pin values",
+                        self.host, self.port, time.time() - self._disconnected_at, len(self._authoritative))
+        else:
+            logger.info("pigpio: connected to %s:%s", self.host, self.port)
+        self._disconnected_at = None
+        self._backoff_seconds = self.backoff_initial_seconds
+
+    def _disconnect(self):
+        pi = self.pi
+        self.pi = None
+        try:
+            pi.stop()
+        except (AttributeError, IOError, pigpio.error):
+            pass
+
+    def _record_error(self, e):
+        self.errors += 1
+        PIGPIO_ERRORS.inc(labels=self._metric_labels)
+        self.last_error = "{}: {}".format(e.__class__.__name__, e)
+        if self._disconnected_at is None:  # Only log the start of an outage, not every retry
+            self._disconnected_at = time.time()
+            logger.warning("pigpio: lost %s:%s (%s). Degraded mode, dropping frames while reconnecting.", self.host, self.port, self.last_error)
+
+    def _record_latency(self, seconds):
+        PIGPIO_WRITE_SECONDS.observe(seconds, self._metric_labels)
+        latency_ms = seconds * 1000.0
+        self.last_latency_ms = latency_ms
+        if self.avg_latency_ms is None:
+            self.avg_latency_ms = latency_ms
+        else:
+            self.avg_latency_ms += LATENCY_SMOOTHING * (latency_ms - self.avg_latency_ms)
+        self.max_latency_ms = max(self.max_latency_ms or 0.0, latency_ms)
+
+    def _wait_for_frame(self):
+        """
+        Waits for pins to write, up to the health check interval
+        :return: {pin: value} to write, or None if we timed out and should health check
+        """
+        with self._condition:
+            if not self._dirty and not self._stop_signal:
+                self._condition.wait(self.health_check_seconds)
+            if not self._dirty:
+                return None
+            frame = dict((pin, self._authoritative[pin]) for pin in self._dirty)
+            self._dirty.clear()
+        return frame
+
+    def _backoff(self):
+        """
+        Waits before the next reconnect attempt, doubling the wait each time
+        """
+        self._stop_event.wait(self._backoff_seconds)
+        self._backoff_seconds = min(self._backoff_seconds * 2.0, self.backoff_max_seconds)
+
+    def _run(self):
+        """
+        Worker loop: connect when needed, write the latest values, health check when idle
+        """
+        while not self._stop_signal:
+            if not self.connected:
+                try:
+                    self._connect()
+                except Exception as e:  # pigpio can raise socket, struct or pigpio errors
+                    self._record_error(e)
+                    self._backoff()
+                    continue
+            frame = self._wait_for_frame()
+            if self._stop_signal:
+                break
+            try:
+                started = time.time()
+                if frame is None:
+                    self.pi.get_current_tick()  # Cheap ping
+                else:
+                    for pin, value in frame.items():
+                        self.pi.set_PWM_dutycycle(pin, value)
+                    self._record_latency(time.time() - started)
+                    self.frames_written += 1
+            except Exception as e:
+                self._record_error(e)
+                self._disconnect()  # The unwritten frame is in the authoritative values, so goes out on reconnect
+        self._disconnect()
+
+    def stop(self):
+        """
+        Stops the worker and releases the connection
+        """
+        with self._condition:
+            self._stop_signal = True
+            self._stop_event.set()
+            self._condition.notify()
+
+    def report(self):
+        """
+        Returns a dict of this connection's health
+        """
+        def _ms(value):
+            return None if value is None else round(value, 2)
+        return {
+            "host": self.host,
+            "port": self.port,
+            "connected": self.connected,
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+            "latency_ms": _ms(self.last_latency_ms),
+            "latency_ms_avg": _ms(self.avg_latency_ms),
+            "latency_ms_max": _ms(self.max_latency_ms),
+        }
+
+
+@six.python_2_unicode_compatible
+class SupervisedPiInterface(object):
+    """
+    Stands in for a PiPinInterface, but talks to the Pi through a SupervisedConnection.
+
+        Only implements the part of pigpio.pi that LEDStrip uses. Writes return immediately and are
+        dropped quietly while the daemon is away; reads come from the authoritative values.
+    """
+
+    def __init__(self, params):
+        self.connection = SupervisedConnection(params.get("pi_host", "localhost"), params.get("pig_port", 8888), connect_now=True)
+        self._stopped = False
+        # LEDStrip compares these against the settings
+        self._host = self.connection.host
+        self._port = self.connection.port
+
+    def __str__(self):
+        return six.text_type(self.connection)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def connected(self):
+        """
+        Accepts frames for as long as it's running. Whether the daemon is actually there is in report()
+        """
+        return not self._stopped
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self.connection.submit(user_gpio, dutycycle)
+        return 0
+
+    def get_PWM_dutycycle(self, user_gpio):
+        return self.connection.read(user_gpio)
+
+    def stop(self):
+        self._stopped = True
+        self.connection.stop()
+
+    def report(self):
+        return [self.connection.report()]
+
+
+@six.python_2_unicode_compatible
+class SimulatedPiInterface(object):
+    """
+    Stands in for a PiPinInterface with pins that only exist in memory.
+
+        For benchmarks, and for developing the web interface without a Raspberry Pi. Turn it on with
+        simulate = 1 in raspiled.conf.
+    """
+
+    def __init__(self, params=None):
+        params = params or {}
+        self._pins = {}
+        self._stopped = False
+        self.frames_written = 0
+        # LEDStrip compares these against the settings
+        self._host = params.get("pi_host", "localhost")
+        self._port = params.get("pig_port", 8888)
+
+    def __str__(self):
+        return "Simulated RaspberryPi Pins ({} writes)".format(self.frames_written)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def connected(self):
+        return not self._stopped
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self._pins[user_gpio] = dutycycle
+        self.frames_written += 1
+        return 0
+
+    def get_PWM_dutycycle(self, user_gpio):
+        return self._pins.get(user_gpio, 0)
+
+    def stop(self):
+        self._stopped = True
+
+    def report(self):
+        return [{
+            "host": "simulated",
+            "port": None,
+            "connected": self.connected,
+            "frames_written": self.frames_written,
+        }]
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Network discovery
+
+        Finds the other Raspiled listeners on your LAN, SSDP style (the same multicast protocol UPnP
+        devices use, on 239.255.255.250:1900):
+
+            * Every BROADCAST_INTERVAL_SECONDS we multicast a NOTIFY ssdp:alive, saying where our device
+              descriptor lives (http://<ip>:<port>/whoami) and how long to remember us for (max-age).
+            * At startup we multicast an M-SEARCH, and every listener answers it directly, so a new Pi
+              fills its directory in seconds rather than waiting for the next round of announcements.
+            * Whenever we hear of a peer we haven't got a descriptor for (or whose descriptor has
+              changed, which its ETag tells us) we fetch its /whoami, a few peers at a time.
+            * Peers we stop hearing from drop out of the directory once their max-age runs out, or
+              straight away if they say ssdp:byebye on the way down.
+
+        Our own messages are built once, so announcing costs one UDP write, and everything runs on the
+        reactor thread, so rendering the network page is a read of the directory with no network round trips.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import random
+import re
+import socket
+
+import six
+from six.moves.urllib.parse import urlsplit
+from twisted.internet import defer, task
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import DatagramProtocol
+
+from src.config import logger
+from metrics import REGISTRY, monotonic
+
+
+SSDP_ADDR = "239.255.255.250"  # Where SSDP devices announce themselves
+SSDP_PORT = 1900
+SEARCH_TARGET = "urn:raspiled:device:1"  # What we announce ourselves as, and search for
+MAX_AGE_SECONDS = 60  # How long peers should remember us without hearing from us again
+MAX_SEARCH_DELAY_SECONDS = 2  # M-SEARCH MX: peers spread their answers over this long, so they don't all land at once
+PROBE_CONCURRENCY = 4  # Max number of peer descriptors to fetch at once
+PROBE_TIMEOUT_SECONDS = 5  # Give up fetching a peer's descriptor after this long
+RE_MAX_AGE = re.compile(r"max-age\s*=\s*([0-9]+)", re.IGNORECASE)
+
+PEERS = REGISTRY.gauge("raspiled_discovery_peers", "Raspiled listeners in the peer directory")
+PROBES = REGISTRY.counter("raspiled_discovery_probes_total", "Peer descriptor fetches, by result (ok or error)", ("result",))
+
+
+def build_message(start_line, headers):
+    """
+    @param start_line: <unicode> e.g. "NOTIFY * HTTP/1.1"
+    @param headers: ((<unicode> name, value), ) in order
+    @return: <bytes> An SSDP (HTTP over UDP) message
+    """
+    lines = [start_line] + ["{}: {}".format(name, value) for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+
+def parse_message(datagram):
+    """
+    @param datagram: <bytes> An SSDP message
+    @return: (<unicode> start line, {<unicode> lower case header name: <unicode> value}). The start line is "" if it is not an SSDP message
+    """
+    try:
+        text = datagram.decode("utf-8")
+    except UnicodeDecodeError:
+        return "", {}
+    lines = text.split("\r\n")
+    start_line = lines[0].strip()
+    if not (start_line.endswith("HTTP/1.1") or start_line.startswith("HTTP/1.1")):
+        return "", {}
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    return start_line, headers
+
+
+def parse_max_age(cache_control, default=MAX_AGE_SECONDS):
+    """
+    @param cache_control: <unicode> e.g. "max-age=60"
+    @return: <int> seconds
+    """
+    match = RE_MAX_AGE.search(cache_control or "")
+    if match is None:
+        return default
+    return int(match.group(1))
+
+
+def local_ip_address(towards=SSDP_ADDR):
+    """
+    @return: <unicode> The IP address this machine uses to reach the LAN (no packets are sent), or 127.0.0.1 if there is no network
+    """
+    probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe_socket.connect((towards, SSDP_PORT))
+        return six.ensure_text(probe_socket.getsockname()[0])
+    except (OSError, socket.error):
+        return "127.0.0.1"
+    finally:
+        probe_socket.close()
+
+
+class Peer(object):
+    """
+    Another Raspiled listener, as far as we know it
+    """
+
+    def __init__(self, usn, location, etag, expires):
+        self.usn = usn  # Unique Service Name, which identifies the listener whatever its address
+        self.location = location  # <unicode> URL of its descriptor
+        self.etag = etag  # Changes whenever its descriptor does
+        self.expires = expires  # monotonic() time after which we forget it
+        self.descriptor = None  # {} its /whoami, once fetched
+
+    @property
+    def url(self):
+        """
+        @return: <unicode> Its controls page
+        """
+        parts = urlsplit(self.location)
+        return "{}://{}/".format(parts.scheme or "http", parts.netloc)
+
+    def as_dict(self, now):
+        descriptor = self.descriptor or {}
+        return {
+            "usn": self.usn,
+            "name": descriptor.get("name") or urlsplit(self.location).hostname,
+            "url": self.url,
+            "location": self.location,
+            "descriptor": self.descriptor,
+            "expires_in": max(round(self.expires - now, 1), 0),
+        }
+
+
+class PeerDirectory(object):
+    """
+    The Raspiled listeners we've heard from lately, keyed by USN. Each is forgotten once its max-age runs out
+    """
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self._peers = {}  # usn : <Peer>
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __contains__(self, usn):
+        return usn in self._peers
+
+    def get(self, usn):
+        return self._peers.get(usn)
+
+    def seen(self, usn, location, max_age=MAX_AGE_SECONDS, etag=None):
+        """
+        Records that usn is alive at location
+
+        @return: <Bool> Whether its descriptor needs fetching (it's new, has moved or changed, or we never got it)
+        """
+        expires = self.clock() + max_age
+        peer = self._peers.get(usn)
+        if peer is None:
+            peer = self._peers[usn] = Peer(usn, location, etag, expires)
+            PEERS.set(len(self._peers))
+            logger.info("Discovery: found %s at %s", usn, location)
+            return True
+        peer.expires = expires
+        if peer.location != location or peer.etag != etag:
+            peer.location = location
+            peer.etag = etag
+            peer.descriptor = None
+        return peer.descriptor is None
+
+    def describe(self, usn, descriptor):
+        """
+        Stores usn's descriptor, if we still know of it
+        """
+        peer = self._peers.get(usn)
+        if peer is not None:
+            peer.descriptor = descriptor
+
+    def forget(self, usn):
+        if self._peers.pop(usn, None) is not None:
+            PEERS.set(len(self._peers))
+            logger.info("Discovery: %s left", usn)
+
+    def expire(self):
+        """
+        Forgets the peers we haven't heard from within their max-age
+        """
+        now = self.clock()
+        for usn in [usn for usn, peer in self._peers.items() if peer.expires < now]:
+            self.forget(usn)
+
+    def peers(self):
+        """
+        @return: [{}, ] The live peers, sorted by name
+        """
+        self.expire()
+        now = self.clock()
+        return sorted((peer.as_dict(now) for peer in self._peers.values()), key=lambda peer: (peer["name"] or "", peer["usn"]))
+
+
+class SSDPProtocol(DatagramProtocol):
+    """
+    Joins the SSDP multicast group and hands every message it hears to the Discovery
+    """
+
+    def __init__(self, discovery):
+        self.discovery = discovery
+
+    def startProtocol(self):
+        self.transport.setTTL(2)  # As SSDP recommends: far enough for a home network, no further
+        self.transport.joinGroup(SSDP_ADDR)
+
+    def datagramReceived(self, datagram, address):
+        self.discovery.datagram_received(datagram, address)
+
+
+class Discovery(object):
+    """
+    Announces this listener on the LAN and keeps a directory of the others
+    """
+
+    def __init__(self, reactor, descriptor, location, interval_seconds=15, max_age=MAX_AGE_SECONDS, probe_concurrency=PROBE_CONCURRENCY,
+                 fetch_descriptor=None):
+        """
+        @param reactor: The Twisted reactor
+        @param descriptor: {} What we are. Must have a "usn"
+        @param location: <unicode> URL of our descriptor e.g. http://192.168.0.33:9090/whoami
+        @keyword interval_seconds: <float> How often to announce ourselves
+        @keyword max_age: <int> How long peers should remember us for. Should be a few intervals
+        @keyword probe_concurrency: <int> Max number of peer descriptors to fetch at once
+        @keyword fetch_descriptor: callable(<unicode> location) -> Deferred firing with a {} descriptor. Defaults to an HTTP GET
+        """
+        self.reactor = reactor
+        self.usn = descriptor["usn"]
+        self.location = location
+        self.interval_seconds = interval_seconds
+        self.max_age = max_age
+        self.directory = PeerDirectory()
+        self.fetch_descriptor = fetch_descriptor or self.http_get_descriptor
+        self.port = None  # Our multicast listening port, once started
+        self._announce_task = None
+        self._probes = defer.DeferredSemaphore(max(int(probe_concurrency), 1))
+        self._probing = set()  # usns whose descriptors are being fetched
+        etag = hashlib.sha1(json.dumps(descriptor, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        identity = (
+            ("CACHE-CONTROL", "max-age={}".format(max_age)),
+            ("LOCATION", location),
+            ("SERVER", "Raspiled UPnP/1.1"),
+            ("USN", self.usn),
+            ("ETAG", etag),
+        )
+        host = ("HOST", "{}:{}".format(SSDP_ADDR, SSDP_PORT))
+        self._alive = build_message("NOTIFY * HTTP/1.1", (host, ("NT", SEARCH_TARGET), ("NTS", "ssdp:alive")) + identity)
+        self._byebye = build_message("NOTIFY * HTTP/1.1", (host, ("NT", SEARCH_TARGET), ("NTS", "ssdp:byebye"), ("USN", self.usn)))
+        self._search = build_message("M-SEARCH * HTTP/1.1", (host, ("MAN", '"ssdp:discover"'), ("MX", MAX_SEARCH_DELAY_SECONDS), ("ST", SEARCH_TARGET)))
+        self._response = build_message("HTTP/1.1 200 OK", (("ST", SEARCH_TARGET), ("EXT", "")) + identity)
+
+    def start(self):
+        """
+        Starts listening, announces us, and asks who else is out there
+        @return: <Bool> Whether it started (it can't if port 1900 is unavailable)
+        """
+        try:
+            self.port = self.reactor.listenMulticast(SSDP_PORT, SSDPProtocol(self), listenMultiple=True)
+        except CannotListenError as e:
+            logger.warning("Discovery: cannot listen for peers on port %s (%s)", SSDP_PORT, e)
+            return False
+        self._announce_task = task.LoopingCall(self.announce)
+        self._announce_task.clock = self.reactor
+        self._announce_task.start(self.interval_seconds)
+        self.search()
+        return True
+
+    def stop(self):
+        """
+        Says goodbye, so peers drop us straight away, and stops listening
+        """
+        if self._announce_task is not None and self._announce_task.running:
+            self._announce_task.stop()
+        if self.port is not None:
+            self.send(self._byebye)
+            self.port.stopListening()
+            self.port = None
+
+    def send(self, message, address=(SSDP_ADDR, SSDP_PORT)):
+        if self.port is None or not getattr(self.port, "connected", False):  # Already closed, e.g. by the reactor shutting down
+            return
+        try:
+            self.port.write(message, address)
+        except Exception as e:  # The network going away mustn't take the listener with it
+            logger.warning("Discovery: could not send to %s:%s (%s: %s)", address[0], address[1], e.__class__.__name__, e)
+
+    def announce(self):
+        """
+        Tells the LAN we're still here, and forgets the peers that have gone quiet
+        """
+        self.send(self._alive)
+        self.directory.expire()
+
+    def search(self):
+        self.send(self._search)
+
+    def datagram_received(self, datagram, address):
+        start_line, headers = parse_message(datagram)
+        if not start_line:
+            return
+        if start_line.startswith("M-SEARCH"):
+            if headers.get("st") in (SEARCH_TARGET, "ssdp:all"):
+                try:
+                    delay = random.uniform(0, min(int(headers.get("mx") or 1), 5))
+                except ValueError:
+                    delay = 0
+                self.reactor.callLater(delay, self.send, self._response, address)
+            return
+        usn = headers.get("usn")
+        if not usn or usn == self.usn:
+            return
+        if start_line.startswith("NOTIFY"):
+            if headers.get("nt") != SEARCH_TARGET:
+                return
+            if headers.get("nts") == "ssdp:byebye":
+                self.directory.forget(usn)
+                return
+        elif headers.get("st") != SEARCH_TARGET:  # A response to someone's M-SEARCH
+            return
+        self.saw(usn, headers, address)
+
+    def saw(self, usn, headers, address):
+        """
+        Records a peer's announcement, fetching its descriptor if we need it
+        """
+        location = headers.get("location") or "http://{}/whoami".format(address[0])
+        needs_probe = self.directory.seen(usn, location, max_age=parse_max_age(headers.get("cache-control")), etag=headers.get("etag"))
+        if needs_probe:
+            self.probe(usn)
+
+    def probe(self, usn):
+        """
+        Fetches usn's descriptor into the directory. At most probe_concurrency fetches run at once; the rest queue
+        """
+        if usn in self._probing:
+            return None
+        self._probing.add(usn)
+
+        def fetch():
+            peer = self.directory.get(usn)
+            if peer is None:  # Expired while it queued
+                return None
+            return self.fetch_descriptor(peer.location)
+
+        def fetched(descriptor):
+            if descriptor is not None:
+                self.directory.describe(usn, descriptor)
+                PROBES.inc(labels=("ok",))
+
+        def failed(failure):
+            PROBES.inc(labels=("error",))
+            logger.warning("Discovery: could not fetch the descriptor of %s (%s)", usn, failure.getErrorMessage())
+
+        def finished(result):
+            self._probing.discard(usn)
+            return result
+
+        return self._probes.run(fetch).addCallbacks(fetched, failed).addBoth(finished)
+
+    def http_get_descriptor(self, location):
+        """
+        @return: Deferred firing with the JSON at location
+        """
+        from twisted.web.client import Agent, readBody  # Only needed once a peer turns up
+        agent = Agent(self.reactor, connectTimeout=PROBE_TIMEOUT_SECONDS)
+        deferred = agent.request(b"GET", six.ensure_binary(location, encoding="utf-8"))
+        deferred.addCallback(readBody)
+        deferred.addCallback(lambda body: json.loads(body.decode("utf-8")))
+        deferred.addTimeout(PROBE_TIMEOUT_SECONDS, self.reactor)
+        return deferred
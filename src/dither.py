@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Temporal dithering
+
+        The PWM duty cycle only comes in whole steps (0-255), and near black one step is a big jump in
+        brightness, so a slow fade to black (the tail of a sunset) visibly staircases. Dithering shows a
+        fractional duty cycle by flicking between the two whole steps either side of it, frame by frame,
+        so that on average over a few frames the light is at the fraction. Each extra bit of dithering
+        doubles the resolution, without raising the PWM range.
+
+        Which frames go up a step is decided by error diffusion: each frame's rounding error is carried into
+        the next, so the up-steps are spread as evenly as they can be. For each fractional level that pattern
+        is worked out once, into a residual table, so a dithered frame costs a table lookup per channel.
+
+        Dithering only helps while the colour is changing. Once it holds still, the output settles on the
+        nearest whole step, so a static colour never flickers.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import math
+
+
+DITHER_BITS = 2  # Default extra bits of resolution. Each one doubles the cycle length: at 50 frames a second 2 bits repeat at 12.5Hz
+MAX_DITHER_BITS = 4  # More than this repeats slowly enough to see the flicker
+CHANNEL_PHASES = (0.0, 1.0 / 3, 2.0 / 3)  # Stagger the channels' cycles, so their up-steps don't all land on the same frame
+
+
+_residual_tables = {}  # bits : table
+
+
+def residual_table(bits):
+    """
+    For each fractional level, which frames of the cycle go up a step, by error diffusion
+
+    @param bits: <int> 1 - MAX_DITHER_BITS
+    @return: ((<int> 0 or 1 per frame, ), ) indexed [level][frame], 2 ** bits of each
+    """
+    try:
+        return _residual_tables[bits]
+    except KeyError:
+        pass
+    levels = 1 << bits
+    table = []
+    for level in range(levels):
+        fraction = level / float(levels)
+        carried = 0.0
+        pattern = []
+        for _frame in range(levels):
+            wanted = fraction + carried
+            step = int(math.floor(wanted + 0.5))
+            carried = wanted - step
+            pattern.append(step)
+        table.append(tuple(pattern))
+    _residual_tables[bits] = table = tuple(table)
+    return table
+
+
+class TemporalDither(object):
+    """
+    Turns a stream of fractional duty cycles, one (r, g, b) per frame, into whole ones whose average over each
+    cycle is the fraction
+    """
+
+    def __init__(self, bits=DITHER_BITS):
+        """
+        @keyword bits: <int> Extra bits of resolution, 1 - MAX_DITHER_BITS
+        """
+        self.bits = min(max(int(bits), 1), MAX_DITHER_BITS)
+        self.levels = 1 << self.bits
+        self.table = residual_table(self.bits)
+        self.frame = 0
+        self.settled = True  # Whether the last output was the plain rounded colour
+        self._offsets = tuple(int(phase * self.levels) for phase in CHANNEL_PHASES)
+        self._last_rgb = None
+
+    def dither(self, r, g, b):
+        """
+        @param r, g, b: <float> duty cycles
+        @return: (<int> r, <int> g, <int> b) the whole duty cycles to show this frame
+        """
+        rgb = (r, g, b)
+        if rgb == self._last_rgb:  # Holding still: no need to dither
+            self.settled = True
+            return int(round(r)), int(round(g)), int(round(b))
+        self._last_rgb = rgb
+        self.settled = False
+        self.frame = frame = (self.frame + 1) % self.levels
+        levels = self.levels
+        table = self.table
+        out = []
+        for value, offset in zip(rgb, self._offsets):
+            whole = int(value)  # Duty cycles are never negative, so this is floor()
+            level = int((value - whole) * levels + 0.5)
+            if level == levels:
+                whole += 1
+                level = 0
+            out.append(whole + table[level][(frame + offset) % levels])
+        return tuple(out)
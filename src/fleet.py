@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Fleet controller
+
+        Lets one listener drive the LED strips on many Raspberry Pis at once. Each Pi gets its own
+        supervised pigpio connection and worker thread, so every frame goes out to all of them in
+        parallel and a slow or dead Pi never holds up the rest.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import six
+
+from connection import SupervisedConnection
+from src.config import logger
+
+
+def parse_fleet_hosts(fleet_hosts, default_port=8888):
+    """
+    Converts the fleet_hosts setting into a list of (host, port) tuples
+
+        "192.168.0.40, 192.168.0.41:7777" -> [("192.168.0.40", 8888), ("192.168.0.41", 7777)]
+
+    @param fleet_hosts: <unicode> comma delimited list of host or host:port entries, or an iterable of them
+    @keyword default_port: <int> The pigpio daemon port to use when an entry doesn't specify one
+
+    @return: [(<unicode> host, <int> port), ]
+    """
+    if not fleet_hosts:
+        return []
+    if isinstance(fleet_hosts, (six.text_type, six.binary_type)):
+        fleet_hosts = six.ensure_text(fleet_hosts, "utf-8").split(",")
+    out_hosts = []
+    for entry in fleet_hosts:
+        entry = six.text_type(entry).strip()
+        if not entry:
+            continue
+        host, _sep, port = entry.partition(":")
+        try:
+            port = int(port) if port else int(default_port)
+        except (TypeError, ValueError):
+            logger.warning("Fleet: ignoring '%s', the port is not a valid integer", entry)
+            continue
+        if (host, port) not in out_hosts:
+            out_hosts.append((host, port))
+    return out_hosts
+
+
+@six.python_2_unicode_compatible
+class PiFleetInterface(object):
+    """
+    Stands in for a PiPinInterface, but fans every pin write out to many Raspberry Pis in parallel.
+
+        Only implements the part of pigpio.pi that LEDStrip uses. Writes return immediately; reads are
+        answered from the values we last sent, so nothing on the frame loop waits on the network.
+    """
+
+    def __init__(self, hosts, **connection_kwargs):
+        """
+        @param hosts: [(<unicode> host, <int> port), ] as returned by parse_fleet_hosts()
+        @keyword connection_kwargs: Passed on to each SupervisedConnection (e.g. backoff timings)
+        """
+        self.hosts = [SupervisedConnection(host, port, **connection_kwargs) for host, port in hosts]
+        self._pin_values = {}
+        self._stopped = False
+        # LEDStrip compares these against the settings
+        self._host = ",".join("{}:{}".format(fleet_host.host, fleet_host.port) for fleet_host in self.hosts)
+        self._port = None
+
+    def __str__(self):
+        return "Fleet of {} Raspberry Pis: {}".format(len(self.hosts), self._host)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def connected(self):
+        """
+        The fleet accepts frames for as long as it's running. Each Pi reports its own health via report()
+        """
+        return not self._stopped
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self._pin_values[user_gpio] = dutycycle
+        for fleet_host in self.hosts:
+            fleet_host.submit(user_gpio, dutycycle)
+        return 0
+
+    def get_PWM_dutycycle(self, user_gpio):
+        return self._pin_values.get(user_gpio, 0)  # Never wait on the network to read back
+
+    def stop(self):
+        self._stopped = True
+        for fleet_host in self.hosts:
+            fleet_host.stop()
+
+    def report(self):
+        """
+        Per-Pi latency and error report
+        """
+        return [fleet_host.report() for fleet_host in self.hosts]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Frame trace
+
+        Remembers the last few minutes of frames the strip was sent: when each frame was due, when it was
+        actually written, the colour written and how long the write took. Useful for hunting down
+        stutter in fades and sequences after the fact.
+
+        The ring buffer is a set of arrays allocated once at startup, so recording a frame is a handful
+        of slot assignments with no allocation. Download it from http://your.pi:port/frames:
+
+            ?format=json (default)  Columns of numbers plus a jitter summary
+            ?format=binary          A header then one fixed-size record per frame, oldest first:
+                                        header: <4s magic "RLFT"> <uint16 version> <uint16 record size> <uint32 frame count>
+                                                <float64 seconds to add to a monotonic time to get a unix timestamp>
+                                        record: <float64 target> <float64 actual> <float32 r, g, b> <float32 write latency>
+                                    All little-endian, times in seconds on the monotonic clock.
+            &seconds=60             Only the last 60 seconds
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+from array import array
+import json
+import struct
+import time
+
+from twisted.web.resource import Resource
+
+
+monotonic = getattr(time, "monotonic", time.time)
+FRAMES_PER_SECOND = 50
+BINARY_MAGIC = b"RLFT"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHId")
+BINARY_RECORD = struct.Struct("<dd3ff")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class FrameTrace(object):
+    """
+    A fixed-size ring buffer of frame timings. Has the record() method LEDStrip.frame_recorder expects
+    """
+
+    def __init__(self, capacity):
+        """
+        @param capacity: <int> How many frames to remember. The oldest are overwritten once it's full
+        """
+        self.capacity = max(1, int(capacity))
+        self.targets = array("d", [0.0]) * self.capacity
+        self.actuals = array("d", [0.0]) * self.capacity
+        self.latencies = array("f", [0.0]) * self.capacity
+        self.rgbs = array("f", [0.0]) * (self.capacity * 3)
+        self.recorded = 0  # Total frames ever recorded
+        self._next = 0  # Slot the next frame goes in
+
+    @classmethod
+    def for_seconds(cls, seconds):
+        """
+        A trace long enough to hold seconds' worth of frames at full frame rate
+        """
+        return cls(seconds * FRAMES_PER_SECOND)
+
+    def __len__(self):
+        return min(self.recorded, self.capacity)
+
+    def record(self, target_time, actual_time, rgb, write_latency):
+        """
+        Records one frame. Only ever called from the thread writing frames, so needs no lock
+        """
+        slot = self._next
+        self.targets[slot] = target_time
+        self.actuals[slot] = actual_time
+        self.latencies[slot] = write_latency
+        rgb_slot = slot * 3
+        self.rgbs[rgb_slot], self.rgbs[rgb_slot + 1], self.rgbs[rgb_slot + 2] = rgb
+        slot += 1
+        self._next = 0 if slot == self.capacity else slot
+        self.recorded += 1
+
+    def slots(self, seconds=None):
+        """
+        @keyword seconds: <float> Only the frames due in the last this many seconds
+        @return: [<int> slot, ] oldest first
+        """
+        count = len(self)
+        first = (self._next - count) % self.capacity
+        slots = [(first + i) % self.capacity for i in range(count)]
+        if seconds is not None:
+            since = monotonic() - seconds
+            slots = [slot for slot in slots if self.targets[slot] >= since]
+        return slots
+
+    def summary(self, slots):
+        """
+        @return: {} jitter statistics for the given slots
+        """
+        jitters = sorted(self.actuals[slot] - self.targets[slot] for slot in slots)
+        latencies = sorted(self.latencies[slot] for slot in slots)
+        frame_seconds = 1.0 / FRAMES_PER_SECOND
+        gaps = sum(1 for previous, slot in zip(slots, slots[1:]) if self.targets[slot] - self.targets[previous] > frame_seconds * 1.5)
+
+        def _ms(value):
+            return None if value is None else round(value * 1000.0, 3)
+        return {
+            "frames": len(slots),
+            "gaps": gaps,  # Places where frames were skipped (or the colour held), so nothing was written for over a frame
+            "jitter_ms_median": _ms(percentile(jitters, 0.5)),
+            "jitter_ms_p99": _ms(percentile(jitters, 0.99)),
+            "jitter_ms_max": _ms(jitters[-1] if jitters else None),
+            "latency_ms_median": _ms(percentile(latencies, 0.5)),
+            "latency_ms_max": _ms(latencies[-1] if latencies else None),
+        }
+
+    def to_dict(self, seconds=None):
+        slots = self.slots(seconds)
+        return {
+            "capacity": self.capacity,
+            "recorded": self.recorded,
+            "clock_offset": time.time() - monotonic(),  # Add to a monotonic time to get a unix timestamp
+            "summary": self.summary(slots),
+            "target": [self.targets[slot] for slot in slots],
+            "actual": [self.actuals[slot] for slot in slots],
+            "latency": [self.latencies[slot] for slot in slots],
+            "rgb": [[round(channel, 2) for channel in self.rgbs[slot * 3:slot * 3 + 3]] for slot in slots],
+        }
+
+    def to_bytes(self, seconds=None):
+        slots = self.slots(seconds)
+        chunks = [BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_RECORD.size, len(slots), time.time() - monotonic())]
+        for slot in slots:
+            rgb_slot = slot * 3
+            chunks.append(BINARY_RECORD.pack(self.targets[slot], self.actuals[slot], self.rgbs[rgb_slot], self.rgbs[rgb_slot + 1],
+                                             self.rgbs[rgb_slot + 2], self.latencies[slot]))
+        return b"".join(chunks)
+
+
+class FrameTraceResource(Resource):
+    """
+    Serves a FrameTrace at /frames
+    """
+    isLeaf = True
+
+    def __init__(self, frame_trace):
+        Resource.__init__(self)
+        self.frame_trace = frame_trace
+
+    def render_GET(self, request):
+        seconds = request.get_param("seconds", force=float)
+        if self.frame_trace is None:
+            request.setResponseCode(404)
+            request.setHeader(b"Content-Type", b"application/json; charset=utf-8")
+            return json.dumps({"error": "Frame tracing is off. Set frame_trace_seconds in raspiled.conf."}).encode("utf-8")
+        if request.get_param("format") == "binary":
+            request.setHeader(b"Content-Type", b"application/octet-stream")
+            request.setHeader(b"Content-Disposition", b'attachment; filename="raspiled-frames.bin"')
+            return self.frame_trace.to_bytes(seconds)
+        request.setHeader(b"Content-Type", b"application/json; charset=utf-8")
+        return json.dumps(self.frame_trace.to_dict(seconds)).encode("utf-8")
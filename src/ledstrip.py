@@ -15,7 +15,14 @@ from __future__ import unicode_literals
 import colorsys
 import math
 
-from named_colours import NAMED_COLOURS
+from named_colours import named_rgb
+from colour_index import KELVIN_MATCH_DISTANCE, nearest_kelvin, nearest_named_colour
+from connection import SimulatedPiInterface, SupervisedPiInterface, port_is_open
+from dither import DITHER_BITS, TemporalDither
+from fleet import PiFleetInterface, parse_fleet_hosts
+from metrics import DURATION_BUCKETS, REGISTRY
+from timeline import SunTimeline, Timeline
+from transitions import clean_interpolation, transition_table
 
 import copy
 from src.config import logger
@@ -26,7 +33,11 @@ import subprocess
 import time
 from time import sleep
 import threading
-from six.moves.html_parser import HTMLParser
+try:
+    from html import unescape as html_unescape
+except ImportError:  # Python 2
+    from six.moves.html_parser import HTMLParser
+    html_unescape = HTMLParser().unescape
 
 
 ##### Constants #####
@@ -46,27 +57,58 @@ PIN_MODE = "BCM"  # Broadcom mode
 PWM_MAX = 255.0
 PWM_MIN = 0.0
 
+FRAME_SECONDS = 0.02  # 50Hz, human perception notices things slower than this
+COLOUR_CACHE_SIZE = 1024  # Max number of resolved colour strings to remember
+TIMELINE_CACHE_SIZE = 64  # Max number of compiled sequences to remember
 
-#####################
+monotonic = getattr(time, "monotonic", time.time)  # Immune to the wall clock being changed under us
 
+FRAMES_RENDERED = REGISTRY.counter("raspiled_frames_rendered_total", "Frames written by sequences")
+FRAMES_MISSED = REGISTRY.counter("raspiled_frame_deadlines_missed_total", "Frames skipped because the sequence fell behind their deadline")
+FRAME_JITTER_SECONDS = REGISTRY.histogram("raspiled_frame_jitter_seconds", "How late each frame was written, relative to its deadline")
+SEQUENCES_RUNNING = REGISTRY.gauge("raspiled_sequences_running", "Sequence threads currently running")
+SEQUENCE_SECONDS = REGISTRY.histogram("raspiled_sequence_seconds", "How long sequence threads ran for, by sequence", ("sequence",), buckets=DURATION_BUCKETS)
+CACHE_LOOKUPS = REGISTRY.counter("raspiled_cache_lookups_total", "Colour and timeline cache lookups, by cache and result (hit or miss)", ("cache", "result"))
+JSON_TYPES = six.string_types + six.integer_types + (float, list, tuple, type(None))  # Sequence kwargs we can snapshot
 
-def pigpiod_process():
-    cmd = 'pgrep pigpiod'
 
-    process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
+#####################
 
-    if output == '':
-        logger.info('*** [STARTING PIGPIOD] i.e. "sudo pigpiod" ***')
-        cmd = 'sudo pigpiod'
-        process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
-        _output, _error = process.communicate()
-    else:
-        logger.info('PIGPIOD is running! PID: %s', six.ensure_text(output, "utf-8").split('\n')[0])
 
+def calibration_from_settings(settings):
+    """
+    @param settings: {} e.g. the config
+    @return: {<unicode> channel letter: <float> multiplier} from calibrate_r, calibrate_g and calibrate_b, or AUTO_CALIBRATE's
+    """
+    return dict((channel, float(settings.get("calibrate_" + channel, AUTO_CALIBRATE[channel]))) for channel in "rgb")
 
-# Initialise our
-pigpiod_process()
+
+def pigpiod_process(host="localhost", port=8888, wait_seconds=3.0):
+    """
+    Makes sure the pigpio daemon is up. Probes its port first, and only runs "sudo pigpiod" if it isn't
+    listening on this machine. Called by the listener at startup, never on import.
+
+    @return: <Bool> Whether the daemon is accepting connections
+    """
+    if port_is_open(host, port):
+        logger.info("PIGPIOD is running on %s:%s", host, port)
+        return True
+    if host not in ("localhost", "127.0.0.1", "::1"):
+        logger.warning("PIGPIOD is not answering on %s:%s. Will keep trying in the background.", host, port)
+        return False
+    logger.info('*** [STARTING PIGPIOD] i.e. "sudo pigpiod -p %s" ***', port)
+    try:
+        subprocess.Popen(["sudo", "pigpiod", "-p", six.text_type(port)], stdout=subprocess.PIPE).communicate()
+    except OSError as e:
+        logger.error("Could not start pigpiod (%s: %s)", e.__class__.__name__, e)
+        return False
+    deadline = monotonic() + wait_seconds
+    while monotonic() < deadline:
+        if port_is_open(host, port):
+            return True
+        sleep(0.05)
+    logger.warning("PIGPIOD did not come up on %s:%s. Will keep trying in the background.", host, port)
+    return False
 
 
 @six.python_2_unicode_compatible
@@ -107,7 +149,14 @@ class LEDStrip(object):
     iface = None
     _sequence = None  # The current sequence we are running
     _sequence_stop_signal = False  # Whether to stop a sequence or not
+    frame_recorder = None  # Anything with a record(target_time, actual_time, rgb, write_latency) method, to trace the frames we render
+    state_snapshot = None  # <state.StateSnapshot> to tell whenever our state changes
+    _sequence_state = None  # What the current sequence is, its kwargs and when it started, for the snapshot
+    RESUMABLE_SEQUENCES = ("colour_loop", "sunrise_sunset")  # Sequences which can pick up at any point in time
     sequence_colours = ""  # For reporting back to JS
+    fade_interpolation = "linear"  # How fades and rotates blend colours: "linear" (RGB) or "oklab" (perceptual)
+    dither = None  # <dither.TemporalDither> for the frames of fades and sequences, if dithering is switched on
+    shared_clock = None  # <timesync.SharedClock> the timebase synchronised sequences (start_at=...) run on. None = our own wall clock
 
     def __init__(self, params, calibrate=None, interface=None):
         """
@@ -122,11 +171,14 @@ class LEDStrip(object):
         blue_pin = params.get("blue_pin", 22)
         pi_host = params.get("pi_host", "localhost")
         pig_port = params.get("pig_port", 8888)
+        fleet_hosts = parse_fleet_hosts(params.get("fleet_hosts"), default_port=pig_port)
 
         # Resolve interface - create if not provided!
         need_to_generate_new_interface = False  # Flag to see what we're doing
         if interface is None:
             need_to_generate_new_interface = True
+        elif fleet_hosts:  # Fleet mode: only a fleet interface will do
+            need_to_generate_new_interface = not isinstance(interface, PiFleetInterface)
         else:  # Check the interface is connected!
             try:
                 iface_host = interface._host
@@ -160,12 +212,20 @@ class LEDStrip(object):
             self.iface = interface
 
         # Set vars
+        self._configured_calibrate = calibration_from_settings(params)  # What the config asks for, to tell whether a saved calibration is stale
         if calibrate is None:
-            calibrate = copy.copy(AUTO_CALIBRATE)  # Don't pollute global mutable!
+            calibrate = dict(self._configured_calibrate)  # A fresh dict, so we don't pollute the global mutable!
         self._calibrate = calibrate  # Whether to adjust for differing RGB light intensities (green is brighter)
         self._red_pin = self.pin_lim(red_pin)
         self._green_pin = self.pin_lim(green_pin)
         self._blue_pin = self.pin_lim(blue_pin)
+        self._output_lock = threading.RLock()  # Held while a frame is written, so settings can be swapped between frames
+        try:
+            self.fade_interpolation = clean_interpolation(params.get("fade_interpolation"))
+        except ValueError as e:
+            logger.warning("%s. Fading linearly.", e)
+        if params.get("dither"):
+            self.dither = TemporalDither(params.get("dither_bits", DITHER_BITS))
 
         # Initialise strip... it may already be alive!
         self.sync_channels()  # Sets internal channels to match the values of the actual pins
@@ -194,10 +254,10 @@ class LEDStrip(object):
         # Test values
         try:
             if value < lower:
-                logger.warning(" LEDStrip.lim(): Value %s is less than lower limit %s. Setting to %s." % (value, lower, less_than_lower_default))
+                logger.warning(" LEDStrip.lim(): Value %s is less than lower limit %s. Setting to %s.", value, lower, less_than_lower_default)
                 return float(less_than_lower_default)
             if value > upper:
-                logger.warning(" LEDStrip.lim(): Value %s is greater than upper limit %s. Setting to %s" % (value, upper, greater_than_upper_default))
+                logger.warning(" LEDStrip.lim(): Value %s is greater than upper limit %s. Setting to %s", value, upper, greater_than_upper_default)
                 return float(greater_than_upper_default)
         except (ValueError, TypeError, AttributeError):
             return float(less_than_lower_default)
@@ -227,6 +287,13 @@ class LEDStrip(object):
         r, g, b = tuple(int(hex_value[i:i + 2], 16) for i in (0, 2, 4))
         return (r, g, b)
 
+    @classmethod
+    def named_colour_to_rgb(cls, name):
+        """
+        Looks up a named colour (e.g. 'pink' or '2700k'). Returns an (r, g, b) tuple, or None if the name isn't known
+        """
+        return named_rgb(six.text_type(name))
+
     @classmethod
     def rgb_to_hex(cls, r, g, b):
         """
@@ -393,6 +460,53 @@ class LEDStrip(object):
 
         return None  # Otherwise canny do i' captain
 
+    _colour_cache = {}  # colour string : (r, g, b), for colours that don't depend on the current colour
+
+    @classmethod
+    def colour_depends_on_current(cls, col_str):
+        """
+        Whether a colour string is relative to the current colour (e.g. 'hs(120,50)' or 'v50'), so can't be cached
+        """
+        if cls.RE_COLOUR_HEX_6.search(col_str) or cls.RE_COLOUR_HEX_3.search(col_str) or cls.RE_COLOUR_HSV.search(col_str):
+            return False
+        return bool(cls.RE_COLOUR_HS.search(col_str) or cls.RE_COLOUR_BRIGHTNESS.search(col_str))
+
+    @classmethod
+    def resolve_colour(cls, colour, current_rgb=None):
+        """
+        Resolves a named / hex / rgb / hsv / kelvin colour string into an (r, g, b) tuple, remembering the answer
+
+        @param colour: <str> The colour expression, or an (r, g, b) iterable which is passed straight through
+        @keyword current_rgb: <tuple> The current colour, for expressions relative to it
+        @return: <tuple> (r, g, b) or None if the colour can't be identified
+        """
+        if not isinstance(colour, (six.text_type, six.binary_type)):
+            try:
+                r, g, b = colour
+                return r, g, b
+            except (TypeError, ValueError):
+                return None
+        key = six.ensure_text(colour).strip().lower()
+        try:
+            rgb = cls._colour_cache[key]
+        except KeyError:
+            CACHE_LOOKUPS.inc(labels=("colour", "miss"))
+        else:
+            CACHE_LOOKUPS.inc(labels=("colour", "hit"))
+            return rgb
+        rgb = cls.named_colour_to_rgb(key)
+        if rgb is None:
+            try:
+                rgb = cls.colour_to_rgb_tuple(key, current_rgb)
+            except (TypeError, IndexError, ValueError):
+                rgb = None
+            if rgb is None or cls.colour_depends_on_current(key):
+                return rgb
+        if len(cls._colour_cache) >= COLOUR_CACHE_SIZE:
+            cls._colour_cache.clear()
+        cls._colour_cache[key] = rgb
+        return rgb
+
     @classmethod
     def contrast_from_bg(cls, col="#000000", dark_default="000000", light_default="FFFFFF", hashed="#"):
         """
@@ -442,10 +556,9 @@ class LEDStrip(object):
         colours.extend(args)
         intermediate_list = []
         # Add in comma delimited stuff
-        h = HTMLParser()
         for colour_term in colours:
             if isinstance(colour_term, (six.text_type, six.binary_type)):
-                colour_term_decoded = h.unescape(colour_term)  # HTML char decode
+                colour_term_decoded = html_unescape(colour_term)  # HTML char decode
                 colour_terms_list = colour_term_decoded.split(",")
                 intermediate_list.extend(colour_terms_list)
             else:
@@ -589,18 +702,66 @@ class LEDStrip(object):
             return "{}K".format(self._kelvin)
         return ""
 
+    @property
+    def colour_name(self):
+        """
+        The name of the named colour closest to what we're showing, e.g. 'salmon'
+        """
+        return nearest_named_colour(self.rgb)[0]
+
+    @property
+    def kelvin_estimate(self):
+        """
+        The colour temperature we were set to, or failing that the one our colour is indistinguishable from (e.g. set by
+        RGB to what 2700K looks like). None if we aren't showing a colour temperature
+        :return: int
+        """
+        if self._kelvin is not None:
+            return self._kelvin
+        kelvin, distance = nearest_kelvin(self.rgb)
+        if distance is not None and distance <= KELVIN_MATCH_DISTANCE:
+            return kelvin
+        return None
+
     def generate_new_interface(self, params):
         """
-        Builds a new interface, stores it in self.iface
+        Builds a new supervised interface (reconnects by itself if pigpiod goes away), stores it in self.iface
+        If params lists fleet_hosts, builds a fleet interface that drives all of those Pis at once
+        If params has simulate set, the pins only exist in memory
         """
         # Kill existing iface
         try:
             self.iface.stop()
         except (AttributeError, IOError):
             pass
-        self.iface = PiPinInterface(params)
+        fleet_hosts = parse_fleet_hosts(params.get("fleet_hosts"), default_port=params.get("pig_port", 8888))
+        if params.get("simulate"):
+            logger.info("Simulated mode: no pins will be driven")
+            self.iface = SimulatedPiInterface(params)
+        elif fleet_hosts:
+            logger.info("Fleet controller mode: driving %s Raspberry Pis", len(fleet_hosts))
+            self.iface = PiFleetInterface(fleet_hosts)
+        else:
+            self.iface = SupervisedPiInterface(params)
         return self.iface
 
+    def connection_report(self):
+        """
+        Per-host connection health, latency and errors. Empty list if our interface can't report
+        """
+        try:
+            return self.iface.report()
+        except AttributeError:
+            return []
+
+    def fleet_report(self):
+        """
+        Per-host latency and error report when driving a fleet of Pis. Empty list otherwise
+        """
+        if isinstance(self.iface, PiFleetInterface):
+            return self.connection_report()
+        return []
+
     def set_led(self, pin, value=0):
         """
         Sets the LED pin to the specified value
@@ -613,9 +774,9 @@ class LEDStrip(object):
             try:
                 self.iface.set_PWM_dutycycle(pin, value)
             except (AttributeError, IOError):
-                logger.error(" Cannot output to pins. PWM of pin #%s would be %s" % (pin, value))
+                logger.error(" Cannot output to pins. PWM of pin #%s would be %s", pin, value)
         else:
-            logger.error(" Interface not connected. Cannot output to pins. PWM of pin #%s would be %s" % (pin, value))
+            logger.error(" Interface not connected. Cannot output to pins. PWM of pin #%s would be %s", pin, value)
         return value
 
     def read_led(self, pin):
@@ -629,9 +790,9 @@ class LEDStrip(object):
             try:
                 value = self.iface.get_PWM_dutycycle(pin)
             except (AttributeError, IOError, pigpio.error):
-                logger.error(" Cannot read PWM of pin #%s" % (pin,))
+                logger.error(" Cannot read PWM of pin #%s", pin)
         else:
-            logger.error(" Interface not connected. Cannot read PWM of pin #%s." % (pin,))
+            logger.error(" Interface not connected. Cannot read PWM of pin #%s.", pin)
         return value
 
     def read_rgb(self, decalibrate=False):
@@ -675,22 +836,35 @@ class LEDStrip(object):
         self.b = self.set_led(self._blue_pin, value)
         return self.blue
 
-    def set_rgb(self, r=0, g=0, b=0, calibrate=True):
+    def set_rgb(self, r=0, g=0, b=0, calibrate=True, dither=False):
         """
         Sets the LED array to rgb
+        @keyword dither: <Bool> Whether this is one of a stream of frames, which self.dither may dither
         @return: (r,g,b)
         """
-        r = self.set_red(r)
-        g = self.set_green(g)
-        b = self.set_blue(b)
+        with self._output_lock:
+            if dither and self.dither is not None:  # Dither the calibrated duty cycles, i.e. what actually goes to the pins
+                if self._calibrate:
+                    r, g, b = r * self._calibrate.get("r", 1.0), g * self._calibrate.get("g", 1.0), b * self._calibrate.get("b", 1.0)
+                r, g, b = self.dither.dither(r, g, b)
+                r = self.set_red(r, calibrate=False)
+                g = self.set_green(g, calibrate=False)
+                b = self.set_blue(b, calibrate=False)
+            else:
+                r = self.set_red(r)
+                g = self.set_green(g)
+                b = self.set_blue(b)
+        if self._sequence_state is None:  # A running sequence is snapshotted by its parameters instead
+            self._state_changed()
         return (r, g, b)
 
-    def fade_to_rgb(self, r=0, g=0, b=0, fade=300, check=True):
+    def fade_to_rgb(self, r=0, g=0, b=0, fade=300, check=True, interpolation=None):
         """
         Fades to the rgb values over the specified time period (in milliseconds)
         Human perception notices things slower than 50Hz (20ms)
         
         @keyword fade: <float> if provided, will make the colour transition smooth over the specified period of time
+        @keyword interpolation: <unicode> "linear" or "oklab". Defaults to self.fade_interpolation
         """
         # When we're doing a fade, the pin values may have changed... check first!!
         if check:
@@ -704,16 +878,27 @@ class LEDStrip(object):
         gap_g = g - init_g
         gap_b = b - init_b
         n_steps = int(float(fade) / 20.0)  # 50Hz = 20 milliseconds
+        started = monotonic()
+        frames = None
+        if n_steps and (interpolation or self.fade_interpolation) != "linear":  # Read the frames out of a cached table
+            frames = transition_table((init_r, init_g, init_b), (r, g, b), n_steps, interpolation or self.fade_interpolation)
 
         for step in range(0, n_steps):
-            fractional_progress = float(step) / n_steps
-            cur_r = init_r + (gap_r * fractional_progress)
-            cur_g = init_g + (gap_g * fractional_progress)
-            cur_b = init_b + (gap_b * fractional_progress)
-            cur_col = self.set_rgb(cur_r, cur_g, cur_b)
-            sleep(0.02)  # 20ms
-            if self._sequence and self._sequence_stop_signal:  # Instantly escape the fade if changing routine
-                break
+            if frames is not None:
+                cur_r, cur_g, cur_b = frames[step]
+            else:
+                fractional_progress = float(step) / n_steps
+                cur_r = init_r + (gap_r * fractional_progress)
+                cur_g = init_g + (gap_g * fractional_progress)
+                cur_b = init_b + (gap_b * fractional_progress)
+            self._render_frame((cur_r, cur_g, cur_b), started + step * FRAME_SECONDS)
+            # Sleep until the next frame is due, not a fixed 20ms, so the time spent writing never accumulates
+            next_frame_time = started + (step + 1) * FRAME_SECONDS
+            if self._sequence:
+                if not self.sleep_until(next_frame_time):  # Instantly escape the fade if changing routine
+                    break
+            else:  # The stop signal is left set after a sequence stops, so it means nothing here
+                sleep(max(next_frame_time - monotonic(), 0.0))
 
                 # And fix it to the target in case float calcs put us off a bit
         return self.set_rgb(r, g, b)
@@ -761,12 +946,11 @@ class LEDStrip(object):
                 self._kelvin = round(float(kelvin_matches.group(1)))
 
         if name:
-            try:
-                hex_value = NAMED_COLOURS[six.text_type(name).lower()]
-            except KeyError:
-                pass
-            else:
-                return self.set_hex(hex_value, fade=fade, check=check)
+            named = named_rgb(six.text_type(name))
+            if named is not None:
+                if fade:
+                    return self.rgb_to_hex(*self.fade_to_rgb(*named, fade=fade, check=check))
+                return self.rgb_to_hex(*self.set_rgb(*named))
 
         if name or hex_value:
             # Try our regex based resolver:
@@ -828,6 +1012,7 @@ class LEDStrip(object):
             calibrate = copy.copy(AUTO_CALIBRATE)
         self._calibrate = calibrate
         logger.info("Calibration updated! %s" % self._calibrate)
+        self._state_changed()
 
     set_calibration = set_calibrate
     calibrate = set_calibrate
@@ -838,11 +1023,104 @@ class LEDStrip(object):
         """
         self._calibrate = copy.copy(NO_CALIBRATION)
         logger.info("Calibration off! %s" % self._calibrate)
+        self._state_changed()
 
     set_calibrate_off = calibrate_off
     set_calibration_off = calibrate_off
     calibration_off = calibrate_off
 
+    def apply_settings(self, settings, changed=None):
+        """
+        Applies changed settings (e.g. from editing the config file) to the running strip, without restarting it.
+
+        Everything is swapped in one go between two frames, then the colour we were showing is written out again
+        through the new pins and calibration, and any pin we've stopped using is switched off. A running sequence
+        carries on from its next frame, so the lights never go dark.
+
+        @param settings: {<unicode> name: value} The settings, e.g. the reloaded config. Pins, calibrate_r|g|b, dither,
+                         dither_bits and fade_interpolation are applied, anything else is ignored
+        @keyword changed: [<unicode> name, ] Which settings have changed, so only those are applied. None = all of them
+        @raise ValueError: If fade_interpolation isn't one we know, before anything has changed
+        """
+        changed = set(settings if changed is None else changed)
+        fade_interpolation = self.fade_interpolation
+        if "fade_interpolation" in changed:
+            fade_interpolation = clean_interpolation(settings.get("fade_interpolation"))
+        pins = (self._red_pin, self._green_pin, self._blue_pin)
+        if changed.intersection(("red_pin", "green_pin", "blue_pin")):
+            pins = tuple(self.pin_lim(settings.get(name, pin)) for name, pin in zip(("red_pin", "green_pin", "blue_pin"), pins))
+        calibrate = dict(NO_CALIBRATION, **(self._calibrate or {}))
+        configured_calibrate = dict(self._configured_calibrate)
+        configured_calibrate.update((channel, float(settings["calibrate_" + channel])) for channel in "rgb" if "calibrate_" + channel in changed)
+        calibrate.update((channel, configured_calibrate[channel]) for channel in "rgb" if "calibrate_" + channel in changed)
+        dither = self.dither
+        if changed.intersection(("dither", "dither_bits")):
+            dither = TemporalDither(settings.get("dither_bits", DITHER_BITS)) if settings.get("dither") else None
+        with self._output_lock:
+            old_pins = (self._red_pin, self._green_pin, self._blue_pin)
+            rgb = self.decalibrate_rgb(self.r, self.g, self.b) if self._calibrate else (self.r, self.g, self.b)
+            changed_output = pins != old_pins or calibrate != self._calibrate
+            self._red_pin, self._green_pin, self._blue_pin = pins
+            self._calibrate = calibrate
+            self._configured_calibrate = configured_calibrate
+            self.dither = dither
+            self.fade_interpolation = fade_interpolation
+            if changed_output:
+                self.set_rgb(*rgb)  # The new pins first, then the old ones off, so the strip is never dark
+                for pin in set(old_pins) - set(pins):
+                    self.set_led(pin, 0)
+        if changed_output:
+            logger.info("LEDstrip: now on pins %s, calibrated %s", pins, calibrate)
+
+    ### Snapshots ###
+
+    def _state_changed(self):
+        if self.state_snapshot is not None:
+            self.state_snapshot.changed()
+
+    def snapshot_state(self):
+        """
+        Returns a JSON serialisable dict of everything needed to pick up where we are now
+        """
+        return {
+            "pins": [self.r, self.g, self.b],  # Raw, so calibration isn't applied twice on restore
+            "kelvin": self._kelvin,
+            "calibrate": dict(self._calibrate or {}),
+            "configured_calibrate": dict(self._configured_calibrate),  # So a restore can tell if the config has changed since
+            "sequence": self._sequence_state,
+        }
+
+    def restore_state(self, state):
+        """
+        Puts the strip back the way snapshot_state() found it. A rotate, jump, sunrise or sunset resumes at the
+        point it would have reached had we never stopped.
+
+        The saved calibration (which may have been changed at runtime) is only restored if the config's calibrate_*
+        values are the same as when it was saved. If they've been edited since, the config wins.
+
+        @param state: {} from snapshot_state()
+        @return: <unicode> The name of a saved sequence we can't resume by ourselves (e.g. circadian), or None
+        """
+        saved_configured_calibrate = state.get("configured_calibrate", AUTO_CALIBRATE)  # Older snapshots were made before the config's calibration was used
+        if state.get("calibrate") and dict(saved_configured_calibrate) == self._configured_calibrate:
+            self._calibrate = dict(state["calibrate"])
+        elif state.get("calibrate"):
+            logger.info("Calibration changed in the config since the state was saved, using %s", self._configured_calibrate)
+        sequence = state.get("sequence")
+        if sequence and sequence.get("name") in self.RESUMABLE_SEQUENCES:
+            sequence_kwargs = dict(sequence.get("kwargs") or {})
+            sequence_kwargs["elapsed"] = max(time.time() - sequence.get("started", time.time()), 0.0)
+            logger.info("Resuming %s %.1fs in", sequence["name"], sequence_kwargs["elapsed"])
+            self.run_sequence(getattr(self, "_{}".format(sequence["name"])), **sequence_kwargs)
+            return None
+        pins = state.get("pins")
+        if pins:
+            self.set_red(pins[0], calibrate=False)
+            self.set_green(pins[1], calibrate=False)
+            self.set_blue(pins[2], calibrate=False)
+        self._kelvin = state.get("kelvin")
+        return sequence.get("name") if sequence else None
+
     ### Sequences ###
     """
     Sequences run inside a separate thread so that they do not block the web client
@@ -861,6 +1139,18 @@ class LEDStrip(object):
                 break
             sleep(0.01)
 
+    def sleep_until(self, deadline):
+        """
+        Sleeps until the monotonic() deadline, checking the exit flag every 10ms
+        :return: <Bool> False if we were told to stop
+        """
+        while not self._sequence_stop_signal:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return True
+            sleep(min(remaining, 0.01))
+        return False
+
     def run_sequence(self, func, *args, **kwargs):
         """
         Initiates a sequence in a separate non-blocking thread.
@@ -872,11 +1162,33 @@ class LEDStrip(object):
         self.stop_current_sequence()
         sequence_colours = kwargs.get("colours", [])
         self.sequence_colours = ",".join(sequence_colours)
-        self._sequence = threading.Thread(target=func, args=args, kwargs=kwargs)
+        self._sequence_state = {
+            "name": func.__name__.strip("_"),
+            "kwargs": dict((key, value) for key, value in kwargs.items() if key != "elapsed" and isinstance(value, JSON_TYPES)),
+            "started": time.time() - kwargs.get("elapsed", 0.0),  # Wall clock, so it means something after a restart
+        }
+        self._state_changed()
+        self._sequence = threading.Thread(target=self._run_sequence_thread, args=(func,) + args, kwargs=kwargs,
+                                          name="raspiled-sequence-{}".format(self._sequence_state["name"]))
         self._sequence_stop_signal = False
         self._sequence.start()
         return self.rgb
 
+    def _run_sequence_thread(self, func, *args, **kwargs):
+        """
+        Runs the sequence, then drops it from the snapshot if it finished by itself
+        """
+        started = monotonic()
+        SEQUENCES_RUNNING.inc()
+        try:
+            func(*args, **kwargs)
+        finally:
+            SEQUENCES_RUNNING.dec()
+            SEQUENCE_SECONDS.observe(monotonic() - started, (func.__name__.strip("_"),))
+        if not self._sequence_stop_signal:
+            self._sequence_state = None
+            self._state_changed()
+
     def stop_current_sequence(self, timeout=60):
         """
         Stops the current sequence by issuing a stop flag to the sequence thread then joining it
@@ -886,6 +1198,9 @@ class LEDStrip(object):
         """
         self._sequence_stop_signal = True
         self.sequence_colours = ""
+        if self._sequence_state is not None:
+            self._sequence_state = None
+            self._state_changed()
         try:
             self._sequence._sequence_stop_signal = True  # In case the sequence is pointing to a different signal
             self._sequence.join(timeout)  # We'll wait timeout seconds for the thread to stop
@@ -899,145 +1214,236 @@ class LEDStrip(object):
         Nukes any remaining threads. Called when the parent reactor loop stops
         """
         logger.info("\tLEDstrip: exiting sequence threads...")
+        if self.state_snapshot is not None:  # Save what we were doing, not the fade to black, so we can resume it
+            self.state_snapshot.flush()
+            self.state_snapshot = None
         self.off()  # Stops all sequences and fades to black
         logger.info("\t\t...done")
 
-    def _colour_loop(self, colours, seconds=None, milliseconds=None, fade=True):
+    _timeline_cache = {}  # Compiled timelines, keyed by the sequence and its parameters
+
+    @classmethod
+    def _cached_timeline(cls, key, compile_func):
         """
-        Loops around the specified colours, changing colour every n seconds or m milliseconds
-        
+        Returns the compiled timeline for key, compiling it via compile_func() the first time it's asked for
+        """
+        try:
+            timeline = cls._timeline_cache[key]
+        except KeyError:
+            CACHE_LOOKUPS.inc(labels=("timeline", "miss"))
+        else:
+            CACHE_LOOKUPS.inc(labels=("timeline", "hit"))
+            return timeline
+        timeline = compile_func()
+        if len(cls._timeline_cache) >= TIMELINE_CACHE_SIZE:
+            cls._timeline_cache.clear()
+        cls._timeline_cache[key] = timeline
+        return timeline
+
+    def colour_loop_timeline(self, colours, seconds=None, milliseconds=None, fade=True):
+        """
+        Compiles a rotate (fade=True) or jump (fade=False) around the colours into a looping timeline
+
         @param colours: [] A list of named / hex / RGB colours to loop around
-        @keyword fade: <boolean> Whether to jump (False) or fade (True)
+        @return: <Timeline> or None if none of the colours could be identified
         """
         colours = self.convert_to_colour_list(colours)  # Forces a list of colours into an actual python list
         if len(colours) < 2:
             colours.append("#000000")  # Blink between black and the specified colour if only one provided
-
-        # Start with the first colour immediately:
-        if fade:
-            self.fade(colours[0])
-        else:
-            self.set(colours[0])
         step_time = self.clean_time_in_milliseconds(seconds, milliseconds, default_seconds=1, minimum_milliseconds=50)
 
-        # Do the loop
-        i = 1  # We're moving to the second colour now
-        total_colours = len(colours)
+        def compile_loop():
+            colours_rgb = []
+            for colour in colours:
+                rgb = self.resolve_colour(colour, self.rgb)
+                if rgb is None:
+                    logger.info("WARNING: no colour identified by '%s'. Skipping it.", colour)
+                    continue
+                colours_rgb.append(rgb)
+            if not colours_rgb:
+                return None
+            return Timeline.colour_loop(colours_rgb, step_time / 1000.0, fade=fade, name="rotate" if fade else "jump", interpolation=self.fade_interpolation)
+
+        colour_keys = tuple(six.text_type(colour).strip().lower() for colour in colours)
+        if any(self.colour_depends_on_current(colour) for colour in colour_keys):
+            return compile_loop()  # Relative colours differ every time, so don't cache
+        return self._cached_timeline(("loop", colour_keys, step_time, bool(fade), self.fade_interpolation), compile_loop)
+
+    def _render_frame(self, rgb, target_time):
+        """
+        Writes one frame of a sequence, and hands its timing to the frame recorder if there is one
+        """
+        actual_time = monotonic()
+        self.set_rgb(*rgb, dither=True)
+        FRAMES_RENDERED.inc()
+        FRAME_JITTER_SECONDS.observe(max(actual_time - target_time, 0.0))
+        if self.frame_recorder is not None:
+            self.frame_recorder.record(target_time, actual_time, rgb, monotonic() - actual_time)
+
+    def shared_time_offset(self):
+        """
+        @return: <float> seconds to add to a monotonic() time to get the shared time (epoch seconds) synchronised sequences run on
+        """
+        if self.shared_clock is not None:
+            return self.shared_clock.monotonic_offset()
+        return time.time() - monotonic()
+
+    def _play_timeline(self, timeline, lead_in=300, elapsed=0.0, start_at=None):
+        """
+        Renders a compiled timeline until it finishes or the sequence is stopped.
+
+        Frames are anchored to the moment we started: frame k is due at started + k * FRAME_SECONDS, and
+        shows the colour the timeline specifies for that moment. Time spent writing pins or being starved
+        of CPU never accumulates. If we fall behind we skip straight to the next frame that's due, and a
+        one-shot timeline lands on its final colour exactly duration seconds after it started.
+
+        With start_at, the timeline starts when the shared clock reads start_at, and every frame is worked out
+        from the shared time, so listeners given the same start_at show the same colour at the same moment.
+
+        @param timeline: <Timeline>
+        @keyword lead_in: <float> milliseconds over which to blend from the current colour into the timeline
+        @keyword elapsed: <float> seconds into the timeline to start from (e.g. resuming after a restart). Skips the lead in.
+        @keyword start_at: <float> shared time (epoch seconds) the timeline starts at, in the future or the past. Overrides elapsed
+        @return: <Bool> True if the timeline played to the end (or is looping and was stopped), False if it was stopped early
+        """
+        if start_at is not None:
+            started = start_at - self.shared_time_offset()
+            if not self.sleep_until(started):  # Hold what we're showing until the agreed moment
+                return timeline.loop
+            elapsed = max(monotonic() - started, 0.0)
+        lead_in_seconds = 0.0 if elapsed else (lead_in or 0) / 1000.0
+        start_rgb = self.rgb
+        started = monotonic() - elapsed
+        end_time = started + timeline.duration
+        last_rgb = None
+        frame = int(elapsed / FRAME_SECONDS)
+        skipped = 0
         while not self._sequence_stop_signal:
-            # Resolve our colour
-            next_colour = colours[i]
-            i = (i + 1) % total_colours  # ensures we are never asking for more colours than provided
-            if fade:  # Fading is a blocking process, thus we let the fade loop use up the time
-                _latest_colour = self.fade(next_colour, fade_time=step_time, check=False)
-            else:  # Set is instant, so we need to consume the step time
-                _latest_colour = self.set(next_colour, fade=False, check=False)
-                self.sleep(step_time / 1000)  # NB fade uses milliseconds!!
-        # Return the latest colour
+            if start_at is not None:  # Follow the shared clock as its offset is refined
+                started = start_at - self.shared_time_offset()
+                end_time = started + timeline.duration
+            target_time = started + frame * FRAME_SECONDS
+            if not timeline.loop and target_time >= end_time:
+                break
+            elapsed = target_time - started
+            rgb = timeline.colour_at(elapsed)
+            if elapsed < lead_in_seconds:  # Blend in from whatever we were showing before
+                blend = elapsed / lead_in_seconds
+                rgb = tuple(start + (target - start) * blend for start, target in zip(start_rgb, rgb))
+            if rgb != last_rgb or (self.dither is not None and not self.dither.settled):  # Holding a colour (e.g. jump) needs no pin writes, once dithering settles
+                self._render_frame(rgb, target_time)
+                last_rgb = rgb
+            # Work out which frame is due next, skipping any we're already too late for
+            next_frame = frame + 1
+            late_frame = int((monotonic() - started) / FRAME_SECONDS)
+            if late_frame > next_frame:
+                skipped += late_frame - next_frame
+                FRAMES_MISSED.inc(late_frame - next_frame)
+                next_frame = late_frame
+            frame = next_frame
+            next_time = started + frame * FRAME_SECONDS
+            if not timeline.loop:
+                next_time = min(next_time, end_time)
+            self.sleep_until(next_time)
+        if self._sequence_stop_signal and not timeline.loop:
+            return False
+        if not timeline.loop:
+            self._render_frame(timeline.colour_at(timeline.duration), end_time)  # Land exactly on the final colour
+            logger.info("Timeline '%s' finished %.3fs after it started, target=%.3fs (%s frames skipped)",
+                        timeline.name, monotonic() - started, timeline.duration, skipped)
+        return True
+
+    def _colour_loop(self, colours, seconds=None, milliseconds=None, fade=True, elapsed=0.0, start_at=None):
+        """
+        Loops around the specified colours, changing colour every n seconds or m milliseconds
+        
+        @param colours: [] A list of named / hex / RGB colours to loop around
+        @keyword fade: <boolean> Whether to jump (False) or fade (True)
+        @keyword elapsed: <float> seconds into the loop to start from
+        @keyword start_at: <float> shared time (epoch seconds) to start the loop at, to keep in step with other listeners
+        """
+        timeline = self.colour_loop_timeline(colours, seconds=seconds, milliseconds=milliseconds, fade=fade)
+        if timeline is not None:
+            self._play_timeline(timeline, lead_in=300 if fade else 0, elapsed=elapsed, start_at=start_at)  # Fade into the first colour, or jump straight to it
         return self.sync_channels()
 
-    def jump(self, colours, seconds=None, milliseconds=None):
+    def jump(self, colours, seconds=None, milliseconds=None, start_at=None):
         """
         Jumps between the specified colours every time interval
         """
-        return self.run_sequence(self._colour_loop, colours=colours, seconds=seconds, milliseconds=milliseconds, fade=False)
+        return self.run_sequence(self._colour_loop, colours=colours, seconds=seconds, milliseconds=milliseconds, fade=False, start_at=start_at)
 
     blink = jump  # Alias
 
-    def rotate(self, colours, seconds=None, milliseconds=None):
+    def rotate(self, colours, seconds=None, milliseconds=None, start_at=None):
         """
         Rotates (fades) between the specified colours every time interval
         """
-        return self.run_sequence(self._colour_loop, colours=colours, seconds=seconds, milliseconds=milliseconds, fade=True)
+        return self.run_sequence(self._colour_loop, colours=colours, seconds=seconds, milliseconds=milliseconds, fade=True, start_at=start_at)
 
     rot = rotate  # Alias
     huerot = rotate  # Alias
 
-    def _sunrise_sunset(self, seconds=None, milliseconds=None, temp_start=None, temp_end=None, setting=True):
+    @classmethod
+    def clean_colour_temperature(cls, temperature, default):
         """
-        Silly routine to emulate a sunset
-        
-        If:  step_time = 100 + f(z)/(65-x)
-        
-        Then the area under the curve needs to be our target time
-        
-            target_time = 100x - z*log(x-65)
-        
-        We have 60 steps, so we can apply limits on x (0 to 60). We end up with:
-        
-            z = (target_time - 6000) / log(65)-log(5) = (target_time - 6000) / 2.564949357
+        Turns '5000K', '5000k' or 5000 into an integer number of Kelvin, or returns default if it isn't one
+        """
+        if temperature is None or temperature == "":
+            return default
+        try:
+            return int(round(float(six.text_type(temperature).strip().rstrip("Kk"))))
+        except (TypeError, ValueError):
+            logger.warning("Sunrise/sunset: '%s' is not a valid colour temperature, using %sK", temperature, default)
+            return default
+
+    @classmethod
+    def sun_timeline(cls, seconds=None, milliseconds=None, temp_start=None, temp_end=None, setting=True):
+        """
+        Compiles a sunset (setting=True) or sunrise into a SunTimeline through the colour temperatures in 100K steps.
+        The colour at any moment is a pure function of the time since it started (see SunTimeline).
 
         @keyword seconds: <float> Number of seconds to do the sequence over
         @keyword milliseconds: <float> Number of milliseconds to do the sequence over, gets added to seconds if both provided
         @keyword temp_start: <unicode> A colour temperature (in Kelvin) to start the sequence from
         @keyword temp_end: <unicode> A colour temperature (in Kelvin) to end the sequence at
         """
+        # Work out what the defaults should be. You can override these if either temp_start or temp_end is set
+        if setting:
+            temp_0 = cls.clean_colour_temperature(temp_start, 6500)
+            temp_n = cls.clean_colour_temperature(temp_end, 500)
+        else:
+            temp_0 = cls.clean_colour_temperature(temp_start, 500)
+            temp_n = cls.clean_colour_temperature(temp_end, 6500)
+        target_time = cls.clean_time_in_milliseconds(seconds, milliseconds, default_seconds=1, minimum_milliseconds=1000)
 
-        # Work out what the defaults should be
-        if setting is True:
-            t0 = 6500
-            t1 = 500
-        elif setting is False:
-            t0 = 500
-            t1 = 6500
+        def compile_sun():
+            temp_step = -100 if temp_0 > temp_n else 100
+            temps = list(range(temp_0, temp_n, temp_step)) + [temp_n]
+            colours_rgb = []
+            for temp in temps:
+                rgb = cls.named_colour_to_rgb("%sk" % temp)
+                if rgb is None:  # Off the 100K grid, calculate it instead
+                    rgb = cls.kelvin_to_rgb(max(temp, 1000))
+                colours_rgb.append(rgb)
+            return SunTimeline(colours_rgb, target_time / 1000.0, rising=temp_0 < temp_n, name="sunset" if setting else "sunrise")
 
-        # You can override these defaults if either temp_start or temp_end is set
-        if temp_start:
-            try:
-                _exists = NAMED_COLOURS[temp_start]
-                t0 = temp_start.rstrip('K')
-            except (TypeError, ValueError):  # Means the starting temp has NOT been provided, use default
-                pass
-            except KeyError:
-                logger.warning("Sunrise/sunset: Your starting colour temperature '{}' is not a valid colour temperature".format(temp_start))
-        if temp_end:
-            try:
-                _exists = NAMED_COLOURS[temp_end]
-                t1 = temp_end.rstrip('K')
-            except (TypeError, ValueError):  # Means the ending temp has NOT been provided, use default
-                pass
-            except KeyError:
-                logger.warning("Sunrise/sunset: Your ending colour temperature '{}' is not a valid colour temperature".format(temp_end))
-
-        if t0 > t1:
-            temp_0 = int(t0)
-            temp_n = int(t1)
-            temp_step = -100
-            x_start = 0
-            x_step_amount = 1
-        else:
-            temp_0 = int(t0)
-            temp_n = int(t1)
-            temp_step = 100
-            x_start = 60
-            x_step_amount = -1
-
-        # Add in a fudge factor to cater for CPU doing other things:
-        FUDGE_FACTOR = 0.86  # i.e we expect the routine to take 12% longer than the target time
-
-        # Calculate our z scaling factor:
-        target_time = self.clean_time_in_milliseconds(seconds, milliseconds, default_seconds=1, minimum_milliseconds=1000)
-        z_factor = (target_time * FUDGE_FACTOR) / 2.564949357
-        x_step = x_start
-
-        # And run the loop
-        t1 = time.time()
-        check = True  # We only check the current values on the first run
-        for temp in range(temp_0, temp_n, temp_step):
-            if self._sequence_stop_signal:  # Bail if sequence should stop
-                return None
-            k = u"%sk" % temp
-            try:
-                fade_time = ((100 + z_factor) / (65 - x_step))
-            except (ValueError, ZeroDivisionError):
-                x_step += x_step_amount
-                continue
-            else:
-                x_step += x_step_amount
-            self.fade(k, fade_time=fade_time, check=check)  # ms, slows down as sunset progresses
-            check = False
+        return cls._cached_timeline(("sun", temp_0, temp_n, target_time), compile_sun)
 
-        t2 = time.time()
-        logger.info("%ss, target=%ss" % ((t2 - t1), target_time / 1000.0))
+    def _sunrise_sunset(self, seconds=None, milliseconds=None, temp_start=None, temp_end=None, setting=True, elapsed=0.0):
+        """
+        Silly routine to emulate a sunset or sunrise, by playing the timeline from sun_timeline().
+        Takes exactly the time asked for, however busy the CPU is.
+
+        @keyword seconds: <float> Number of seconds to do the sequence over
+        @keyword milliseconds: <float> Number of milliseconds to do the sequence over, gets added to seconds if both provided
+        @keyword temp_start: <unicode> A colour temperature (in Kelvin) to start the sequence from
+        @keyword temp_end: <unicode> A colour temperature (in Kelvin) to end the sequence at
+        @keyword elapsed: <float> seconds into the sequence to start from
+        """
+        timeline = self.sun_timeline(seconds=seconds, milliseconds=milliseconds, temp_start=temp_start, temp_end=temp_end, setting=setting)
+        self._play_timeline(timeline, elapsed=elapsed)
+        return self.sync_channels()
 
     def sunset(self, seconds=None, milliseconds=None, temp_start=None, temp_end=None):
         """
@@ -1050,3 +1456,64 @@ class LEDStrip(object):
         Emulates a sunset
         """
         return self.run_sequence(self._sunrise_sunset, seconds=seconds, milliseconds=milliseconds, temp_start=temp_start, temp_end=temp_end, setting=False)
+
+    def _circadian(self, kelvin_at, update_seconds=60, fade_time=2000):
+        """
+        Follows a colour temperature curve through the day, e.g. a solar.CircadianCurve.
+        Runs until another action stops it.
+
+        @param kelvin_at: callable(<float> timestamp) returning the colour temperature in Kelvin for that time
+        @keyword update_seconds: <float> How often to check the curve
+        @keyword fade_time: <int> milliseconds to fade between colour temperatures
+        """
+        while not self._sequence_stop_signal:
+            kelvin = int(round(kelvin_at(time.time()) / 100.0)) * 100  # The named colour temperatures are in 100K steps
+            if kelvin != self._kelvin:
+                self.fade("%sK" % kelvin, fade_time=fade_time)
+            self.sleep(update_seconds)
+        return self.sync_channels()
+
+    def circadian(self, kelvin_at, update_seconds=60):
+        """
+        Follows the sun's colour temperature, run in a separate thread
+        """
+        return self.run_sequence(self._circadian, kelvin_at=kelvin_at, update_seconds=update_seconds)
+
+    def _music(self, source):
+        """
+        Lights the strip to the sound coming from source, one frame per block of audio, until the
+        audio ends or another action stops it.
+
+        @param source: <audio.PCMSource> An open audio source. Closed when we finish
+        """
+        from audio import MusicVisualiser  # Only pay for numpy if you use music mode
+        try:
+            visualiser = MusicVisualiser(source.sample_rate, source.block_size)
+            started = monotonic()
+            blocks = 0
+            while not self._sequence_stop_signal:
+                samples = source.read_block(should_stop=lambda: self._sequence_stop_signal)
+                if samples is None:
+                    break
+                if source.realtime:  # A file: show each block when it would be heard
+                    target_time = started + blocks * source.block_seconds
+                    if not self.sleep_until(target_time):
+                        break
+                else:  # Live audio: show it the moment it arrives
+                    target_time = monotonic()
+                self._render_frame(visualiser.process(samples), target_time)
+                blocks += 1
+            logger.info("Music: %s finished after %s blocks", source, blocks)
+        finally:
+            source.close()
+        return self.sync_channels()
+
+    def music(self, source_spec="alsa", sample_rate=44100, channels=1, block_size=1024):
+        """
+        Lights the strip to music, run in a separate thread. See audio.py for the sources you can use
+
+        @raise ValueError / IOError / OSError: If the audio source can't be opened
+        """
+        from audio import open_source  # Only pay for numpy if you use music mode
+        source = open_source(source_spec, sample_rate=sample_rate, channels=channels, block_size=block_size)
+        return self.run_sequence(self._music, source=source)
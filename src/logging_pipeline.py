@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Logging pipeline
+
+        Keeps slow SD card writes out of the frame loop. Logging a line just puts the record on a queue;
+        a background thread writes it to a size-rotated log file. If the writer ever falls too far
+        behind, records are dropped (and counted) rather than blocking whoever is logging.
+
+        Repeated messages are rate limited: the same message from the same call site gets one line per
+        window, and the next time it gets through it says how many were suppressed in between. If it
+        doesn't come again, the count is logged on its own once the window is over.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import atexit
+import logging
+from logging.handlers import RotatingFileHandler
+import time
+
+from six.moves import queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2: log synchronously
+    QueueHandler = QueueListener = None
+
+
+monotonic = getattr(time, "monotonic", time.time)
+LOG_FORMAT = "[%(asctime)s RASPILED] %(message)s"
+LOG_DATE_FORMAT = "%H:%M:%S"
+QUEUE_SIZE = 10000  # Records waiting for the writer before we start dropping them
+MAX_REPEAT_SITES = 1024  # Distinct messages the repeat filter remembers before starting afresh
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Lets each message (its call site and formatted text) through once per window_seconds. Different messages
+    from the same line, e.g. one per job or peer, all get through
+
+        Runs in whichever thread is logging, so is kept to a dict lookup. Suppressed records never reach the queue.
+    """
+
+    def __init__(self, window_seconds=10.0):
+        super(RepeatFilter, self).__init__()
+        self.window_seconds = float(window_seconds)
+        self._sites = {}  # (pathname, lineno, message) : [window start, suppressed count, last suppressed record]
+        self._swept = monotonic()
+
+    def filter(self, record):
+        if self.window_seconds <= 0:
+            return True
+        now = monotonic()
+        if now - self._swept >= self.window_seconds:
+            self.sweep(now)
+        key = (record.pathname, record.lineno, record.getMessage())
+        site = self._sites.get(key)
+        if site is None:
+            if len(self._sites) >= MAX_REPEAT_SITES:
+                self._sites.clear()
+            self._sites[key] = [now, 0, None]
+            return True
+        if now - site[0] < self.window_seconds:
+            site[1] += 1
+            site[2] = record
+            return False
+        if site[1]:
+            record.msg = "{} [{} more like this suppressed in the last {:.0f}s]".format(record.getMessage(), site[1], now - site[0])
+            record.args = None
+        site[0] = now
+        site[1] = 0
+        site[2] = None
+        return True
+
+    def sweep(self, now=None, everything=False):
+        """
+        Logs the suppressed counts of messages whose window is over and which haven't come again to report them
+
+        @keyword everything: <Bool> Report every count, however recent (e.g. as we exit)
+        """
+        now = monotonic() if now is None else now
+        self._swept = now
+        for key, (started, suppressed, last_record) in list(self._sites.items()):
+            if not suppressed or (not everything and now - started < self.window_seconds):
+                continue
+            self._sites.pop(key, None)
+            summary = logging.makeLogRecord(dict(last_record.__dict__, args=None, exc_info=None, exc_text=None,
+                                                 msg="{} [{} more like this suppressed in the last {:.0f}s]".format(last_record.getMessage(), suppressed, now - started)))
+            logging.getLogger(last_record.name).handle(summary)  # A different message, so it gets through this filter
+
+
+class DroppingQueueHandler(QueueHandler or logging.Handler):
+    """
+    A QueueHandler which drops records rather than blocking when the writer is behind
+    """
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(logger, path, max_bytes=1024 * 1024, backups=3, level="INFO", repeat_seconds=10.0):
+    """
+    Points logger at a rotating log file, written from a background thread
+
+    @param logger: <logging.Logger>
+    @param path: <unicode> The log file. Opened on the first record, not now
+    @keyword max_bytes: <int> Rotate once the file reaches this size. 0 = never rotate
+    @keyword backups: <int> How many rotated files to keep (path.1, path.2...)
+    @keyword level: <unicode> One of LEVELS
+    @keyword repeat_seconds: <float> Rate limit window for repeated messages. 0 = log everything
+    @return: <QueueListener> or None if logging is synchronous (Python 2)
+    """
+    file_handler = RotatingFileHandler(filename=path, encoding="utf-8", mode="a", maxBytes=int(max_bytes), backupCount=int(backups), delay=True)
+    file_handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    try:
+        set_level(logger, level)
+    except ValueError as e:
+        logger.setLevel(logging.INFO)
+        logging.warning("%s Using INFO.", e)
+    repeat_filter = RepeatFilter(repeat_seconds)
+    logger.addFilter(repeat_filter)
+    if QueueHandler is None:
+        logger.addHandler(file_handler)
+        atexit.register(repeat_filter.sweep, everything=True)
+        return None
+    queue_handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Writes out whatever is still queued
+    atexit.register(repeat_filter.sweep, everything=True)  # Runs first, so its counts are queued before the listener stops
+    return listener
+
+
+def set_level(logger, level):
+    """
+    Changes how verbose the logger is, at runtime
+    @param level: <unicode> One of LEVELS, any case
+    @raise ValueError: If level isn't one of LEVELS
+    """
+    level_name = "{}".format(level).strip().upper()
+    if level_name not in LEVELS:
+        raise ValueError("Unknown log level '{}'. Choose from: {}".format(level, ", ".join(LEVELS)))
+    logger.setLevel(getattr(logging, level_name))
+    return level_name
+
+
+def get_level(logger):
+    return logging.getLevelName(logger.level)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Metrics
+
+        Counters and histograms for what the listener is doing (requests, frames, pigpio writes,
+        sequences, caches), served in the Prometheus text format at http://your.pi:port/metrics
+
+        Cheap enough to leave on: recording a value is a dict update under a lock that is only ever
+        held for that update, and histograms find their bucket before taking the lock. Everything is
+        formatted into text only when /metrics is scraped.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+import threading
+import time
+
+import six
+from twisted.web.resource import Resource
+
+
+monotonic = getattr(time, "monotonic", time.time)
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+DURATION_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0, 24 * 3600.0)  # seconds
+
+
+def escape_label_value(value):
+    return six.text_type(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return six.text_type(int(value))
+    return six.text_type(value)
+
+
+class Metric(object):
+    """
+    A named family of values, one per combination of label values
+    """
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # (label values, ) : value
+        self._lock = threading.Lock()
+
+    def format_labels(self, label_values, extra=()):
+        pairs = list(zip(self.labelnames, label_values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, escape_label_value(value)) for name, value in pairs) + "}"
+
+    def samples(self):
+        """
+        @return: [(<unicode> sample name + labels, <number> value), ]
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name + self.format_labels(labels), value) for labels, value in values]
+
+    def exposition(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        lines.extend("{} {}".format(sample, format_value(value)) for sample, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A count that only ever goes up
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Counter, self).__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0  # Report zero rather than nothing before the first increment
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Either set() it, or give it a function to read it with when scraped
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), read_func=None):
+        """
+        @keyword read_func: callable() returning a number, or {(label values, ): number}, read at scrape time
+        """
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.read_func = read_func
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def samples(self):
+        if self.read_func is not None:
+            values = self.read_func()
+            if not isinstance(values, dict):
+                values = {(): values}
+            with self._lock:
+                self._values = dict(values)
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets, plus their sum and count
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets))
+        if not self.labelnames:
+            self._values[()] = self._empty()
+
+    def _empty(self):
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]  # Per bucket counts (the last is +Inf), sum, count
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                series = self._values[labels]
+            except KeyError:
+                series = self._values[labels] = self._empty()
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, labels=()):
+        """
+        Context manager which observes how long its block took
+        """
+        return HistogramTimer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(series[0]), series[1], series[2])) for labels, series in self._values.items())
+        out_samples = []
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                out_samples.append((self.name + "_bucket" + self.format_labels(labels, [("le", format_value(upper_bound))]), cumulative))
+            out_samples.append((self.name + "_sum" + self.format_labels(labels), total))
+            out_samples.append((self.name + "_count" + self.format_labels(labels), count))
+        return out_samples
+
+
+class HistogramTimer(object):
+
+    def __init__(self, histogram, labels=()):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(monotonic() - self.started, self.labels)
+
+
+class MetricsRegistry(object):
+    """
+    All the metrics this process exposes, by name
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Adds a metric, or returns the one already registered under its name (so modules can be reloaded)
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), read_func=None):
+        return self.register(Gauge(name, documentation, labelnames, read_func))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        """
+        @return: <unicode> Every metric in the Prometheus text format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return "\n".join(metric.exposition() for name, metric in metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()  # The process wide registry
+
+
+class MetricsResource(Resource):
+    """
+    Serves a registry at /metrics for Prometheus to scrape
+    """
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", CONTENT_TYPE)
+        return self.registry.exposition().encode("utf-8")
@@ -7,6 +7,11 @@
 """
 from __future__ import unicode_literals
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
 CSS4_COLOURS = {
     'indigo': '#4B0082',
     'gold': '#FFD700',
@@ -312,7 +317,49 @@ NAMED_COLOURS = {
     '9900k': '#cddcff'
 }
 NAMED_COLOURS.update(CSS4_COLOURS)
-NAMED_COLORS = NAMED_COLOURS
 
 
+class PackedColourNames(Mapping):
+    """
+    A read-only {<unicode> name: <unicode> "#RRGGBB"} over a table of packed 0xRRGGBB integers, so the hex strings
+    only exist while someone is using one
+    """
+
+    def __init__(self, packed):
+        self._packed = packed
+
+    def __getitem__(self, name):
+        return "#{:06X}".format(self._packed[name])
+
+    def __contains__(self, name):
+        return name in self._packed
+
+    def __iter__(self):
+        return iter(self._packed)
+
+    def __len__(self):
+        return len(self._packed)
+
+
+# The hex literals above are parsed once, here, into packed integers (which take about half the memory), then let go
+_packed_colours = dict((name, int(hex_value.lstrip("#"), 16)) for name, hex_value in NAMED_COLOURS.items())  # {<unicode> name: <int> 0xRRGGBB}
+CSS4_COLOURS = PackedColourNames(dict((name, _packed_colours[name]) for name in CSS4_COLOURS))
+NAMED_COLOURS = NAMED_COLORS = PackedColourNames(_packed_colours)
+
+
+def packed_colours():
+    """
+    @return: {<unicode> name: <int> 0xRRGGBB} every named colour
+    """
+    return _packed_colours
+
 
+def named_rgb(name):
+    """
+    @param name: <unicode> e.g. "pink" or "2700k". Case insensitive
+    @return: (r, g, b) 0-255, or None if the name isn't known
+    """
+    packed = _packed_colours.get(name.lower())
+    if packed is None:
+        return None
+    return packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF
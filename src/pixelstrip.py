@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Addressable pixel strips (WS281x / APA102)
+
+        Where LEDStrip drives one colour across a whole strip via three PWM pins, PixelStrip holds a
+        colour for every pixel in a compact NumPy uint8 frame buffer (one row of r, g, b per pixel).
+        Effects work on the whole buffer at once, so a gradient across thousands of pixels costs a
+        handful of array operations rather than thousands of Python calls.
+
+        Frames go out through a sink:
+            FilePixelSink - writes raw encoded frames to a file, FIFO or stdout. Handy off-hardware.
+            SpiPixelSink - writes to /dev/spidevX.Y via the optional spidev package.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import io
+
+import numpy as np
+import six
+
+import colour_arrays
+from ledstrip import LEDStrip, calibration_from_settings
+from src.config import logger
+
+try:
+    import spidev
+except ImportError:  # Only needed to drive real hardware
+    spidev = None
+
+
+PIXEL_TYPES = ("ws281x", "apa102")
+DEFAULT_COLOUR_ORDERS = {"ws281x": "GRB", "apa102": "BGR"}  # What each type of chip usually expects on the wire
+WS281X_SPI_HZ = 2400000  # Each WS281x bit becomes 3 SPI bits at 2.4MHz (~417ns each)
+APA102_SPI_HZ = 8000000
+
+
+def _build_ws281x_lookup():
+    """
+    Maps each byte value onto the 3 SPI bytes that clock it out to a WS281x: 1 -> 110, 0 -> 100
+    :return: <np.ndarray> uint8 of shape (256, 3)
+    """
+    lookup = np.zeros((256, 3), dtype=np.uint8)
+    for value in range(256):
+        bits = 0
+        for bit in range(7, -1, -1):
+            bits = (bits << 3) | (0b110 if (value >> bit) & 1 else 0b100)
+        lookup[value] = ((bits >> 16) & 0xFF, (bits >> 8) & 0xFF, bits & 0xFF)
+    return lookup
+
+
+WS281X_SPI_LOOKUP = _build_ws281x_lookup()
+
+
+class PixelSink(object):
+    """
+    Somewhere to send encoded frames. Subclass and implement write()
+    """
+
+    def write(self, frame):
+        """
+        @param frame: <np.ndarray> uint8 encoded frame, contiguous (supports the buffer protocol)
+        """
+        raise NotImplementedError("PixelSink.write() must be implemented by a subclass")
+
+    def close(self):
+        return None
+
+
+class FilePixelSink(PixelSink):
+    """
+    Writes raw frames to a file or pipe.
+
+        Seekable files are rewound each frame so they always hold the latest frame. Pipes, FIFOs and
+        streams get every frame appended, so another process can consume them frame by frame.
+    """
+
+    def __init__(self, target):
+        """
+        @param target: <unicode> path to a file / FIFO, or an already open binary file object
+        """
+        if isinstance(target, (six.text_type, six.binary_type)):
+            self.fileobj = io.open(target, "wb", buffering=0)
+            self._owns_file = True
+        else:
+            self.fileobj = target
+            self._owns_file = False
+        try:
+            self._seekable = self.fileobj.seekable()
+        except (AttributeError, IOError, ValueError):
+            self._seekable = False
+
+    def write(self, frame):
+        if self._seekable:
+            self.fileobj.seek(0)
+        self.fileobj.write(frame)
+        if self._seekable:
+            self.fileobj.truncate()
+        try:
+            self.fileobj.flush()
+        except (AttributeError, IOError):
+            pass
+
+    def close(self):
+        if self._owns_file:
+            self.fileobj.close()
+
+
+class SpiPixelSink(PixelSink):
+    """
+    Writes frames to the SPI bus. Needs the spidev package (pip install spidev) and SPI enabled on the Pi
+    """
+
+    def __init__(self, bus=0, device=0, speed_hz=WS281X_SPI_HZ):
+        if spidev is None:
+            raise RuntimeError("SpiPixelSink needs the spidev package: pip install spidev")
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = int(speed_hz)
+        self.spi.mode = 0
+
+    def write(self, frame):
+        self.spi.writebytes2(frame)  # Accepts buffer-protocol objects, and chunks large frames for us
+
+    def close(self):
+        self.spi.close()
+
+
+@six.python_2_unicode_compatible
+class PixelStrip(object):
+    """
+    Represents an addressable LED strip: one colour per pixel, held in a NumPy frame buffer
+    """
+    pixels = None  # <np.ndarray> uint8 (count, 3), r, g, b per pixel
+
+    def __init__(self, count, sink, pixel_type="ws281x", colour_order=None, brightness=1.0, calibrate=None):
+        """
+        :param count: <int> Number of pixels on the strip
+        :param sink: <PixelSink> Where to send the encoded frames
+        :keyword pixel_type: <unicode> "ws281x" or "apa102"
+        :keyword colour_order: <unicode> The order the channels go out on the wire, e.g. "GRB" for most WS2812Bs.
+                               None = the pixel type's usual order (DEFAULT_COLOUR_ORDERS)
+        :keyword brightness: <float> 0-1 global brightness
+        :keyword calibrate: {} dict of channel letter : multiplier, as LEDStrip
+        """
+        pixel_type = six.text_type(pixel_type).lower()
+        if pixel_type not in PIXEL_TYPES:
+            raise ValueError("Unknown pixel type '{}'. Choose from: {}".format(pixel_type, ", ".join(PIXEL_TYPES)))
+        colour_order = six.text_type(colour_order or DEFAULT_COLOUR_ORDERS[pixel_type]).upper()
+        if sorted(colour_order) != ["B", "G", "R"]:
+            raise ValueError("Colour order '{}' must be an arrangement of R, G and B".format(colour_order))
+        self.count = int(count)
+        self.sink = sink
+        self.pixel_type = pixel_type
+        self.colour_order = colour_order
+        self._channel_order = np.array(["RGB".index(channel) for channel in colour_order], dtype=np.intp)
+        self._calibrate = calibrate or {"r": 1.0, "g": 1.0, "b": 1.0}
+        self._brightness = 1.0
+        # Preallocate everything a frame needs, so show() doesn't allocate
+        self.pixels = np.zeros((self.count, 3), dtype=np.uint8)
+        self._positions = np.arange(self.count, dtype=np.float64)
+        self._hsv = np.zeros((self.count, 3), dtype=np.float64)
+        self._scale = np.zeros(3, dtype=np.uint16)
+        self._scaled = np.zeros((self.count, 3), dtype=np.uint16)
+        self._ordered = np.zeros((self.count, 3), dtype=np.uint8)
+        if pixel_type == "ws281x":
+            self._frame = np.zeros(self.count * 9, dtype=np.uint8)
+        else:  # APA102: 4 byte start frame, 4 bytes per pixel, then enough 1s to clock the data down the strip
+            end_frame_bytes = max(4, (self.count + 15) // 16)
+            self._frame = np.zeros(4 + self.count * 4 + end_frame_bytes, dtype=np.uint8)
+            self._frame[4 + self.count * 4:] = 0xFF
+            self._frame_pixels = self._frame[4:4 + self.count * 4].reshape(self.count, 4)
+            self._frame_pixels[:, 0] = 0xFF  # 111 + full 5-bit global brightness; we scale the colours instead
+        self.set_brightness(brightness)
+
+    def __str__(self):
+        return "{} {} pixels ({})".format(self.count, self.pixel_type, self.colour_order)
+
+    def __len__(self):
+        return self.count
+
+    #### Colour helpers ####
+
+    @classmethod
+    def resolve_colour(cls, colour):
+        """
+        Turns a named / hex / rgb / kelvin colour string or an (r, g, b) iterable into an (r, g, b) tuple
+        """
+        if isinstance(colour, (six.text_type, six.binary_type)):
+            colour_str = six.ensure_text(colour).strip()
+            named_rgb = LEDStrip.named_colour_to_rgb(colour_str)
+            if named_rgb is not None:
+                return named_rgb
+            rgb = LEDStrip.colour_to_rgb_tuple(colour_str)
+            if rgb is None:
+                raise ValueError("No colour identified by '{}'".format(colour_str))
+            return tuple(int(round(channel)) for channel in rgb)
+        r, g, b = colour
+        return int(r), int(g), int(b)
+
+    def set_brightness(self, brightness):
+        """
+        Sets the global brightness (0-1), folded together with calibration into one multiplier per channel
+        """
+        self._brightness = LEDStrip.lim(0.0, 1.0, brightness)
+        for i, channel in enumerate("rgb"):
+            self._scale[i] = int(round(256 * self._brightness * self._calibrate.get(channel, 1.0)))
+        return self._brightness
+
+    #### Effects: whole-buffer operations ####
+
+    def fill(self, colour):
+        """
+        Sets every pixel to one colour
+        """
+        self.pixels[:] = self.resolve_colour(colour)
+        return self
+
+    def set_pixel(self, index, colour):
+        self.pixels[index] = self.resolve_colour(colour)
+        return self
+
+    def clear(self):
+        self.pixels.fill(0)
+        return self
+
+    def gradient(self, colours, start=0, end=None):
+        """
+        Spreads the colours evenly from pixel start to pixel end, blending linearly between them
+
+        @param colours: [] list of colours (or a comma delimited string)
+        @keyword start: <int> First pixel of the gradient
+        @keyword end: <int> Last pixel of the gradient (inclusive). Defaults to the end of the strip
+        """
+        colours = LEDStrip.convert_to_colour_list(colours)
+        stops = np.array([self.resolve_colour(colour) for colour in colours], dtype=np.float64)
+        if end is None:
+            end = self.count - 1
+        if len(stops) == 1 or end <= start:
+            self.pixels[start:end + 1] = stops[0]
+            return self
+        stop_positions = np.linspace(start, end, len(stops))
+        positions = self._positions[start:end + 1]
+        for channel in range(3):
+            self.pixels[start:end + 1, channel] = np.rint(np.interp(positions, stop_positions, stops[:, channel]))
+        return self
+
+    def rainbow(self, offset=0.0, saturation=1.0, value=1.0, cycles=1.0):
+        """
+        Paints the whole colour wheel along the strip
+
+        @keyword offset: <float> 0-1 how far round the wheel the first pixel is. Animate this to spin the rainbow
+        @keyword cycles: <float> How many times the wheel repeats along the strip
+        """
+        self._hsv[:, 0] = (self._positions * (cycles / max(self.count, 1)) + offset) % 1.0
+        self._hsv[:, 1] = saturation
+        self._hsv[:, 2] = value
+        self.pixels[:] = colour_arrays.hsv_to_rgb(self._hsv, hue_scale_factor=1.0, sat_scale_factor=1.0, val_scale_factor=1.0)
+        return self
+
+    def rotate(self, steps=1):
+        """
+        Moves every pixel along by steps (wrapping round), for chasers and scrolling effects
+        """
+        self.pixels[:] = np.roll(self.pixels, steps, axis=0)
+        return self
+
+    def fade_towards(self, colour, fraction):
+        """
+        Blends every pixel fraction (0-1) of the way towards colour, e.g. one step of a fade
+        """
+        target = np.array(self.resolve_colour(colour), dtype=np.int16)
+        current = self.pixels.astype(np.int16)
+        current += np.rint((target - current) * LEDStrip.lim(0.0, 1.0, fraction)).astype(np.int16)
+        self.pixels[:] = current
+        return self
+
+    #### Output ####
+
+    def encode(self):
+        """
+        Encodes the frame buffer into the bytes the strip expects, in the preallocated output buffer
+        :return: <np.ndarray> uint8 encoded frame
+        """
+        np.multiply(self.pixels, self._scale, out=self._scaled)
+        np.right_shift(self._scaled, 8, out=self._scaled)
+        np.minimum(self._scaled, 255, out=self._scaled)
+        np.take(self._scaled, self._channel_order, axis=1, out=self._ordered, mode="clip")
+        if self.pixel_type == "ws281x":
+            np.take(WS281X_SPI_LOOKUP, self._ordered.reshape(-1), axis=0, out=self._frame.reshape(-1, 3))
+        else:
+            self._frame_pixels[:, 1:] = self._ordered
+        return self._frame
+
+    def show(self):
+        """
+        Sends the current frame buffer to the strip
+        """
+        self.sink.write(self.encode())
+        return self
+
+    def teardown(self):
+        try:
+            self.clear().show()
+        finally:
+            self.sink.close()
+
+
+def pixel_strip_from_settings(params):
+    """
+    Builds a PixelStrip from the pixel_* settings, or returns None if pixel_count is 0
+
+        pixel_sink = spi:0.0  -> SPI bus 0, device 0
+        pixel_sink = /tmp/raspiled_pixels.bin  -> file or FIFO
+    """
+    try:
+        count = int(params.get("pixel_count", 0) or 0)
+    except (TypeError, ValueError):
+        logger.warning("pixel_count must be an integer, pixel strip disabled")
+        return None
+    if count <= 0:
+        return None
+    pixel_type = six.text_type(params.get("pixel_type", "ws281x") or "ws281x").lower()
+    sink_setting = six.text_type(params.get("pixel_sink", "spi:0.0") or "spi:0.0")
+    if sink_setting.startswith("spi:"):
+        bus, _sep, device = sink_setting[4:].partition(".")
+        speed_hz = WS281X_SPI_HZ if pixel_type == "ws281x" else APA102_SPI_HZ
+        sink = SpiPixelSink(int(bus or 0), int(device or 0), speed_hz=speed_hz)
+    else:
+        sink = FilePixelSink(sink_setting)
+    logger.info("Pixel strip: %s %s pixels -> %s", count, pixel_type, sink_setting)
+    return PixelStrip(count, sink, pixel_type=pixel_type, colour_order=params.get("pixel_order") or None, calibrate=calibration_from_settings(params))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - On-demand profiling
+
+        For when the Pi feels sluggish and you want to know where the time goes. Two profilers, both
+        off until you ask for them at http://your.pi:port/profile (admin only):
+
+            ?requests=20            Deterministic cProfile of the next 20 web requests (render_GET and everything under it)
+            ?sample=30              Samples the sequence thread's stack every few ms for 30 seconds
+                &interval_ms=5      ...how often to sample
+                &thread=all         ...which threads (name contains this, or "all"). Default: the sequence thread
+            ?stop                   Stops both
+            ?download=pstats        The request profile, for python -m pstats / snakeviz
+            ?download=stats         The request profile as text, by cumulative time
+            ?download=collapsed     The sampled stacks, one "frame;frame;frame count" line each, for flamegraph.pl / speedscope
+            (no params)             What's running and what's been captured
+
+        While disabled they cost nothing: the request profiler swaps a profiled render_GET onto the
+        resource only while armed, and the sampler is a thread that only exists during its window.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+from collections import Counter
+import cProfile
+import json
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+import six
+from twisted.web.resource import Resource
+
+from src.config import logger
+
+
+monotonic = getattr(time, "monotonic", time.time)
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+MAX_SAMPLE_SECONDS = 600
+MAX_PROFILED_REQUESTS = 1000
+MAX_STACK_DEPTH = 64
+SEQUENCE_THREAD_PREFIX = "raspiled-sequence"  # LEDStrip names its sequence threads with this
+
+
+class RequestProfiler(object):
+    """
+    Runs cProfile over the next N calls to a resource's render_GET
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.profile = None
+        self.requests_wanted = 0
+        self.requests_profiled = 0
+
+    @property
+    def armed(self):
+        return "render_GET" in vars(self.resource)
+
+    def arm(self, requests):
+        """
+        Starts a fresh profile covering the next <requests> requests
+        """
+        self.disarm()
+        self.profile = cProfile.Profile()
+        self.requests_wanted = max(1, min(int(requests), MAX_PROFILED_REQUESTS))
+        self.requests_profiled = 0
+        original_render_GET = self.resource.render_GET
+        profile = self.profile
+
+        def profiled_render_GET(request):
+            try:
+                return profile.runcall(original_render_GET, request)
+            finally:
+                self.requests_profiled += 1
+                if self.requests_profiled >= self.requests_wanted:
+                    self.disarm()
+                    logger.info("Profiler: captured %s requests", self.requests_profiled)
+
+        self.resource.render_GET = profiled_render_GET  # Shadows the class's method until disarmed
+        logger.info("Profiler: profiling the next %s requests", self.requests_wanted)
+
+    def disarm(self):
+        if self.armed:
+            del self.resource.render_GET
+
+    def pstats_bytes(self):
+        """
+        @return: <bytes> The profile in the format pstats.Stats() loads, or None if nothing was captured
+        """
+        if self.profile is None or not self.requests_profiled:
+            return None
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+    def stats_text(self, limit=40):
+        if self.profile is None or not self.requests_profiled:
+            return None
+        stream = six.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    def report(self):
+        return {
+            "armed": self.armed,
+            "requests_wanted": self.requests_wanted,
+            "requests_profiled": self.requests_profiled,
+        }
+
+
+class SamplingProfiler(object):
+    """
+    Counts the call stacks of chosen threads, sampled every interval over a window of time
+    """
+    _thread = None
+
+    def __init__(self):
+        self.stacks = Counter()  # "thread;frame;frame" : samples
+        self.samples = 0
+        self.thread_filter = SEQUENCE_THREAD_PREFIX
+        self.interval_seconds = DEFAULT_SAMPLE_INTERVAL_MS / 1000.0
+        self.ends_at = None
+        self._stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval_ms=DEFAULT_SAMPLE_INTERVAL_MS, thread_filter=SEQUENCE_THREAD_PREFIX):
+        """
+        Starts sampling for seconds, replacing any stacks from last time
+        @param thread_filter: <unicode> Only sample threads whose name contains this, or "all"
+        """
+        self.stop()
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread_filter = "" if thread_filter in ("all", "*") else thread_filter
+        self.interval_seconds = max(float(interval_ms), 1.0) / 1000.0
+        self.ends_at = monotonic() + max(0.0, min(float(seconds), MAX_SAMPLE_SECONDS))
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="raspiled-sampling-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Profiler: sampling '%s' threads every %.0fms for %ss", self.thread_filter or "all", self.interval_seconds * 1000, seconds)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.current_thread().ident
+        while not self._stop_event.wait(self.interval_seconds) and monotonic() < self.ends_at:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                name = names.get(thread_id, "thread-{}".format(thread_id))
+                if thread_id == own_id or self.thread_filter not in name:
+                    continue
+                self.stacks[self.collapse(name, frame)] += 1
+            self.samples += 1
+        logger.info("Profiler: sampling finished after %s samples", self.samples)
+
+    @classmethod
+    def collapse(cls, thread_name, frame):
+        """
+        @return: <unicode> "thread;outermost frame;...;innermost frame"
+        """
+        frames = []
+        while frame is not None and len(frames) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            frames.append("{} ({})".format(code.co_name, os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        frames.append(thread_name)
+        frames.reverse()
+        return ";".join(frame_name.replace(";", ":") for frame_name in frames)
+
+    def collapsed_text(self):
+        """
+        @return: <unicode> Brendan Gregg's collapsed stack format, ready for flamegraph.pl
+        """
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+    def report(self):
+        return {
+            "running": self.running,
+            "thread_filter": self.thread_filter or "all",
+            "interval_ms": self.interval_seconds * 1000.0,
+            "seconds_left": round(max(0.0, self.ends_at - monotonic()), 1) if self.running else 0,
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+        }
+
+
+class ProfilingResource(Resource):
+    """
+    The admin endpoint at /profile, which switches the profilers on and off and serves their results
+    """
+    isLeaf = True
+
+    def __init__(self, resource, is_admin):
+        """
+        @param resource: <RaspberryPiWebResource> whose requests we profile
+        @param is_admin: callable(request) -> <Bool> whether the requester may use the profilers
+        """
+        Resource.__init__(self)
+        self.is_admin = is_admin
+        self.request_profiler = RequestProfiler(resource)
+        self.sampling_profiler = SamplingProfiler()
+
+    def report(self):
+        return {
+            "requests": self.request_profiler.report(),
+            "sampler": self.sampling_profiler.report(),
+        }
+
+    @classmethod
+    def render_json(cls, request, context, http_code=200):
+        request.setHeader(b"Content-Type", b"application/json; charset=utf-8")
+        request.setResponseCode(http_code)
+        return json.dumps(context).encode("utf-8")
+
+    @classmethod
+    def render_download(cls, request, content, filename, content_type=b"text/plain; charset=utf-8"):
+        if content is None:
+            return cls.render_json(request, {"error": "Nothing has been captured yet."}, http_code=404)
+        request.setHeader(b"Content-Type", content_type)
+        request.setHeader(b"Content-Disposition", 'attachment; filename="{}"'.format(filename).encode("utf-8"))
+        return content if isinstance(content, six.binary_type) else content.encode("utf-8")
+
+    def render_GET(self, request):
+        if not self.is_admin(request):
+            return self.render_json(request, {"error": "Profiling is for admins only."}, http_code=403)
+        try:
+            if request.has_param("stop"):
+                self.request_profiler.disarm()
+                self.sampling_profiler.stop()
+            if request.has_param("requests"):
+                self.request_profiler.arm(request.get_param("requests", force=int))
+            if request.has_param("sample"):
+                self.sampling_profiler.start(
+                    seconds=request.get_param("sample", force=float),
+                    interval_ms=request.get_param("interval_ms", default=DEFAULT_SAMPLE_INTERVAL_MS, force=float),
+                    thread_filter=request.get_param("thread", default=SEQUENCE_THREAD_PREFIX),
+                )
+        except (TypeError, ValueError) as e:
+            return self.render_json(request, {"error": "{}: {}".format(e.__class__.__name__, e)}, http_code=400)
+
+        download = request.get_param("download")
+        if download == "pstats":
+            return self.render_download(request, self.request_profiler.pstats_bytes(), "raspiled.pstats", b"application/octet-stream")
+        if download == "stats":
+            return self.render_download(request, self.request_profiler.stats_text(), "raspiled-stats.txt")
+        if download == "collapsed":
+            return self.render_download(request, self.sampling_profiler.collapsed_text() or None, "raspiled-stacks.collapsed")
+        return self.render_json(request, self.report())
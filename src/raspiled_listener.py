@@ -12,22 +12,38 @@
 from __future__ import unicode_literals
 import os
 import sys
+import time
+PROCESS_STARTED = getattr(time, "monotonic", time.time)()  # Before any heavy imports, for the time-to-first-request log
 # Add some gymnastics so we can use imports relative to the parent dir.
 my_dir = os.path.dirname(os.path.realpath(__file__))  # The directory we're running in
 sys.path.append(os.path.dirname(my_dir))  # Parent dir
 
-from src.config import CONFIG, get_setting, DEBUG, logger
+from src.config import CONFIG, config_path, get_setting, DEBUG, logger, interactive_setup
+from src.logging_pipeline import LEVELS, get_level, set_level
 from utils import *
-from ledstrip import LEDStrip
-
-from subprocess import check_output, CalledProcessError
-from twisted.internet import reactor, endpoints
+from ledstrip import LEDStrip, monotonic, pigpiod_process
+from connection import port_is_open
+from access import TokenBucketLimiter, Whitelist
+from config_watcher import ConfigWatcher
+from frametrace import FrameTrace, FrameTraceResource
+from scheduler import Job, JobScheduler, parse_when
+from solar import CircadianCurve, SolarSchedule, SOLAR_EVENTS
+from state import StateSnapshot
+from timesync import TimeSync
+from transitions import clean_interpolation
+
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
 from twisted.web.server import Site, Request
 from named_colours import NAMED_COLOURS
 import copy
-import configparser
+import functools
 import six
-from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import parse_qsl, urlencode, urlsplit
+try:
+    from types import MappingProxyType
+except ImportError:  # Python 2: no read-only dict view, so make do with a dict
+    MappingProxyType = dict
 
 
 APP_NAME = "python ./raspiled_listener.py"
@@ -219,7 +235,20 @@ class RaspiledControlResource(RaspberryPiWebResource):
     Our web page for controlling the LED strips
     """
     led_strip = None  # Populated at init
-
+    first_request_served = False  # Whether we have logged the time to first request yet
+    pixel_strip = None  # Populated at init if you have an addressable strip
+    solar_schedule = None  # Populated at init
+    scheduler = None  # Populated once we have a reactor
+    state_snapshot = None  # Populated at init
+    time_sync = None  # <timesync.TimeSync> Populated once we have a reactor, keeps us on the same clock as the other listeners
+
+    PARAM_TO_INFORMATION_MAPPING = RaspberryPiWebResource.PARAM_TO_INFORMATION_MAPPING + (
+        ("fleet", "fleet"),  # Fleet controller health
+        ("connection", "connection"),  # pigpio connection health
+        ("solar", "solar"),  # Today's sunrise, sunset and twilight times
+        ("jobs", "jobs"),  # Scheduled jobs
+        ("timesync", "timesync"),  # Our offset from the shared timebase
+    )
     # State what params should automatically trigger actions. If none supplied will show a default page. Specified in order of hierarchy
     PRESET_FUNCTIONS = (
         # Stat actions
@@ -246,7 +275,13 @@ class RaspiledControlResource(RaspberryPiWebResource):
         # Generic:
         ("off", "off"),
         ("stop", "stop"),
-        ("preset", "preset")
+        ("preset", "preset"),
+        ("pixels", "pixels"),
+        ("circadian", "circadian"),
+        ("schedule", "schedule"),
+        ("unschedule", "unschedule"),
+        ("loglevel", "loglevel"),
+        ("music", "music"),
     ) + PRESET_FUNCTIONS + (
         # Docs:
         ("capabilities", "capabilities"),
@@ -311,13 +346,31 @@ class RaspiledControlResource(RaspberryPiWebResource):
         )
     }
     PRESETS_COPY = copy.deepcopy(PRESETS)  # Modifiable dictionary. Used in alarms and music.
+    MUSIC_PRESETS = (
+        Preset(label="&#x1f3b5; Music", slug="music", display_gradient=("red", "lime", "blue"), music="", is_sequence=True),
+        Preset(label="Stop", display_colour="black", stop=""),
+    )
+    SEQUENCE_SAFE_ACTIONS = ("schedule", "unschedule", "loglevel")  # Actions which leave the current sequence running
 
     def __init__(self, *args, **kwargs):
         """
         @TODO: perform LAN discovery, interrogate the resources, generate controls for all of them
         """
         self.led_strip = LEDStrip(RESOLVED_USER_SETTINGS)
+        if get_setting("pixel_count", 0):  # Only pay for importing numpy if you have an addressable strip
+            from pixelstrip import pixel_strip_from_settings
+            self.pixel_strip = pixel_strip_from_settings(RESOLVED_USER_SETTINGS)
+        self.solar_schedule = SolarSchedule(get_setting("latitude", 52.2053), get_setting("longitude", 0.1218))
+        self.circadian_curve = CircadianCurve(self.solar_schedule, day_kelvin=get_setting("circadian_day_kelvin", 6500),
+                                              night_kelvin=get_setting("circadian_night_kelvin", 2000))
+        self.state_snapshot = StateSnapshot(os.path.join(RASPILED_DIR, get_setting("state_file", "raspiled_state.json")), self.led_strip.snapshot_state)
+        self.resume_state()
+        self.led_strip.state_snapshot = self.state_snapshot
+        if get_setting("frame_trace_seconds", 300):
+            self.led_strip.frame_recorder = FrameTrace.for_seconds(get_setting("frame_trace_seconds", 300))
+        self.rate_limiter = TokenBucketLimiter(get_setting("rate_limit_per_second", 10), get_setting("rate_limit_burst", 20))
         RaspberryPiWebResource.__init__(self, *args, **kwargs)  # Super, deals with generating the static directory etc
+        self.putChild(b"frames", FrameTraceResource(self.led_strip.frame_recorder))  # Recent frame timings, for diagnosing stutter
 
     def render_controls(self, request):
         """
@@ -327,7 +380,7 @@ class RaspiledControlResource(RaspberryPiWebResource):
             "off_preset_html": self.OFF_PRESET.render(),
             "light_html": self.render_light_presets(request),
             "alarm_html": self.render_alarm_presets(request),
-            "music_html": self.render_udevelop_presets(request),
+            "music_html": self.render_music_presets(request),
             "controls_html": self.render_udevelop_presets(request),
         }
         return RaspberryPiWebResource.render_controls(self, request, context)
@@ -401,6 +454,24 @@ class RaspiledControlResource(RaspberryPiWebResource):
         out_html = "\n".join(out_html_list)
         return out_html
 
+    def render_music_presets(self, request):
+        """
+        Renders the music mode controls
+        """
+        out_html = """
+            <div class="preset_group">
+                <h2>Music</h2>
+                <p>Bass lights red, mids green and treble blue. Listening to: {audio_source}</p>
+                <div class="presets_row">
+                    {preset_html}
+                </div>
+            </div>
+        """.format(
+            audio_source=get_setting("audio_source", "alsa"),
+            preset_html="\n".join(preset.render() for preset in self.MUSIC_PRESETS)
+        )
+        return out_html
+
     def render_udevelop_presets(self, request):
         """
         Renders the Under Development text.
@@ -412,12 +483,24 @@ class RaspiledControlResource(RaspberryPiWebResource):
         """
         return out_html
 
+    def render_GET(self, request):
+        """
+        Serves the request, logging how long after the process started the first one was served
+        """
+        output = RaspberryPiWebResource.render_GET(self, request)
+        if not self.first_request_served:
+            self.first_request_served = True
+            logger.info("[STARTUP] First request served %.3fs after the process started", monotonic() - PROCESS_STARTED)
+        return output
+
     # Actions: These are the actions our web server can initiate. Triggered by hitting the url with ?action_name=value ####
 
     def before_action(self, *args, **kwargs):
         """
         Called just before an action takes place. We stop whatever current sequence is running
         """
+        if args and args[0] in self.SEQUENCE_SAFE_ACTIONS:
+            return
         self.led_strip.stop_current_sequence()  # Stop current sequence
 
     def action__set(self, request):
@@ -538,10 +621,11 @@ class RaspiledControlResource(RaspberryPiWebResource):
         jump_colours = request.get_param_values("jump")
         seconds = request.get_param(["seconds", "s"], default=0.0, force=float)
         milliseconds = request.get_param(["milliseconds", "ms"], default=0.0, force=float)
+        start_at = self.synchronised_start(request)
         self.led_strip.stop_current_sequence()  # Terminate any crap that's going on
         total_seconds = (seconds + (milliseconds / 1000.0))
         logger.info("Jump: %s, %s seconds" % (jump_colours, total_seconds))
-        self.led_strip.jump(jump_colours, seconds=seconds, milliseconds=milliseconds)  # Has its own colour sanitisation routine
+        self.led_strip.jump(jump_colours, seconds=seconds, milliseconds=milliseconds, start_at=start_at)  # Has its own colour sanitisation routine
         return self.outcome(action="jump", successful=True, message="Running jump sequence: {} step duration {}ms",
                             message_args=[jump_colours, (seconds or 0 * 1000) or (milliseconds or 300)])
 
@@ -563,6 +647,18 @@ class RaspiledControlResource(RaspberryPiWebResource):
                 "validity": "<int> > 0",
                 "default": "0",
             },
+            {
+                "param": "sync",
+                "value": "Start in step with every other Raspiled on the network: they are all sent this sequence, to start at the same moment.",
+                "validity": "1",
+                "default": "",
+            },
+            {
+                "param": "start_at",
+                "value": "The shared time (Unix epoch seconds, see ?timesync) to start the sequence at, so several listeners stay in step.",
+                "validity": "<float>",
+                "default": "",
+            },
         ],
     }
 
@@ -573,10 +669,11 @@ class RaspiledControlResource(RaspberryPiWebResource):
         rotate_colours = request.get_param_values("rotate")
         seconds = request.get_param(["seconds", "s"], default=0.0, force=float)
         milliseconds = request.get_param(["milliseconds", "ms"], default=0.0, force=float)
+        start_at = self.synchronised_start(request)
         self.led_strip.stop_current_sequence()  # Terminate any crap that's going on
         total_seconds = (seconds + (milliseconds / 1000.0))
         logger.info("Rotate: %s, %s seconds" % (rotate_colours, total_seconds))
-        self.led_strip.rotate(rotate_colours, seconds=seconds, milliseconds=milliseconds)  # Has its own colour sanitisation routine
+        self.led_strip.rotate(rotate_colours, seconds=seconds, milliseconds=milliseconds, start_at=start_at)  # Has its own colour sanitisation routine
         return self.outcome(action="rotate", successful=True, message="Running colour rotation sequence: {} with fade time {}ms",
                             message_args=[rotate_colours, (seconds or 0 * 1000) or (milliseconds or 300)])
 
@@ -598,9 +695,53 @@ class RaspiledControlResource(RaspberryPiWebResource):
                 "validity": "<int> > 0",
                 "default": "0",
             },
+            {
+                "param": "sync",
+                "value": "Start in step with every other Raspiled on the network: they are all sent this sequence, to start at the same moment.",
+                "validity": "1",
+                "default": "",
+            },
+            {
+                "param": "start_at",
+                "value": "The shared time (Unix epoch seconds, see ?timesync) to start the sequence at, so several listeners stay in step.",
+                "validity": "<float>",
+                "default": "",
+            },
         ],
     }
 
+    def synchronised_start(self, request):
+        """
+        Works out when a sequence should start on the shared clock, if it is to run in step with other listeners.
+        With ?sync, picks a moment sync_lead_seconds from now and sends the same request, with that start_at, to every peer
+
+        @return: <float> shared time (epoch seconds) to start at, or None to start straight away on our own
+        """
+        start_at = request.get_param("start_at", default=None, force=float)
+        if start_at is None and request.has_param("sync"):
+            start_at = monotonic() + self.led_strip.shared_time_offset() + float(get_setting("sync_lead_seconds", 1.0))
+            self.forward_to_peers(request, start_at)
+        return start_at
+
+    def forward_to_peers(self, request, start_at):
+        """
+        Sends request's params on to every listener discovery has found, with start_at in place of sync
+        @return: <int> How many peers it was sent to
+        """
+        if self.discovery is None:
+            return 0
+        from twisted.web.client import Agent  # Only needed once we have peers
+        query = urlencode([(name, value) for name, values in request.params.items() if name not in ("sync", "start_at") for value in values] +
+                          [("start_at", repr(start_at))])
+        agent = Agent(reactor, connectTimeout=2)
+        peers = self.discovery.directory.peers()
+        for peer in peers:
+            url = "{}?{}".format(peer["url"], query)
+            agent.request(b"GET", url.encode("utf-8")).addErrback(
+                lambda failure, url=url: logger.warning("Sync: could not reach %s (%s)", url, failure.getErrorMessage()))
+        logger.info("Sync: starting at %.3f here and on %s peer(s)", start_at, len(peers))
+        return len(peers)
+
     def action__stop(self, request):
         """
         Stops the current sequence
@@ -628,6 +769,217 @@ class RaspiledControlResource(RaspberryPiWebResource):
         "value": "",
     }
 
+    def action__pixels(self, request):
+        """
+        Paints the addressable pixel strip with a gradient of the given colours, or a rainbow
+        """
+        if self.pixel_strip is None:
+            return self.outcome(action="pixels", successful=False, message="No pixel strip configured. Set pixel_count in raspiled.conf.")
+        pixel_colours = request.get_param_values("pixels") or []
+        offset = request.get_param("offset", default=0.0, force=float)
+        if ",".join(pixel_colours).strip().lower() in ("", "rainbow"):
+            self.pixel_strip.rainbow(offset=offset)
+        else:
+            self.pixel_strip.gradient(pixel_colours)
+        self.pixel_strip.show()
+        return self.outcome(action="pixels", successful=True, message="Painted {} pixels: {}", message_args=[len(self.pixel_strip), pixel_colours or "rainbow"])
+
+    action__pixels.capability = {
+        "param": "pixels",
+        "description": "Paints an addressable (WS281x / APA102) pixel strip with a gradient, or a rainbow.",
+        "value": "A comma delimited list of colours to spread along the strip, or 'rainbow'.",
+        "validity": "<unicode> valid colour names or hex values separated by commas (e.g. red,blue,green,cyan,#FF00FF)",
+        "optional_concurrent_parameters": [
+            {
+                "param": "offset",
+                "value": "How far round the colour wheel the first pixel of a rainbow starts (0-1).",
+                "validity": "<float> 0-1",
+                "default": "0",
+            },
+        ],
+    }
+
+    def action__circadian(self, request):
+        """
+        Follows the sun's colour temperature through the day
+        """
+        circadian = request.get_param("circadian", default="on", force=six.text_type).strip().lower()
+        if circadian in ("off", "0", "false", "no"):
+            return self.outcome(action="circadian", successful=True, message="Circadian colour temperature off")
+        self.led_strip.circadian(self.circadian_curve)
+        return self.outcome(action="circadian", successful=True, message="Following the sun's colour temperature: {}K now",
+                            message_args=[int(round(self.circadian_curve.kelvin_at()))])
+
+    action__circadian.capability = {
+        "param": "circadian",
+        "description": "Continuously sets the RGB strip to the colour temperature the sun outside would give: warm at night, cool at midday.",
+        "value": "on or off.",
+        "validity": "<unicode> on / off",
+        "default": "on",
+    }
+
+    def action__music(self, request):
+        """
+        Lights the strip to music
+        """
+        source_spec = request.get_param("music", default="", force=six.text_type).strip() or get_setting("audio_source", "alsa")
+        refusal = None if isinstance(request, OfflineRequest) else self.music_source_refusal(request, source_spec)  # Scheduled jobs were checked when scheduled
+        if refusal:
+            return self.outcome(action="music", successful=False, message="{}", message_args=[refusal])
+        try:
+            self.led_strip.music(source_spec, sample_rate=get_setting("audio_sample_rate", 44100), channels=get_setting("audio_channels", 1),
+                                 block_size=get_setting("audio_block_size", 1024))
+        except ImportError as e:
+            return self.outcome(action="music", successful=False, message="Music mode needs numpy ({})", message_args=[e])
+        except (ValueError, IOError, OSError) as e:
+            return self.outcome(action="music", successful=False, message="Cannot open audio source '{}': {}", message_args=[source_spec, e])
+        return self.outcome(action="music", successful=True, message="Lighting to the music from {}", message_args=[source_spec])
+
+    action__music.capability = {
+        "param": "music",
+        "description": "Lights the RGB strip to music: bass red, mids green, treble blue. Runs until another action stops it, or the audio ends.",
+        "value": "The audio source. Leave blank for the audio_source setting. Only whitelisted clients may choose another one.",
+        "validity": "<unicode> The audio_source setting, or for whitelisted clients alsa:<device> or the path of a 16 bit PCM .wav file",
+        "default": "alsa",
+    }
+
+    def music_source_refusal(self, request, source_spec):
+        """
+        Whether a web client may light the strip to source_spec. Anyone may use the configured audio_source, but
+        choosing another capture device or file is for whitelisted clients only, and stdin (-) and FIFOs are
+        never opened over the web.
+
+        @return: <unicode> Why not, or None if they may
+        """
+        if source_spec == six.text_type(get_setting("audio_source", "alsa")).strip():
+            return None
+        if source_spec == "-" or source_spec.startswith("fifo:"):
+            return "Audio source '{}' can only be set in the audio_source setting.".format(source_spec)
+        if not self.is_admin(request):
+            return "Only whitelisted clients may choose an audio source other than the audio_source setting."
+        return None
+
+    def action__schedule(self, request):
+        """
+        Schedules an action or preset to run later, once or repeatedly
+        """
+        if self.scheduler is None:
+            return self.outcome(action="schedule", successful=False, message="The scheduler isn't running.")
+        job_querystring = request.get_param("schedule", default="", force=six.text_type)
+        job_params = OrderedDict(parse_qsl(job_querystring, keep_blank_values=True))  # "off" and "stop" have no value
+        if not job_params:
+            return self.outcome(action="schedule", successful=False, message="Nothing to schedule. Supply an action querystring, e.g. schedule=preset%3Dsunrise30m")
+        job_actions = [action_name for key_name, action_name in self.PARAM_TO_ACTION_MAPPING if key_name in job_params]
+        if not job_actions or job_actions[0] in self.SEQUENCE_SAFE_ACTIONS:
+            return self.outcome(action="schedule", successful=False, message="'{}' does not trigger an action.", message_args=[job_querystring])
+        if "music" in job_params:
+            refusal = self.music_source_refusal(request, six.text_type(job_params["music"]).strip() or get_setting("audio_source", "alsa"))
+            if refusal:
+                return self.outcome(action="schedule", successful=False, message="{}", message_args=[refusal])
+        solar_event = request.get_param("solar_event", default=None, force=six.text_type)
+        if solar_event is not None and solar_event not in SOLAR_EVENTS:
+            return self.outcome(action="schedule", successful=False, message="Unknown solar event '{}'. Choose from: {}",
+                                message_args=[solar_event, ", ".join(SOLAR_EVENTS)])
+        at = request.get_param("at", default=None, force=six.text_type)
+        job = Job(
+            params=job_params,
+            when=parse_when(at) if at else None,
+            every=request.get_param("every", default=None, force=float),
+            daily=request.get_param("daily", default=None, force=six.text_type),
+            weekdays=request.get_param("days", default=None, force=six.text_type),
+            solar=solar_event,
+            offset=request.get_param("offset", default=0.0, force=float),
+            label=request.get_param("label", default="", force=six.text_type),
+        )
+        if not job.recurring and job.when is None:
+            return self.outcome(action="schedule", successful=False, message="Say when to run it, with at, daily, every or solar_event.")
+        if self.scheduler.add(job) is None:
+            return self.outcome(action="schedule", successful=False, message="{} would never run.", message_args=[job])
+        return self.outcome(action="schedule", successful=True, message="Scheduled {} for {}", message_args=[job, job.report()["next_run"]])
+
+    action__schedule.capability = {
+        "param": "schedule",
+        "description": "Runs an action or preset later: once, daily at a set time, every n seconds, or at a solar event like sunrise.",
+        "value": "The urlencoded querystring of the action to run, e.g. 'preset%3Dsunrise30m' or 'sunrise%3D1800'.",
+        "validity": "<unicode> A querystring that triggers an action.",
+        "optional_concurrent_parameters": [
+            {
+                "param": "at",
+                "value": "When to run it once: a unix timestamp, 'YYYY-MM-DD HH:MM', or 'HH:MM' for the next time that comes round.",
+                "validity": "<unicode>",
+            },
+            {
+                "param": "daily",
+                "value": "Run it every day at this local time.",
+                "validity": "<unicode> HH:MM",
+            },
+            {
+                "param": "days",
+                "value": "Only run daily or solar jobs on these days.",
+                "validity": "<unicode> e.g. mon,wed,fri or mon-fri or weekends",
+                "default": "Every day",
+            },
+            {
+                "param": "every",
+                "value": "Run it repeatedly, this many seconds apart.",
+                "validity": "<float> > 0",
+            },
+            {
+                "param": "solar_event",
+                "value": "Run it every day at this solar event at your latitude / longitude.",
+                "validity": "<unicode> One of: {}".format(", ".join(SOLAR_EVENTS)),
+            },
+            {
+                "param": "offset",
+                "value": "Seconds after (or before, if negative) the solar event to run it.",
+                "validity": "<float>",
+                "default": "0",
+            },
+            {
+                "param": "label",
+                "value": "A name for the job.",
+                "validity": "<unicode>",
+            },
+        ],
+    }
+
+    def action__unschedule(self, request):
+        """
+        Removes a scheduled job
+        """
+        job_id = request.get_param("unschedule", default="", force=six.text_type)
+        job = self.scheduler.remove(job_id) if self.scheduler is not None else None
+        if job is None:
+            return self.outcome(action="unschedule", successful=False, message="No job with the id '{}'.", message_args=[job_id])
+        return self.outcome(action="unschedule", successful=True, message="Unscheduled {}", message_args=[job])
+
+    action__unschedule.capability = {
+        "param": "unschedule",
+        "description": "Removes a scheduled job.",
+        "value": "The job_id of the job to remove (see ?jobs).",
+        "validity": "<unicode> A job_id",
+    }
+
+    def action__loglevel(self, request):
+        """
+        Reports or changes how much goes in the log
+        """
+        level = request.get_param("loglevel", default="", force=six.text_type)
+        if not level.strip():
+            return self.outcome(action="loglevel", successful=True, message="Log level is {}", message_args=[get_level(logger)])
+        try:
+            level_name = set_level(logger, level)
+        except ValueError as e:
+            return self.outcome(action="loglevel", successful=False, message="{}", message_args=[e])
+        return self.outcome(action="loglevel", successful=True, message="Log level set to {}", message_args=[level_name])
+
+    action__loglevel.capability = {
+        "param": "loglevel",
+        "description": "Changes how much goes in the log, until the listener restarts. Leave blank to see the current level.",
+        "value": "The log level, e.g. debug.",
+        "validity": "<unicode> One of: {}".format(", ".join(LEVELS)),
+    }
+
     def action__preset(self, request):
         """
         Runs a named preset based upon its slug
@@ -686,8 +1038,8 @@ class RaspiledControlResource(RaspberryPiWebResource):
         current_hex = self.led_strip.hex
         current_hsv = self.led_strip.hsv
         current_hs = current_hsv[:2]
-        current_kelvin = self.led_strip.kelvin
-        current_kelvin_readable = self.led_strip.kelvin_readable
+        current_kelvin = self.led_strip.kelvin_estimate
+        current_kelvin_readable = "{}K".format(current_kelvin) if current_kelvin is not None else ""
         contrast_colour_hex = self.led_strip.contrast_from_bg(current_hex, dark_default="202020")
         contrast_colour = contrast_colour_hex
         contrast_colour_rgb = self.led_strip.hex_to_rgb(contrast_colour)
@@ -704,14 +1056,251 @@ class RaspiledControlResource(RaspberryPiWebResource):
             "current_hsv": current_hsv,
             "current_hs": current_hs,
             "current_kelvin": current_kelvin,
-            "current_kelvin_readable": current_kelvin_readable
+            "current_kelvin_readable": current_kelvin_readable,
+            "current_colour_name": self.led_strip.colour_name,
+        }
+
+    def information__timesync(self, request, *args, **kwargs):
+        """
+        Reports the shared time, and how far our clock is from the leader's
+        """
+        if self.time_sync is None:
+            return {"timesync": False, "now": monotonic() + self.led_strip.shared_time_offset()}
+        report = self.time_sync.clock.report()
+        report["timesync"] = True
+        return report
+
+    information__timesync__capability = {
+        "param": "timesync",
+        "description": "Reports the shared time synchronised sequences run on, which listener we follow, and our offset from it.",
+        "value": "",
+        "returns": "<JSON> A JSON object with the shared time (epoch seconds), leader, offset and error (seconds)"
+    }
+
+    def information__fleet(self, request, *args, **kwargs):
+        """
+        Reports the latency and errors of every Raspberry Pi we are driving in fleet controller mode
+        """
+        hosts = self.led_strip.fleet_report()
+        return {
+            "fleet": bool(hosts),
+            "hosts": hosts,
+            "connected": len([host for host in hosts if host["connected"]]),
+            "total": len(hosts),
+        }
+
+    information__fleet__capability = {
+        "param": "fleet",
+        "description": "Reports the connection health, latency and errors of every Raspberry Pi in fleet controller mode.",
+        "value": "",
+        "returns": "<JSON> A JSON object with a list of hosts"
+    }
+
+    def information__connection(self, request, *args, **kwargs):
+        """
+        Reports whether we are connected to the pigpio daemon(s), or in degraded mode waiting to reconnect
+        """
+        hosts = self.led_strip.connection_report()
+        return {
+            "connected": bool(hosts) and all(host["connected"] for host in hosts),
+            "hosts": hosts,
+        }
+
+    information__connection__capability = {
+        "param": "connection",
+        "description": "Reports the health of the connection to the pigpio daemon, including reconnects and dropped frames.",
+        "value": "",
+        "returns": "<JSON> A JSON object with a list of hosts"
+    }
+
+    def information__solar(self, request, *args, **kwargs):
+        """
+        Reports today's solar events at the configured latitude and longitude, and what the server will do next
+        """
+        return {
+            "latitude": self.solar_schedule.latitude,
+            "longitude": self.solar_schedule.longitude,
+            "today": self.solar_schedule.today(),
+            "next_trigger": self.next_solar_job(),
+            "circadian_kelvin": int(round(self.circadian_curve.kelvin_at())),
         }
 
+    information__solar__capability = {
+        "param": "solar",
+        "description": "Reports today's sunrise, sunset and twilight times at your latitude / longitude, and the next scheduled sun sequence.",
+        "value": "",
+        "returns": "<JSON> A JSON object of local times (HH:MM:SS)"
+    }
+
+    def next_solar_job(self):
+        """
+        Reports the next job tied to the sun, if any
+        """
+        job = self.scheduler.next_job(solar_only=True) if self.scheduler is not None else None
+        return job.report() if job is not None else None
+
+    def information__jobs(self, request, *args, **kwargs):
+        """
+        Lists the scheduled jobs, soonest first
+        """
+        return {
+            "jobs": self.scheduler.report() if self.scheduler is not None else [],
+        }
+
+    information__jobs__capability = {
+        "param": "jobs",
+        "description": "Lists the scheduled jobs, soonest first.",
+        "value": "",
+        "returns": "<JSON> A JSON object with a list of jobs"
+    }
+
+    def resume_state(self):
+        """
+        Picks up whatever the strip was doing when the listener last stopped, including sequences at the right point
+        """
+        saved_state = self.state_snapshot.load()
+        if not saved_state:
+            return
+        unresumed_sequence = self.led_strip.restore_state(saved_state)
+        if unresumed_sequence == "circadian":
+            self.led_strip.circadian(self.circadian_curve)
+
+    def run_job(self, job):
+        """
+        Performs a scheduled job's action, exactly as though its params had come in over the web
+        """
+        return self.run_action(OfflineRequest(job.params))
+
+    def setup_scheduler(self, reactor):
+        """
+        Starts the job scheduler: reloads saved jobs and adds the sunrise / sunset jobs from the config,
+        so they happen without a browser open
+        """
+        jobs_path = os.path.join(RASPILED_DIR, get_setting("jobs_file", "raspiled_jobs.json"))
+        self.scheduler = JobScheduler(reactor, self.run_job, jobs_path=jobs_path, solar_schedule=self.solar_schedule,
+                                      catch_up_seconds=get_setting("scheduler_catch_up_seconds", 3600))
+        self.scheduler.load()
+        sunrise_seconds = get_setting("solar_sunrise", 0)
+        sunset_seconds = get_setting("solar_sunset", 0)
+        if sunrise_seconds:  # Finishes at the real sunrise
+            self.scheduler.add(Job({"sunrise": sunrise_seconds}, solar="sunrise", offset=-sunrise_seconds, label="{}s sunrise".format(sunrise_seconds),
+                                   job_id="solar_sunrise", persist=False))
+        if sunset_seconds:
+            self.scheduler.add(Job({"sunset": sunset_seconds}, solar="sunset", label="{}s sunset".format(sunset_seconds),
+                                   job_id="solar_sunset", persist=False))
+        if get_setting("circadian", 0):
+            self.led_strip.circadian(self.circadian_curve)
+
+    def whoami(self):
+        """
+        Our device descriptor, plus where to ask us the time
+        """
+        whoami = RaspberryPiWebResource.whoami(self)
+        if self.time_sync is not None and self.time_sync.port is not None:
+            whoami.setdefault("timesync_port", self.time_sync.port.getHost().port)
+        return whoami
+
+    def choose_time_leader(self):
+        """
+        The listener whose clock we all follow: timesync_leader if it's set, otherwise the one with the lowest USN discovery has found
+        @return: (<unicode> host, <int> port), or None if it's us
+        """
+        configured = get_setting("timesync_leader", "")
+        if configured:
+            host, _sep, port = six.text_type(configured).partition(":")
+            return host, int(port or get_setting("timesync_port", 9091))
+        if self.discovery is None:
+            return None
+        candidates = [(self.whoami()["usn"], None)]
+        for peer in self.discovery.directory.peers():
+            descriptor = peer["descriptor"] or {}
+            if descriptor.get("timesync_port"):
+                candidates.append((peer["usn"], (urlsplit(peer["location"]).hostname, int(descriptor["timesync_port"]))))
+        return min(candidates)[1]
+
+    def setup_timesync(self, reactor):
+        """
+        Starts answering time requests and following the leader's clock, so synchronised sequences stay in step
+        """
+        self.time_sync = TimeSync(reactor, self.choose_time_leader)
+        if self.time_sync.start(get_setting("timesync_port", 9091)):
+            self.led_strip.shared_clock = self.time_sync.clock
+        else:
+            self.time_sync = None
+
+    def describe_strips(self):
+        """
+        Describes our RGB strip, and pixel strip if we have one, for whoami()
+        """
+        strips = [{
+            "type": "rgb",
+            "pins": {"red": self.led_strip._red_pin, "green": self.led_strip._green_pin, "blue": self.led_strip._blue_pin},
+            "fleet": len(self.led_strip.fleet_report()),
+        }]
+        if self.pixel_strip is not None:
+            strips.append({"type": self.pixel_strip.pixel_type, "pixels": self.pixel_strip.count})
+        return strips
+
+    def check_settings(self, settings, changed):
+        """
+        Checks the changed settings we can only check by using them, before apply_settings() touches anything
+        @raise ValueError: If one of them is no good
+        """
+        if "fade_interpolation" in changed:
+            clean_interpolation(settings["fade_interpolation"])
+        if "log_level" in changed and "{}".format(settings["log_level"]).strip().upper() not in LEVELS:
+            raise ValueError("Unknown log level '{}'. Choose from: {}".format(settings["log_level"], ", ".join(LEVELS)))
+
+    def apply_settings(self, settings, changed):
+        """
+        Applies changed settings (from the config file) to the strip, the sun and everything else that's running
+
+        Anything that could still fail (building the new rate limiter, the strip's own checks) happens before the
+        strip is touched, so a ValueError leaves everything as it was.
+
+        @param settings: {<unicode> name: value} The new config, already checked by check_settings()
+        @param changed: [<unicode> name, ] Which settings have changed
+        @raise ValueError: If they cannot be applied. Nothing has changed
+        """
+        changed = set(changed)
+        rate_limiter = self.rate_limiter
+        if changed.intersection(("rate_limit_per_second", "rate_limit_burst")):
+            rate_limiter = TokenBucketLimiter(settings["rate_limit_per_second"], settings["rate_limit_burst"])
+        self.led_strip.apply_settings(settings, changed)  # Between two frames, so the lights don't flicker. Checks before it changes anything
+        self.rate_limiter = rate_limiter
+        if changed.intersection(("latitude", "longitude")):
+            self.solar_schedule.move_to(settings["latitude"], settings["longitude"])
+            if self.scheduler is not None:
+                self.scheduler.reschedule_solar()
+        if changed.intersection(("latitude", "longitude", "circadian_day_kelvin", "circadian_night_kelvin")):
+            self.circadian_curve.update(day_kelvin=settings.get("circadian_day_kelvin"), night_kelvin=settings.get("circadian_night_kelvin"))
+        if "log_level" in changed:
+            set_level(logger, settings["log_level"])
+        if changed.intersection(("pi_port", "red_pin", "green_pin", "blue_pin")):
+            self._cached_whoami = None  # Our port and pins are in it
+            if self.discovery is not None:  # Tell the other listeners about the new us
+                discovery_reactor = self.discovery.reactor
+                self.stop_broadcasting()
+                self.setup_broadcasting(discovery_reactor)
+
+    def is_admin(self, request):
+        """
+        Admins are the clients listed in the whitelist
+        """
+        return checkClientAgainstWhitelist(request.getClientAddress().host, None, request.get_param("token"))
+
     def teardown(self):
         """
         Called automatically when exiting the parent reactor
         """
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.stop_broadcasting()
+        if self.time_sync is not None:
+            self.time_sync.stop()
         self.led_strip.teardown()
+        if self.pixel_strip is not None:
+            self.pixel_strip.teardown()
 
 
 class NotSet:
@@ -726,29 +1315,36 @@ class NotSet:
 NOT_SET = NotSet()
 
 
-class SmartRequest(Request, object):
+class SmartRequestMixin(object):
     """
-    The class for request objects returned by our web server.
-        This child version has methods for easily grabbing params safely.
-    
-        Usage:
-            #If you just want the first value
-            sunset = request["sunset"]
-            sunset = request.get_param("sunset")
-            
-            #You can even test the water with multiple values, it will stop at the first valid one
-            sunset = request.get_param(["sunset","ss","twilight"])
-            
-            #If you want a whole list of values
-            jump = request.get_list("jump")
-
-    See docs: https://twistedmatrix.com/documents/8.0.0/api/twisted.web.server.Request.html
+    Methods for easily grabbing params safely. Needs self.args: {<bytes> name: [<bytes> value, ]}
 
+        The args are decoded into text once, the first time any param is asked for (see self.params)
     """
     replacement_params = None
+    _decoded_params = None
 
-    def __init__(self, *args, **kwargs):
-        super(SmartRequest, self).__init__(*args, **kwargs)
+    @property
+    def params(self):
+        """
+        The request's params decoded into text, worked out on first use then kept
+
+        @return: read-only {<unicode> name: (<unicode> value, )}
+        """
+        if self._decoded_params is None:
+            self._decoded_params = MappingProxyType(dict(
+                (six.ensure_text(name, encoding="utf-8"), tuple(six.ensure_text(value, encoding="utf-8") for value in values))
+                for name, values in self.args.items()
+            ))
+        return self._decoded_params
+
+    def param_names(self):
+        """
+        @return: [<unicode>, ] The names of every param supplied, including replacements
+        """
+        if self.replacement_params is None:
+            return list(self.params)
+        return list(self.replacement_params) + [name for name in self.params if name not in self.replacement_params]
 
     def get_param_values(self, name, default=None):
         """
@@ -759,22 +1355,20 @@ class SmartRequest(Request, object):
         
         @return: ["val1","val2"] LIST of arguments, or the default
         """
+        if isinstance(name, six.binary_type):
+            name = name.decode("utf-8")
         if self.replacement_params is not None:
             try:
-                out = self.replacement_params[six.ensure_text(name, encoding="utf-8")]
+                out = self.replacement_params[name]
                 return out
             except (TypeError, IndexError) as e:
                 logger.warning("{}: {}", e.__class__.__name__, e)
             except KeyError:
                 pass
-        found_items_bytes = self.args.get(six.ensure_binary(name, encoding="utf-8"), NOT_SET)
-        if found_items_bytes is NOT_SET:
+        try:
+            return list(self.params[name])
+        except KeyError:
             return default
-        found_items_unicode = []
-        for item_bytes in found_items_bytes:
-            item_unicode = six.ensure_text(item_bytes, encoding="utf-8")
-            found_items_unicode.append(item_unicode)
-        return found_items_unicode
 
     get_params = get_param_values  # Alias
     get_list = get_param_values  # Alias
@@ -821,13 +1415,15 @@ class SmartRequest(Request, object):
         Returns True or the value if any of the param names given by args exist
         """
         for param_name in param_names:
+            if isinstance(param_name, six.binary_type):
+                param_name = param_name.decode("utf-8")
             if self.replacement_params is not None:
                 try:
                     return self.replacement_params[param_name]
                 except (KeyError, IndexError, TypeError):
                     pass
             try:
-                return self.args[six.ensure_binary(param_name, encoding="utf-8")] or True
+                return list(self.params[param_name]) or True
             except KeyError:
                 pass
         return False
@@ -870,16 +1466,106 @@ class SmartRequest(Request, object):
         return self.get_param(name)
 
 
+class SmartRequest(SmartRequestMixin, Request):
+    """
+    The class for request objects returned by our web server.
+        This child version has methods for easily grabbing params safely.
+    
+        Usage:
+            #If you just want the first value
+            sunset = request["sunset"]
+            sunset = request.get_param("sunset")
+            
+            #You can even test the water with multiple values, it will stop at the first valid one
+            sunset = request.get_param(["sunset","ss","twilight"])
+            
+            #If you want a whole list of values
+            jump = request.get_list("jump")
+
+    See docs: https://twistedmatrix.com/documents/8.0.0/api/twisted.web.server.Request.html
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SmartRequest, self).__init__(*args, **kwargs)
+
+
+class OfflineRequest(SmartRequestMixin):
+    """
+    Carries params into actions that weren't triggered over the web (e.g. scheduled jobs).
+        As far as the actions are concerned it behaves just like a SmartRequest.
+
+        Usage:
+            resource.run_action(OfflineRequest({"sunrise": 1800}))
+    """
+
+    def __init__(self, params=None):
+        self.args = {}
+        for name, values in (params or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            self.args[six.ensure_binary(name, encoding="utf-8")] = [six.ensure_binary(six.text_type(value), encoding="utf-8") for value in values]
+
+
 class RaspiledControlSite(Site, object):
     """
     Site thread which initialises the RaspiledControlResource properly
     """
     ip_address = None
+    listening_port = None  # <IListeningPort> The port our web server is listening on
+    config_watcher = None  # <config_watcher.ConfigWatcher> Applies changes to raspiled.conf while we run
 
     def __init__(self, *args, **kwargs):
         resource = kwargs.pop("resource", RaspiledControlResource())
         super(RaspiledControlSite, self).__init__(resource=resource, requestFactory=SmartRequest, *args, **kwargs)
 
+    def listen(self, reactor, port):
+        """
+        Starts the web server listening on port. If it was already listening on another port, that one is only
+        closed once the new one is open, so there's never a moment nothing answers. Open connections carry on
+        @raise CannotListenError: If we cannot listen on port. We're still listening on the old one
+        """
+        new_port = reactor.listenTCP(port, self)
+        self.switch_port(new_port)
+        return new_port
+
+    def switch_port(self, new_port):
+        """
+        Makes new_port (already listening) the one we serve on, and stops listening on the old one
+        """
+        old_port, self.listening_port = self.listening_port, new_port
+        if old_port is not None:
+            old_port.stopListening()
+
+    def setup_config_watcher(self, reactor):
+        """
+        Starts watching raspiled.conf, so changes to it are applied without a restart
+        """
+        self.config_watcher = ConfigWatcher(reactor, config_path, RESOLVED_USER_SETTINGS, functools.partial(self.apply_settings, reactor))
+        self.config_watcher.start()
+
+    def apply_settings(self, reactor, settings, changed):
+        """
+        Applies the changed settings to the running listener. Everything that could fail is tried before anything changes
+        @raise ValueError: If they cannot be applied. Nothing has changed
+        """
+        self.resource.check_settings(settings, changed)
+        new_port = None
+        if "pi_port" in changed and self.listening_port is not None:
+            try:
+                new_port = reactor.listenTCP(int(settings["pi_port"]), self)
+            except CannotListenError as e:
+                raise ValueError("Cannot listen on port {} ({})".format(settings["pi_port"], e))
+        try:
+            self.resource.apply_settings(settings, changed)
+        except Exception:
+            if new_port is not None:  # Back to just the old port
+                new_port.stopListening()
+            raise
+        if new_port is not None:
+            self.switch_port(new_port)
+            logger.info("Listening on port %s", settings["pi_port"])
+
     def buildProtocol(self, addr):
         self.ip_address = addr
         self.resource.ip_address = addr
@@ -888,87 +1574,67 @@ class RaspiledControlSite(Site, object):
     def setup_broadcasting(self, reactor):
         self.resource.setup_broadcasting(reactor)
 
+    def setup_scheduler(self, reactor):
+        self.resource.setup_scheduler(reactor)
+
+    def setup_timesync(self, reactor):
+        self.resource.setup_timesync(reactor)
+
     def stopFactory(self):
         """
         Called automatically when exiting the reactor. Here we tell the LEDstrip to tear down its resources
         """
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
         self.resource.teardown()
 
 
-def get_matching_pids(name, exclude_self=True):
-    """
-    Checks the process ID of the specified processes matching name, having excluded itself
-    
-        check_output(["pidof", str]) will return a space delimited list of all process ids
-        
-    @param name: <str> The process name to search for
-    @keyword exclude_self: <Bool> Whether to remove own ID from returned list (e.g. if searching for a python script!) 
-    
-    @return: <list [<str>,]> List of PIDs 
-    """
-    # Get all matching PIDs
-    try:
-        pids_str = check_output(["pidof", name])
-    except CalledProcessError:  # No matches
-        pids_str = ""
-    # Process string-list into python list
-    pids = pids_str.strip().split(" ")
-    # Remove self if required:
-    if exclude_self:
-        my_pid = str(os.getpid())  # Own PID - getpid() returns integer
-        try:
-            pids.remove(my_pid)  # Remove my PID string:
-        except ValueError:
-            pass
-    return pids
+WHITELIST = Whitelist(os.path.join(RASPILED_DIR, ".whitelist"))  # Loaded on first use, then whenever the file changes
 
 
 def checkClientAgainstWhitelist(ip, user, token):
-    IPS = {
-        'IP1': '127.0.0.1',
-    }
-
-    config_path = os.path.expanduser(RASPILED_DIR + '/.whitelist')
-    parser = configparser.ConfigParser(defaults=IPS)
-
-    if os.path.exists(config_path):
-        parser.read(config_path)
-    else:
-        with open(config_path, 'w') as f:
-            parser.write(f)
-
-    connection = False
-    whitelist = parser.defaults()
-    for ii in whitelist.keys():
-        if ip == whitelist[ii]:
-            logger.info('Client registered')
-            connection = True
-            break
-        else:
-            connection = False
+    """
+    Whether the client at ip is in the whitelist (./.whitelist, IP addresses or CIDR ranges)
+    user and token are not checked yet
+    """
+    connection = WHITELIST.allows(ip)
+    if connection:
+        logger.debug('Client registered')
     return connection
 
 
 def start_if_not_running():
     """
-    Checks if the process is running, if not, starts it!
+    Checks if the listener is already running (something answering on our web port), if not, starts it!
     """
-    pids = get_matching_pids(APP_NAME, exclude_self=True)  # Will remove own PID
-    pids = list(filter(bool, pids))
-    if not pids:  # No match! Implies we need to fire up the listener
-        logger.info("[STARTING] Raspiled Listener with PID %s" % str(os.getpid()))
-        # First the web
-        factory = RaspiledControlSite(timeout=8)  # 8s timeout
-        try:
-            pi_port = int(RESOLVED_USER_SETTINGS.get('pi_port', 9090))
-        except (TypeError, ValueError):
-            raise ConfigurationError("You have an invalid value for 'pi_port' in your settings. This needs to be a valid port number (integer).")
-        endpoint = endpoints.TCP4ServerEndpoint(reactor, pi_port)
-        endpoint.listen(factory)
-        # factory.setup_broadcasting(reactor)  # Uncomment to broadcast stuff over network!
-        reactor.run()
-    else:
-        logger.info("Raspiled Listener already running with PID %s" % ", ".join(pids))
+    if sys.stdin is not None and sys.stdin.isatty():
+        interactive_setup()  # Asks for pins and ports if there is no config file yet
+    try:
+        pi_port = int(RESOLVED_USER_SETTINGS.get('pi_port', 9090))
+    except (TypeError, ValueError):
+        raise ConfigurationError("You have an invalid value for 'pi_port' in your settings. This needs to be a valid port number (integer).")
+    if port_is_open("localhost", pi_port):
+        logger.info("Raspiled Listener (or something else) is already running on port %s", pi_port)
+        return
+    logger.info("[STARTING] Raspiled Listener with PID %s" % str(os.getpid()))
+    if not get_setting("fleet_hosts", "") and not get_setting("simulate", 0):
+        pigpiod_process(get_setting("pi_host", "localhost"), get_setting("pig_port", 8888))
+    # First the web
+    factory = RaspiledControlSite(timeout=8)  # 8s timeout
+    try:
+        factory.listen(reactor, pi_port)
+    except CannotListenError as e:
+        logger.error("[STARTUP] Cannot listen on port %s (%s)", pi_port, e)
+        return
+    logger.info("[STARTUP] Listening on port %s %.3fs after the process started", pi_port, monotonic() - PROCESS_STARTED)
+    factory.setup_scheduler(reactor)
+    if get_setting("timesync", 1):
+        factory.setup_timesync(reactor)  # Before discovery, so our descriptor says where to ask us the time
+    if get_setting("discovery", 1):
+        factory.setup_broadcasting(reactor)  # Finds the other Raspiled listeners on the network
+    if get_setting("config_reload", 1):
+        factory.setup_config_watcher(reactor)  # Applies edits to raspiled.conf as they're saved
+    reactor.run()
 
 
 if __name__ == "__main__":
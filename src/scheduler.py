@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Job scheduler
+
+        Runs actions and presets at set times without a browser open: one-off alarms, daily alarms
+        (optionally only on some weekdays), repeating jobs and jobs tied to the sun (e.g. 30 minutes
+        before sunrise).
+
+        Jobs sit in a min-heap ordered by when they are next due, and a single reactor.callLater
+        tracks the head of the heap. Jobs are saved to disk atomically whenever they change and
+        reloaded at startup, when anything missed while we were down is caught up.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import datetime
+import heapq
+import itertools
+import time
+import uuid
+
+import six
+
+from src.config import logger
+from state import read_json, write_json_atomically
+
+
+CATCH_UP_SECONDS = 3600  # At startup, run jobs we missed by up to this long. Older ones are skipped.
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def parse_weekdays(days):
+    """
+    Converts "mon,wed,fri", "mon-fri", "weekdays" or "weekends" into a sorted list of weekday numbers (Monday = 0)
+
+    @return: [<int>, ] or None for every day
+    """
+    if days is None or days == "":
+        return None
+    if not isinstance(days, (six.text_type, six.binary_type)):
+        return sorted(set(int(day) for day in days))
+    days = six.ensure_text(days, "utf-8").strip().lower()
+    if days in ("all", "daily", "everyday"):
+        return None
+    if days == "weekdays":
+        days = "mon-fri"
+    elif days == "weekends":
+        days = "sat-sun"
+    out_days = set()
+    for day_range in days.split(","):
+        start, _sep, end = day_range.strip().partition("-")
+        try:
+            first = WEEKDAYS.index(start[:3])
+            last = WEEKDAYS.index(end[:3]) if end else first
+        except ValueError:
+            raise ValueError("Unknown weekday in '{}'. Use mon, tue, wed, thu, fri, sat, sun".format(days))
+        day = first
+        out_days.add(day)
+        while day != last:
+            day = (day + 1) % 7
+            out_days.add(day)
+    return sorted(out_days)
+
+
+def parse_clock_time(clock_time):
+    """
+    "07:30" -> (7, 30)
+    """
+    hours, _sep, minutes = six.text_type(clock_time).strip().partition(":")
+    hours, minutes = int(hours), int(minutes or 0)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError("'{}' is not a valid time of day (HH:MM)".format(clock_time))
+    return hours, minutes
+
+
+def parse_when(when, now=None):
+    """
+    Converts a unix timestamp, "YYYY-MM-DD HH:MM" or "HH:MM" (the next time that local time comes round) into a timestamp
+    """
+    now = time.time() if now is None else now
+    when = six.text_type(when).strip()
+    try:
+        return float(when)
+    except ValueError:
+        pass
+    for date_format in ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return time.mktime(datetime.datetime.strptime(when, date_format).timetuple())
+        except ValueError:
+            pass
+    hours, minutes = parse_clock_time(when)
+    today = datetime.date.fromtimestamp(now)
+    due = time.mktime(datetime.datetime(today.year, today.month, today.day, hours, minutes).timetuple())
+    if due <= now:
+        tomorrow = today + datetime.timedelta(days=1)
+        due = time.mktime(datetime.datetime(tomorrow.year, tomorrow.month, tomorrow.day, hours, minutes).timetuple())
+    return due
+
+
+def clean_job_params(params):
+    """
+    Normalises job params into a {<unicode>: <unicode>} dict
+    """
+    out_params = {}
+    for key, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            value = ",".join(six.text_type(item) for item in value)
+        out_params[six.text_type(key)] = six.text_type(value)
+    return out_params
+
+
+@six.python_2_unicode_compatible
+class Job(object):
+    """
+    An action (or preset) to run at some point, and optionally again and again
+    """
+
+    def __init__(self, params, when=None, every=None, daily=None, weekdays=None, solar=None, offset=0.0,
+                 label="", job_id=None, persist=True):
+        """
+        @param params: {<unicode> param: <unicode> value} the querystring the job sends to the listener, e.g. {"preset": "sunrise30m"}
+        @keyword when: <float> timestamp the job is next due. Worked out from the repeat rules if not given
+        @keyword every: <float> repeat every this many seconds
+        @keyword daily: <unicode> "HH:MM" repeat at this local time each day...
+        @keyword weekdays: [<int>, ] ...but only on these days (Monday = 0)
+        @keyword solar: <unicode> repeat at this solar event each day (see solar.SOLAR_EVENTS)...
+        @keyword offset: <float> ...this many seconds after (or before, if negative) the event
+        @keyword persist: <Bool> Whether to save the job to disk (False for jobs generated from the config)
+        """
+        self.params = clean_job_params(params)
+        self.when = None if when is None else float(when)
+        self.every = float(every) if every else None
+        self.daily = daily or None
+        if self.daily:
+            parse_clock_time(self.daily)  # Validate
+        self.weekdays = parse_weekdays(weekdays)
+        self.solar = solar or None
+        self.offset = float(offset or 0.0)
+        self.label = label or ", ".join("{}={}".format(key, value) for key, value in self.params.items())
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.persist = persist
+
+    def __str__(self):
+        return "Job {} '{}'".format(self.job_id, self.label)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def recurring(self):
+        return bool(self.every or self.daily or self.solar)
+
+    def next_due(self, after, solar_schedule=None):
+        """
+        Returns when the job is next due after the given timestamp, or None if it will never run again
+        """
+        if self.every:
+            if self.when is None:
+                return after + self.every
+            if self.when > after:
+                return self.when
+            missed = int((after - self.when) // self.every) + 1
+            return self.when + missed * self.every
+        if self.daily:
+            hours, minutes = parse_clock_time(self.daily)
+            day = datetime.date.fromtimestamp(after)
+            for _day_offset in range(8):
+                if self.weekdays is None or day.weekday() in self.weekdays:
+                    due = time.mktime(datetime.datetime(day.year, day.month, day.day, hours, minutes).timetuple())  # Local time, so DST safe
+                    if due > after:
+                        return due
+                day += datetime.timedelta(days=1)
+            return None
+        if self.solar:
+            if solar_schedule is None:
+                return None
+            due = solar_schedule.next_event(self.solar, after=after, offset=self.offset)
+            # Skip days the job isn't wanted on
+            while due is not None and self.weekdays is not None and datetime.date.fromtimestamp(due).weekday() not in self.weekdays:
+                due = solar_schedule.next_event(self.solar, after=due + 1.0, offset=self.offset)
+            return due
+        return None  # One-off
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "label": self.label,
+            "params": dict(self.params),
+            "when": self.when,
+            "every": self.every,
+            "daily": self.daily,
+            "weekdays": self.weekdays,
+            "solar": self.solar,
+            "offset": self.offset,
+        }
+
+    @classmethod
+    def from_dict(cls, job_dict):
+        return cls(
+            params=job_dict["params"],
+            when=job_dict.get("when"),
+            every=job_dict.get("every"),
+            daily=job_dict.get("daily"),
+            weekdays=job_dict.get("weekdays"),
+            solar=job_dict.get("solar"),
+            offset=job_dict.get("offset", 0.0),
+            label=job_dict.get("label", ""),
+            job_id=job_dict.get("job_id"),
+        )
+
+    def report(self):
+        out = self.to_dict()
+        out["next_run"] = None if self.when is None else datetime.datetime.fromtimestamp(self.when).strftime("%Y-%m-%d %H:%M:%S")
+        out["weekdays"] = None if self.weekdays is None else [WEEKDAYS[day] for day in self.weekdays]
+        return out
+
+
+class JobScheduler(object):
+    """
+    A min-heap of jobs, driven by a single reactor.callLater for whichever is due next.
+
+        Cancelled and rescheduled jobs leave stale entries in the heap, which are skipped when they
+        reach the top, so adding and removing jobs is O(log n).
+    """
+
+    def __init__(self, reactor, run_job, jobs_path=None, solar_schedule=None, catch_up_seconds=CATCH_UP_SECONDS):
+        """
+        @param reactor: The twisted reactor
+        @param run_job: callable(<Job>) that actually performs the job's action
+        @keyword jobs_path: <unicode> The JSON file to persist jobs to. None = don't persist
+        @keyword solar_schedule: <solar.SolarSchedule> needed for jobs tied to the sun
+        @keyword catch_up_seconds: <float> At load, jobs missed by up to this long are run straight away
+        """
+        self.reactor = reactor
+        self.run_job = run_job
+        self.jobs_path = jobs_path
+        self.solar_schedule = solar_schedule
+        self.catch_up_seconds = catch_up_seconds
+        self.jobs = {}  # job_id : Job
+        self._heap = []  # [(when, tie breaker, job_id), ]
+        self._counter = itertools.count()
+        self._delayed_call = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, job, save=True):
+        """
+        Schedules a job (replacing any job with the same id)
+        @return: <Job> or None if the job will never be due
+        """
+        if job.when is None:
+            job.when = job.next_due(time.time(), self.solar_schedule)
+        if job.when is None:
+            logger.warning("Scheduler: %s is never due, ignoring it", job)
+            return None
+        self.jobs[job.job_id] = job
+        heapq.heappush(self._heap, (job.when, next(self._counter), job.job_id))
+        logger.info("Scheduler: %s due at %s", job, datetime.datetime.fromtimestamp(job.when))
+        if save and job.persist:
+            self.save()
+        self._arm()
+        return job
+
+    def remove(self, job_id):
+        """
+        Unschedules a job. Its heap entry goes stale and is skipped
+        @return: <Job> the removed job, or None if there was no such job
+        """
+        job = self.jobs.pop(job_id, None)
+        if job is not None:
+            if job.persist:
+                self.save()
+            self._arm()
+        return job
+
+    def _is_current(self, entry):
+        when, _tie_breaker, job_id = entry
+        job = self.jobs.get(job_id)
+        return job is not None and job.when == when
+
+    def _arm(self):
+        """
+        Points our single timer at the head of the heap
+        """
+        heap = self._heap
+        while heap and not self._is_current(heap[0]):
+            heapq.heappop(heap)
+        if not heap:
+            self.stop()
+            return
+        delay = max(heap[0][0] - time.time(), 0.0)
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.reset(delay)
+        else:
+            self._delayed_call = self.reactor.callLater(delay, self._fire)
+
+    def _run(self, job):
+        logger.info("Scheduler: running %s", job)
+        try:
+            self.run_job(job)
+        except Exception as e:
+            logger.exception(e)
+
+    def _fire(self):
+        """
+        Runs every job that is due, then reschedules the recurring ones
+        """
+        self._delayed_call = None
+        now = time.time()
+        changed = False
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._is_current(entry):
+                continue
+            job = self.jobs[entry[2]]
+            self._run(job)
+            changed = changed or job.persist
+            self._reschedule(job, after=max(now, job.when))
+        if changed:
+            self.save()
+        self._arm()
+
+    def _reschedule(self, job, after):
+        """
+        Moves a job that has just run onto its next due time, or drops it if it was a one-off
+        """
+        if self.jobs.get(job.job_id) is not job:  # The job unscheduled itself when it ran
+            return
+        job.when = job.next_due(after, self.solar_schedule)
+        if job.when is None:
+            del self.jobs[job.job_id]
+        else:
+            heapq.heappush(self._heap, (job.when, next(self._counter), job.job_id))
+
+    def reschedule_solar(self):
+        """
+        Works out the due times of every job tied to the sun again, e.g. after the solar schedule has moved
+        """
+        now = time.time()
+        for job in list(self.jobs.values()):
+            if not job.solar:
+                continue
+            job.when = job.next_due(now, self.solar_schedule)
+            if job.when is None:
+                logger.warning("Scheduler: %s is never due here, removing it", job)
+                del self.jobs[job.job_id]
+            else:
+                heapq.heappush(self._heap, (job.when, next(self._counter), job.job_id))
+        self.save()
+        self._arm()
+
+    def load(self):
+        """
+        Reloads persisted jobs. Runs any we missed (by up to catch_up_seconds) while we weren't running
+        """
+        job_dicts = read_json(self.jobs_path)
+        if not job_dicts:
+            return
+        now = time.time()
+        for job_dict in job_dicts:
+            try:
+                job = Job.from_dict(job_dict)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error("Scheduler: skipping invalid job %s (%s: %s)", job_dict, e.__class__.__name__, e)
+                continue
+            if job.when is not None and job.when <= now:
+                late = now - job.when
+                if late <= self.catch_up_seconds:
+                    logger.info("Scheduler: catching up %s, missed by %.0fs", job, late)
+                    self._run(job)
+                else:
+                    logger.info("Scheduler: skipping %s, missed by %.0fs", job, late)
+                if not job.recurring:
+                    continue
+                job.when = job.next_due(now, self.solar_schedule)
+            self.add(job, save=False)
+        self.save()
+
+    def save(self):
+        """
+        Writes the jobs to disk atomically: a half-written file can never replace a good one
+        """
+        if not self.jobs_path:
+            return
+        job_dicts = [job.to_dict() for job in sorted(self.jobs.values(), key=lambda job: job.when) if job.persist]
+        try:
+            write_json_atomically(self.jobs_path, job_dicts, indent=1)
+        except (IOError, OSError) as e:
+            logger.error("Scheduler: could not save jobs to %s (%s: %s)", self.jobs_path, e.__class__.__name__, e)
+
+    def next_job(self, solar_only=False):
+        """
+        Returns the next job due to run (optionally only those tied to the sun)
+        """
+        candidates = [job for job in self.jobs.values() if job.solar or not solar_only]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda job: job.when)
+
+    def stop(self):
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+    def report(self):
+        return [job.report() for job in sorted(self.jobs.values(), key=lambda job: job.when)]
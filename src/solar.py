@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Solar schedule
+
+        Works out when the sun rises and sets (plus the civil, nautical and astronomical twilights) at the
+        latitude and longitude in your config, so the server can run sunrises and sunsets by itself
+        without a browser tab staying open.
+
+        The astronomy (NOAA's sunrise equation) runs once per day and is cached. Everything that runs on
+        a timer, like the circadian colour temperature curve, only interpolates between the cached times.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_right
+import datetime
+import math
+import time
+
+from src.config import logger
+
+
+J2000 = 2451545.0  # Julian date of 2000-01-01 12:00 UTC
+UNIX_EPOCH_JULIAN = 2440587.5  # Julian date of 1970-01-01 00:00 UTC
+EARTH_TILT = 23.4397  # degrees
+
+# Angle of the centre of the sun below the horizon, in degrees, for each event
+SUN_ANGLES = (
+    ("astronomical_dawn", "astronomical_dusk", -18.0),
+    ("nautical_dawn", "nautical_dusk", -12.0),
+    ("civil_dawn", "civil_dusk", -6.0),
+    ("sunrise", "sunset", -0.833),  # Allows for refraction and the sun's radius
+)
+SOLAR_EVENTS = (
+    "astronomical_dawn", "nautical_dawn", "civil_dawn", "sunrise", "solar_noon",
+    "sunset", "civil_dusk", "nautical_dusk", "astronomical_dusk",
+)
+DAYS_TO_CACHE = 4  # Yesterday, today, tomorrow and the day after are all we ever need
+
+
+def julian_to_timestamp(julian_date):
+    return (julian_date - UNIX_EPOCH_JULIAN) * 86400.0
+
+
+def solar_transit(date, longitude):
+    """
+    Where the sun is at its highest on the given date, by NOAA's sunrise equation
+
+    @return: (<float> Julian date of solar noon, <float> sine of the sun's declination)
+    """
+    n = date.toordinal() - datetime.date(2000, 1, 1).toordinal() + 0.0008  # Days since J2000
+    mean_solar_noon = n - longitude / 360.0
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_noon) % 360.0)
+    centre = 1.9148 * math.sin(anomaly) + 0.0200 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic_longitude = math.radians((math.degrees(anomaly) + centre + 180.0 + 102.9372) % 360.0)
+    transit = J2000 + mean_solar_noon + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+    sin_declination = math.sin(ecliptic_longitude) * math.sin(math.radians(EARTH_TILT))
+    return transit, sin_declination
+
+
+def noon_elevation(date, latitude, longitude):
+    """
+    @return: <float> degrees above the horizon the sun gets to on the given date. Negative in polar night
+    """
+    _transit, sin_declination = solar_transit(date, longitude)
+    return 90.0 - abs(latitude - math.degrees(math.asin(sin_declination)))
+
+
+def calculate_solar_events(date, latitude, longitude):
+    """
+    Calculates the times of the sun's events on the given date, using NOAA's sunrise equation
+
+    @param date: <datetime.date> The (local) calendar day
+    @param latitude: <float> decimal degrees, north positive
+    @param longitude: <float> decimal degrees, east positive
+
+    @return: {<unicode> event name: <float> unix timestamp or None}. None means the sun never gets
+             that high / low that day (e.g. midsummer in the Arctic)
+    """
+    transit, sin_declination = solar_transit(date, longitude)
+    cos_declination = math.cos(math.asin(sin_declination))
+    phi = math.radians(latitude)
+
+    events = {"solar_noon": julian_to_timestamp(transit)}
+    for morning_name, evening_name, angle in SUN_ANGLES:
+        cos_hour_angle = (math.sin(math.radians(angle)) - math.sin(phi) * sin_declination) / (math.cos(phi) * cos_declination)
+        if -1.0 <= cos_hour_angle <= 1.0:
+            half_day = math.degrees(math.acos(cos_hour_angle)) / 360.0
+            events[morning_name] = julian_to_timestamp(transit - half_day)
+            events[evening_name] = julian_to_timestamp(transit + half_day)
+        else:
+            events[morning_name] = None
+            events[evening_name] = None
+    return events
+
+
+class SolarSchedule(object):
+    """
+    The sun's timetable for one place, calculated once per day and cached
+    """
+
+    def __init__(self, latitude, longitude):
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self._days = {}  # date : events dict
+
+    def move_to(self, latitude, longitude):
+        """
+        Changes where we are. The cached days were for the old place, so they are forgotten
+        """
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self._days = {}
+
+    def events_for(self, date):
+        """
+        Returns the cached events for a local calendar date, calculating them the first time
+        """
+        try:
+            return self._days[date]
+        except KeyError:
+            pass
+        events = calculate_solar_events(date, self.latitude, self.longitude)
+        if len(self._days) >= DAYS_TO_CACHE:
+            del self._days[min(self._days)]
+        self._days[date] = events
+        logger.info("Solar: %s at %s,%s: sunrise %s, sunset %s", date, self.latitude, self.longitude,
+                    self.format_time(events["sunrise"]), self.format_time(events["sunset"]))
+        return events
+
+    def events_around(self, timestamp):
+        """
+        Events for the day before, the day of and the day after timestamp, as a sorted [(timestamp, name), ]
+        """
+        today = datetime.date.fromtimestamp(timestamp)
+        out_events = []
+        for day_offset in (-1, 0, 1):
+            events = self.events_for(today + datetime.timedelta(days=day_offset))
+            out_events.extend((event_time, name) for name, event_time in events.items() if event_time is not None)
+        out_events.sort()
+        return out_events
+
+    def next_event(self, name, after=None, offset=0.0):
+        """
+        Returns the timestamp of the next time event name (+ offset seconds) happens after the given time
+        @return: <float> timestamp or None if the event doesn't happen in the next couple of days
+        """
+        after = time.time() if after is None else after
+        for event_time, event_name in self.events_around(after):
+            if event_name == name and event_time + offset > after:
+                return event_time + offset
+        # Further ahead than our window (e.g. just after today's), try the day after tomorrow
+        events = self.events_for(datetime.date.fromtimestamp(after) + datetime.timedelta(days=2))
+        if events.get(name) is not None and events[name] + offset > after:
+            return events[name] + offset
+        return None
+
+    def today(self, now=None):
+        """
+        Today's events, as {name: "HH:MM:SS" local time}, for reporting
+        """
+        now = time.time() if now is None else now
+        events = self.events_for(datetime.date.fromtimestamp(now))
+        return dict((name, self.format_time(events.get(name))) for name in SOLAR_EVENTS)
+
+    @classmethod
+    def format_time(cls, timestamp):
+        if timestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M:%S")
+
+
+class CircadianCurve(object):
+    """
+    A colour temperature that follows the sun: warm at night, cool at midday.
+
+        Each day's curve is a handful of (time, Kelvin) points built from the cached solar events, so
+        kelvin_at() is just a binary search and a linear blend.
+    """
+
+    def __init__(self, solar_schedule, day_kelvin=6500, night_kelvin=2000, twilight_kelvin=2700):
+        self.solar_schedule = solar_schedule
+        self.day_kelvin = float(day_kelvin)
+        self.night_kelvin = float(night_kelvin)
+        self.twilight_kelvin = float(twilight_kelvin)
+        self._curves = {}  # date : ([times], [kelvins])
+
+    def update(self, day_kelvin=None, night_kelvin=None):
+        """
+        Changes the colour temperatures, and forgets the days' curves so they are rebuilt (also needed after the
+        solar schedule has moved)
+        """
+        if day_kelvin is not None:
+            self.day_kelvin = float(day_kelvin)
+        if night_kelvin is not None:
+            self.night_kelvin = float(night_kelvin)
+        self._curves = {}
+
+    def curve_for(self, date):
+        try:
+            return self._curves[date]
+        except KeyError:
+            pass
+        events = self.solar_schedule.events_for(date)
+        midnight = time.mktime(date.timetuple())
+        points = [(midnight, self.night_kelvin)]
+        for name, kelvin in (("civil_dawn", self.night_kelvin), ("sunrise", self.twilight_kelvin),
+                             ("solar_noon", self.day_kelvin),
+                             ("sunset", self.twilight_kelvin), ("civil_dusk", self.night_kelvin)):
+            if events.get(name) is not None:
+                points.append((events[name], kelvin))
+        if events.get("sunrise") is None and events.get("civil_dawn") is None:  # Polar day or night: hold one value
+            polar_day = noon_elevation(date, self.solar_schedule.latitude, self.solar_schedule.longitude) > 0
+            elevation_kelvin = self.day_kelvin if polar_day else self.night_kelvin
+            points = [(midnight, elevation_kelvin)]
+        points.append((midnight + 86400.0, points[-1][1] if len(points) == 1 else self.night_kelvin))
+        points.sort()
+        curve = ([point[0] for point in points], [point[1] for point in points])
+        if len(self._curves) >= DAYS_TO_CACHE:
+            del self._curves[min(self._curves)]
+        self._curves[date] = curve
+        return curve
+
+    def kelvin_at(self, timestamp=None):
+        """
+        The colour temperature (Kelvin) the curve specifies at timestamp
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        times, kelvins = self.curve_for(datetime.date.fromtimestamp(timestamp))
+        index = bisect_right(times, timestamp) - 1
+        if index < 0:
+            return kelvins[0]
+        if index >= len(times) - 1:
+            return kelvins[-1]
+        blend = (timestamp - times[index]) / ((times[index + 1] - times[index]) or 1.0)
+        return kelvins[index] + (kelvins[index + 1] - kelvins[index]) * blend
+
+    __call__ = kelvin_at
+
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - State snapshots
+
+        Saves what the strip is doing (colour, colour temperature, calibration and any running sequence
+        with its start time) so a restarted listener can pick up exactly where it left off.
+
+        Writes are throttled: a burst of changes produces one write, shortly after the first of them.
+        Every write goes to a temporary file which then replaces the snapshot, so a power cut mid-write
+        can never leave a corrupt snapshot behind.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from src.config import logger
+
+
+SNAPSHOT_DELAY_SECONDS = 1.0  # How long to gather changes before writing them out
+replace_file = getattr(os, "replace", os.rename)  # Atomic on POSIX
+
+
+def write_json_atomically(path, data, indent=None):
+    """
+    Writes data to path as JSON, via a temporary file in the same directory that then replaces path
+
+    @raise IOError / OSError: If the file cannot be written. path is left untouched.
+    """
+    target_dir = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(prefix=".{}-".format(os.path.basename(path)), suffix=".tmp", dir=target_dir)
+    try:
+        with os.fdopen(file_descriptor, "w") as temp_file:
+            json.dump(data, temp_file, indent=indent)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        replace_file(temp_path, path)
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_json(path, default=None):
+    """
+    Reads a JSON file, returning default if it is missing or unreadable
+    """
+    if not path or not os.path.exists(path):
+        return default
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError) as e:
+        logger.error("Could not read %s (%s: %s)", path, e.__class__.__name__, e)
+        return default
+
+
+class StateSnapshot(object):
+    """
+    Keeps a snapshot file up to date with the state returned by get_state()
+
+        Call changed() whenever the state changes. It's cheap enough to call on every frame: the state
+        is only gathered and written once per delay_seconds, from a background timer.
+    """
+
+    def __init__(self, path, get_state, delay_seconds=SNAPSHOT_DELAY_SECONDS):
+        """
+        @param path: <unicode> The JSON file to keep the snapshot in
+        @param get_state: callable() returning a JSON serialisable dict of the current state
+        @keyword delay_seconds: <float> How long to gather changes before writing them out
+        """
+        self.path = path
+        self.get_state = get_state
+        self.delay_seconds = delay_seconds
+        self.writes = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def changed(self):
+        """
+        Marks the state as changed, so it gets written out shortly. Never blocks on the disk
+        """
+        if self._timer is not None:  # A write is already on its way, and will pick this change up
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Writes the current state out now
+        """
+        with self._lock:
+            timer = self._timer
+            self._timer = None
+            if timer is not None and timer is not threading.current_thread():
+                timer.cancel()
+        state = self.get_state()
+        state["saved"] = time.time()
+        try:
+            write_json_atomically(self.path, state)
+        except (IOError, OSError) as e:
+            logger.error("State: could not save snapshot to %s (%s: %s)", self.path, e.__class__.__name__, e)
+            return False
+        self.writes += 1
+        return True
+
+    def load(self):
+        """
+        Returns the last saved state, or None
+        """
+        return read_json(self.path)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Keyframe timelines
+
+        A sequence (rotate, jump, sunrise, sunset...) is described as a list of keyframes: a colour at a
+        point in time, plus an easing curve for how to get from that keyframe to the next. A Timeline
+        compiles these once into sorted arrays, after which colour_at(t) finds the current segment by
+        binary search (O(log n)) and eases between its two ends. The frame loop just asks "what colour
+        should it be at t?" and never has to track where it is up to.
+
+        With interpolation="oklab" each segment blends through a perceptual transition table (see
+        transitions.py), compiled along with the timeline, instead of straight through RGB.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_right
+import math
+
+import six
+
+from transitions import clean_interpolation, colour_in_table, transition_table
+
+
+def ease_linear(x):
+    return x
+
+
+def ease_step(x):
+    """
+    Holds the keyframe's colour until the next keyframe, then jumps
+    """
+    return 0.0
+
+
+def ease_in(x):
+    return x * x
+
+
+def ease_out(x):
+    return x * (2.0 - x)
+
+
+def ease_in_out(x):
+    return x * x * (3.0 - 2.0 * x)  # Smoothstep
+
+
+EASINGS = {
+    "linear": ease_linear,
+    "step": ease_step,
+    "hold": ease_step,
+    "ease_in": ease_in,
+    "ease_out": ease_out,
+    "ease_in_out": ease_in_out,
+}
+
+
+class Keyframe(object):
+    """
+    A colour at a moment in time
+
+        easing describes the transition FROM this keyframe to the next one
+    """
+
+    def __init__(self, time, rgb, easing="linear"):
+        """
+        :param time: <float> seconds from the start of the timeline
+        :param rgb: (r, g, b) in the range 0-255
+        :keyword easing: <unicode> one of EASINGS, or a callable mapping 0-1 progress onto 0-1 blend
+        """
+        self.time = float(time)
+        self.rgb = tuple(float(channel) for channel in rgb)
+        if callable(easing):
+            self.easing = easing
+        else:
+            try:
+                self.easing = EASINGS[six.text_type(easing).lower()]
+            except KeyError:
+                raise ValueError("Unknown easing '{}'. Choose from: {}".format(easing, ", ".join(sorted(EASINGS))))
+
+    def __repr__(self):
+        return "Keyframe({:.3f}s, {})".format(self.time, self.rgb)
+
+
+class Timeline(object):
+    """
+    A compiled list of keyframes that can be evaluated at any time t
+    """
+    name = ""
+    TABLE_FRAME_SECONDS = 0.02  # Transition tables get a frame per 20ms (50Hz) of each segment
+
+    def __init__(self, keyframes, loop=False, duration=None, name="", interpolation="linear"):
+        """
+        :param keyframes: [<Keyframe>, ] in any order
+        :keyword loop: <Bool> Whether to wrap round to the start once we pass the duration
+        :keyword duration: <float> Total length in seconds. Defaults to the time of the last keyframe.
+                           For loops, the last keyframe blends back into the first across the gap.
+        :keyword interpolation: <unicode> How to blend between keyframes: "linear" (RGB) or "oklab" (perceptual)
+        """
+        keyframes = sorted(keyframes, key=lambda keyframe: keyframe.time)
+        if not keyframes:
+            raise ValueError("A timeline needs at least one keyframe")
+        self.name = name
+        self.loop = loop
+        self.keyframes = keyframes
+        # Compile into flat arrays for the frame loop
+        self.times = [keyframe.time for keyframe in keyframes]
+        self.colours = [keyframe.rgb for keyframe in keyframes]
+        self.easings = [keyframe.easing for keyframe in keyframes]
+        self.duration = float(duration if duration is not None else self.times[-1])
+        if loop:  # Wrap the last segment round to the first colour
+            self.times.append(self.duration)
+            self.colours.append(self.colours[0])
+            self.easings.append(self.easings[0])
+        self.interpolation = clean_interpolation(interpolation)
+        self.tables = [None] * len(self.times)  # Transition table for the segment starting at each keyframe
+        if self.interpolation != "linear":
+            for index in range(len(self.times) - 1):
+                span = self.times[index + 1] - self.times[index]
+                if span > 0 and self.easings[index] is not ease_step:
+                    steps = int(round(span / self.TABLE_FRAME_SECONDS))
+                    self.tables[index] = transition_table(self.colours[index], self.colours[index + 1], steps, self.interpolation)
+
+    def __repr__(self):
+        return "Timeline '{}': {} keyframes over {:.3f}s{}".format(self.name, len(self.keyframes), self.duration, " (loop)" if self.loop else "")
+
+    def __len__(self):
+        return len(self.keyframes)
+
+    def finished(self, t):
+        """
+        Whether a one-shot timeline has played out by time t
+        """
+        return not self.loop and t >= self.duration
+
+    def colour_at(self, t):
+        """
+        Returns the (r, g, b) floats the timeline specifies at t seconds
+        """
+        if self.loop and self.duration > 0:
+            t = t % self.duration
+        times = self.times
+        index = bisect_right(times, t) - 1
+        if index < 0:
+            return self.colours[0]
+        if index >= len(times) - 1:
+            return self.colours[-1]
+        t0 = times[index]
+        span = times[index + 1] - t0
+        if span <= 0:
+            return self.colours[index + 1]
+        blend = self.easings[index]((t - t0) / span)
+        table = self.tables[index]
+        if table is not None:
+            return colour_in_table(table, blend)
+        r0, g0, b0 = self.colours[index]
+        r1, g1, b1 = self.colours[index + 1]
+        return (r0 + (r1 - r0) * blend, g0 + (g1 - g0) * blend, b0 + (b1 - b0) * blend)
+
+    @classmethod
+    def colour_loop(cls, colours_rgb, step_seconds, fade=True, name="", interpolation="linear"):
+        """
+        A looping timeline that visits each colour in turn, one every step_seconds
+
+        :param colours_rgb: [(r, g, b), ]
+        :keyword fade: <Bool> Fade between colours (rotate) or jump straight to them (jump)
+        :keyword interpolation: <unicode> How to fade: "linear" or "oklab"
+        """
+        easing = "linear" if fade else "step"
+        keyframes = [Keyframe(i * step_seconds, rgb, easing) for i, rgb in enumerate(colours_rgb)]
+        return cls(keyframes, loop=True, duration=step_seconds * len(keyframes), name=name, interpolation=interpolation)
+
+
+class SunTimeline(Timeline):
+    """
+    A sunrise or sunset, where the colour is a pure function of the time elapsed.
+
+        The sun moves quickly through the daylight temperatures and lingers at the dark end. Over the
+        60 step profile x (0 = daylight, 60 = darkness) each step takes time proportional to 1/(65-x), so
+        the time taken to reach x is proportional to log(65/(65-x)). We invert that analytically to get
+        x (and thus the colour temperature) at any t, then blend between the colour temperature steps.
+        No state is carried between frames: a late, skipped or resumed frame gets exactly the right colour.
+    """
+    PROFILE_STEPS = 60.0
+    PROFILE_OFFSET = 65.0
+
+    def __init__(self, colours_rgb, duration, rising=False, name=""):
+        """
+        :param colours_rgb: [(r, g, b), ] the colour at each temperature step, in the order they are shown
+        :param duration: <float> seconds the whole sunrise / sunset takes
+        :keyword rising: <Bool> Sunrise (dark to daylight) or sunset (daylight to dark)
+        """
+        if not colours_rgb:
+            raise ValueError("A sun timeline needs at least one colour")
+        self.name = name
+        self.loop = False
+        self.rising = rising
+        self.duration = float(duration)
+        self.colours = [tuple(float(channel) for channel in rgb) for rgb in colours_rgb]
+        self.keyframes = self.colours  # One per temperature step, for len()
+        self._n_steps = len(self.colours) - 1
+        self._log_span = math.log(self.PROFILE_OFFSET / (self.PROFILE_OFFSET - self.PROFILE_STEPS))
+
+    def steps_at(self, t):
+        """
+        How many temperature steps (float) along from the starting colour we are at t seconds
+        """
+        if self.duration <= 0 or t >= self.duration:
+            return float(self._n_steps)
+        if t <= 0:
+            return 0.0
+        fraction = t / self.duration
+        if self.rising:  # Profile runs from darkness (60) to daylight (0)
+            x = self.PROFILE_OFFSET - (self.PROFILE_OFFSET - self.PROFILE_STEPS) * math.exp(fraction * self._log_span)
+            profile_progress = self.PROFILE_STEPS - x
+        else:
+            profile_progress = self.PROFILE_OFFSET - self.PROFILE_OFFSET * math.exp(-fraction * self._log_span)
+        return profile_progress / self.PROFILE_STEPS * self._n_steps
+
+    def colour_at(self, t):
+        steps = self.steps_at(t)
+        index = int(steps)
+        if index >= self._n_steps:
+            return self.colours[-1]
+        blend = steps - index
+        r0, g0, b0 = self.colours[index]
+        r1, g1, b1 = self.colours[index + 1]
+        return (r0 + (r1 - r0) * blend, g0 + (g1 - g0) * blend, b0 + (b1 - b0) * blend)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Shared timebase
+
+        Keeps the Raspiled listeners in a room on one clock, so the same rotate started on several Pis
+        stays in step instead of drifting apart. No NTP needed: each listener follows a leader (the one
+        with the lowest USN that discovery has found, or timesync_leader from the config) and works out
+        how far its clock is from the leader's over UDP, the way NTP does:
+
+            us ---- t0 ----> leader (receives at t1, replies at t2) ---- t3 ----> us
+            offset = ((t1 - t0) + (t2 - t3)) / 2        round trip = (t3 - t0) - (t2 - t1)
+
+        Each round sends a few requests and keeps the answer with the shortest round trip, as it was held
+        up least by the network and so tells us the offset most accurately (to within half its round trip).
+
+        Shared time is in Unix epoch seconds, but runs off monotonic() once we've started, so the wall
+        clock being changed underneath us can't make a sequence lurch.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+from collections import deque
+import itertools
+import time
+
+from twisted.internet import task
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import DatagramProtocol
+
+from src.config import logger
+from metrics import REGISTRY, monotonic
+
+
+SAMPLES_PER_ROUND = 4  # Requests per sync round. The one with the shortest round trip wins
+SAMPLE_SPACING_SECONDS = 0.05  # Gap between the requests of a round, so one burst of network traffic doesn't spoil them all
+SAMPLE_WINDOW = 12  # Offsets to choose the best from (3 rounds' worth)
+STEP_THRESHOLD_SECONDS = 0.05  # Jump straight to offsets further than this from ours. Closer ones are approached halfway at a time
+MAX_ROUND_TRIP_SECONDS = 0.5  # Ignore answers slower than this: too vague to be useful
+SYNC_INTERVAL_SECONDS = 10  # How often to check our offset from the leader
+
+OFFSET_SECONDS = REGISTRY.gauge("raspiled_timesync_offset_seconds", "How far our clock is from the shared timebase (the leader's)")
+ERROR_SECONDS = REGISTRY.gauge("raspiled_timesync_error_seconds", "How far out the shared timebase could be (half the best round trip)")
+
+MESSAGE_PREFIX = b"RLT1"  # Raspiled time, version 1
+
+
+class SharedClock(object):
+    """
+    The timebase all the listeners share: Unix epoch seconds, following monotonic() from when we started, plus
+    whatever offset puts us on the leader's clock
+    """
+
+    def __init__(self, clock=monotonic, wall_clock=time.time):
+        self.clock = clock
+        self._base = wall_clock() - clock()  # monotonic() -> epoch, fixed once so wall clock changes don't reach us
+        self.offset = 0.0  # Seconds we are behind the leader
+        self.error = 0.0  # Half the round trip of the sample the offset came from
+        self.leader = None  # (host, port) we follow. None when we are the reference
+        self.synced_at = None  # monotonic() time of our last sample
+
+    def monotonic_offset(self):
+        """
+        @return: <float> seconds to add to a monotonic() time to get the shared time
+        """
+        return self._base + self.offset
+
+    def now(self):
+        """
+        @return: <float> The shared time, epoch seconds
+        """
+        return self.clock() + self._base + self.offset
+
+    def to_monotonic(self, shared_time):
+        """
+        @return: <float> The monotonic() time at which the shared clock will read shared_time
+        """
+        return shared_time - self._base - self.offset
+
+    def report(self):
+        return {
+            "now": round(self.now(), 6),
+            "leader": "{}:{}".format(*self.leader) if self.leader else None,
+            "offset": round(self.offset, 6),
+            "error": round(self.error, 6),
+            "synced_seconds_ago": round(self.clock() - self.synced_at, 1) if self.synced_at is not None else None,
+        }
+
+
+class TimeSync(DatagramProtocol):
+    """
+    Answers other listeners' time requests, and keeps our SharedClock on the leader's
+    """
+
+    def __init__(self, reactor, choose_leader, clock=None, interval_seconds=SYNC_INTERVAL_SECONDS):
+        """
+        @param reactor: The Twisted reactor
+        @param choose_leader: callable() -> (<unicode> host, <int> port) of the listener to follow, or None if we lead
+        @keyword clock: <SharedClock>
+        @keyword interval_seconds: <float> How often to sync
+        """
+        self.reactor = reactor
+        self.choose_leader = choose_leader
+        self.clock = clock or SharedClock()
+        self.interval_seconds = interval_seconds
+        self.port = None
+        self._sync_task = None
+        self._sequence_numbers = itertools.count(1)
+        self._outstanding = {}  # sequence number : (leader, t0)
+        self._samples = deque(maxlen=SAMPLE_WINDOW)  # (round trip, offset)
+
+    def start(self, port):
+        """
+        @return: <Bool> Whether we could listen on UDP port
+        """
+        try:
+            self.port = self.reactor.listenUDP(port, self)
+        except CannotListenError as e:
+            logger.warning("Time sync: cannot listen on UDP port %s (%s)", port, e)
+            return False
+        self._sync_task = task.LoopingCall(self.sync)
+        self._sync_task.clock = self.reactor
+        self._sync_task.start(self.interval_seconds)
+        return True
+
+    def stop(self):
+        if self._sync_task is not None and self._sync_task.running:
+            self._sync_task.stop()
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+
+    def sync(self):
+        """
+        Starts a round of requests to the leader, if we aren't it
+        """
+        leader = self.choose_leader()
+        if leader != self.clock.leader:
+            logger.info("Time sync: following %s", "{}:{}".format(*leader) if leader else "nobody, we are the reference")
+            self.clock.leader = leader
+            self._samples.clear()  # They were offsets from someone else
+            self._outstanding.clear()
+        if leader is None:  # Keep our offset, so anything we're running carries on smoothly
+            self.clock.error = 0.0
+            return
+        for index in range(SAMPLES_PER_ROUND):
+            self.reactor.callLater(index * SAMPLE_SPACING_SECONDS, self.send_request, leader)
+
+    def send_request(self, leader):
+        if self.port is None:
+            return
+        sequence_number = next(self._sequence_numbers)
+        t0 = self.clock.now()
+        if len(self._outstanding) >= SAMPLES_PER_ROUND * 4:  # Lost answers
+            self._outstanding.clear()
+        self._outstanding[sequence_number] = (leader, t0)
+        self.write(b" ".join((MESSAGE_PREFIX, b"Q", str(sequence_number).encode("ascii"))), leader)
+
+    def write(self, message, address):
+        try:
+            self.port.write(message, address)
+        except Exception as e:  # The network going away mustn't take the listener with it
+            logger.warning("Time sync: could not send to %s:%s (%s: %s)", address[0], address[1], e.__class__.__name__, e)
+
+    def datagramReceived(self, datagram, address):
+        received = self.clock.now()  # t1 if it's a request, t3 if it's an answer
+        parts = datagram.split(b" ")
+        if len(parts) < 3 or parts[0] != MESSAGE_PREFIX:
+            return
+        try:
+            if parts[1] == b"Q":  # Someone wants our time
+                self.write(b" ".join(parts[:1] + [b"A"] + parts[2:3] + [repr(received).encode("ascii"), repr(self.clock.now()).encode("ascii")]), address)
+            elif parts[1] == b"A" and len(parts) == 5:
+                self.answer_received(int(parts[2]), float(parts[3]), float(parts[4]), received)
+        except ValueError:
+            return
+
+    def answer_received(self, sequence_number, t1, t2, t3):
+        """
+        Works an answer into our offset from the leader
+        """
+        try:
+            leader, t0 = self._outstanding.pop(sequence_number)
+        except KeyError:  # Too late, or not ours
+            return
+        if leader != self.clock.leader:
+            return
+        round_trip = (t3 - t0) - (t2 - t1)
+        if round_trip < 0 or round_trip > MAX_ROUND_TRIP_SECONDS:
+            return
+        self._samples.append((round_trip, self.clock.offset + ((t1 - t0) + (t2 - t3)) / 2.0))
+        best_round_trip, best_offset = min(self._samples)
+        change = best_offset - self.clock.offset
+        if abs(change) > STEP_THRESHOLD_SECONDS:
+            self.clock.offset = best_offset
+        else:
+            self.clock.offset += change / 2.0  # Ease in, so a sequence on screen doesn't visibly jump
+        self.clock.error = best_round_trip / 2.0
+        self.clock.synced_at = self.clock.clock()
+        OFFSET_SECONDS.set(self.clock.offset)
+        ERROR_SECONDS.set(self.clock.error)
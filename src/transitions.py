@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspiled - Perceptual colour transitions
+
+        Fading by blending r, g and b linearly goes muddy through the middle (red to green passes through
+        a dull olive) and dips in brightness, because sRGB values are gamma encoded and the eye doesn't
+        weight the channels equally. Blending in OKLab (Björn Ottosson's perceptual colour space) after
+        undoing the sRGB gamma keeps the mid-fade colours bright and saturated.
+
+        The colour space maths costs a few dozen float operations per frame, so each transition is
+        worked out once into a small table of frames, keyed by (interpolation, from, to, steps), and
+        cached. A fade or a rotating sequence just reads frames out of the table, and a sequence which
+        loops round the same colours reuses the same tables on every lap.
+
+    @author: Dr Mike Brooks
+"""
+from __future__ import unicode_literals
+
+import math
+
+import six
+
+from metrics import REGISTRY
+
+
+INTERPOLATIONS = ("linear", "oklab")  # How to blend from one colour to another
+TRANSITION_CACHE_SIZE = 256  # Max number of transition tables to remember
+
+CACHE_LOOKUPS = REGISTRY.counter("raspiled_cache_lookups_total", "Colour and timeline cache lookups, by cache and result (hit or miss)", ("cache", "result"))
+
+
+def clean_interpolation(interpolation):
+    """
+    @return: <unicode> The interpolation name, lower case. "linear" if it is blank
+    @raise ValueError: If it isn't one of INTERPOLATIONS
+    """
+    interpolation = six.text_type(interpolation or "linear").strip().lower()
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError("Unknown interpolation '{}'. Choose from: {}".format(interpolation, ", ".join(INTERPOLATIONS)))
+    return interpolation
+
+
+#### sRGB <-> OKLab ####
+
+def srgb_to_linear(channel):
+    """
+    @param channel: <float> 0-255 gamma encoded
+    @return: <float> 0-1 linear light
+    """
+    value = channel / 255.0
+    if value <= 0.04045:
+        return value / 12.92
+    return ((value + 0.055) / 1.055) ** 2.4
+
+
+def linear_to_srgb(value):
+    """
+    @param value: <float> 0-1 linear light, clipped to that range
+    @return: <float> 0-255 gamma encoded
+    """
+    value = min(max(value, 0.0), 1.0)
+    if value <= 0.0031308:
+        return 12.92 * value * 255.0
+    return (1.055 * value ** (1.0 / 2.4) - 0.055) * 255.0
+
+
+def _cbrt(value):
+    return math.copysign(abs(value) ** (1.0 / 3.0), value)
+
+
+def rgb_to_oklab(rgb):
+    """
+    @param rgb: (r, g, b) 0-255
+    @return: (L, a, b) floats
+    """
+    r, g, b = (srgb_to_linear(channel) for channel in rgb)
+    l_ = _cbrt(0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b)
+    m_ = _cbrt(0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b)
+    s_ = _cbrt(0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b)
+    return (0.2104542553 * l_ + 0.7936177850 * m_ - 0.0040720468 * s_,
+            1.9779984951 * l_ - 2.4285922050 * m_ + 0.4505937099 * s_,
+            0.0259040371 * l_ + 0.7827717662 * m_ - 0.8086757660 * s_)
+
+
+def oklab_to_rgb(lab):
+    """
+    @param lab: (L, a, b) floats
+    @return: (r, g, b) floats 0-255. Colours outside the sRGB gamut are clipped per channel
+    """
+    lightness, a, b = lab
+    l3 = (lightness + 0.3963377774 * a + 0.2158037573 * b) ** 3
+    m3 = (lightness - 0.1055613458 * a - 0.0638541728 * b) ** 3
+    s3 = (lightness - 0.0894841775 * a - 1.2914855480 * b) ** 3
+    return (linear_to_srgb(4.0767416621 * l3 - 3.3077115913 * m3 + 0.2309699292 * s3),
+            linear_to_srgb(-1.2684380046 * l3 + 2.6097574011 * m3 - 0.3413193965 * s3),
+            linear_to_srgb(-0.0041960863 * l3 - 0.7034186147 * m3 + 1.7076147010 * s3))
+
+
+#### Transition tables ####
+
+def _compile_transition(start_rgb, end_rgb, steps, interpolation):
+    if interpolation == "linear":
+        return tuple(tuple(start + (end - start) * step / float(steps) for start, end in zip(start_rgb, end_rgb)) for step in range(steps + 1))
+    start_lab = rgb_to_oklab(start_rgb)
+    end_lab = rgb_to_oklab(end_rgb)
+    frames = [oklab_to_rgb(tuple(start + (end - start) * step / float(steps) for start, end in zip(start_lab, end_lab))) for step in range(1, steps)]
+    return (start_rgb,) + tuple(frames) + (end_rgb,)  # Land exactly on both ends, whatever the float error
+
+
+_transition_cache = {}  # (interpolation, start_rgb, end_rgb, steps) : frames
+
+
+def transition_table(start_rgb, end_rgb, steps, interpolation="oklab"):
+    """
+    Every frame of a transition from start_rgb to end_rgb, worked out once and remembered
+
+    @param start_rgb: (r, g, b) 0-255
+    @param end_rgb: (r, g, b) 0-255
+    @param steps: <int> Number of frames to get from one to the other (at least 1)
+    @keyword interpolation: <unicode> one of INTERPOLATIONS
+    @return: ((r, g, b), ) steps + 1 float colours: frame 0 is start_rgb, frame steps is end_rgb
+    """
+    start_rgb = tuple(float(channel) for channel in start_rgb)
+    end_rgb = tuple(float(channel) for channel in end_rgb)
+    steps = max(int(steps), 1)
+    key = (interpolation, start_rgb, end_rgb, steps)
+    try:
+        frames = _transition_cache[key]
+    except KeyError:
+        CACHE_LOOKUPS.inc(labels=("transition", "miss"))
+    else:
+        CACHE_LOOKUPS.inc(labels=("transition", "hit"))
+        return frames
+    frames = _compile_transition(start_rgb, end_rgb, steps, clean_interpolation(interpolation))
+    if len(_transition_cache) >= TRANSITION_CACHE_SIZE:
+        _transition_cache.clear()
+    _transition_cache[key] = frames
+    return frames
+
+
+def colour_in_table(frames, progress):
+    """
+    The colour progress (0-1) of the way through a transition table, blending between its two nearest frames
+
+    @param frames: from transition_table()
+    @param progress: <float> 0-1, clipped to that range
+    @return: (r, g, b) floats
+    """
+    position = min(max(progress, 0.0), 1.0) * (len(frames) - 1)
+    index = int(position)
+    if index >= len(frames) - 1:
+        return frames[-1]
+    blend = position - index
+    r0, g0, b0 = frames[index]
+    r1, g1, b1 = frames[index + 1]
+    return (r0 + (r1 - r0) * blend, g0 + (g1 - g0) * blend, b0 + (b1 - b0) * blend)
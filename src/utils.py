@@ -11,16 +11,25 @@ from collections import OrderedDict
 from copy import copy
 import json
 import logging
+import math
 import os
-from socket import SOL_SOCKET, SO_BROADCAST
+import socket
+import uuid
 
 import six
-from twisted.internet import task
-from twisted.internet.protocol import DatagramProtocol
+try:
+    from html import escape as html_escape
+except ImportError:  # Python 2
+    from cgi import escape as html_escape
 from twisted.web.resource import Resource
-from twisted.web.static import File
 
-from src.config import DEBUG, logger
+from src.config import DEBUG, get_setting, logger
+from metrics import REGISTRY, MetricsResource, monotonic
+from profiling import ProfilingResource
+
+
+REQUESTS = REGISTRY.counter("raspiled_requests_total", "Web requests handled, by endpoint and HTTP status code", ("endpoint", "code"))
+REQUEST_SECONDS = REGISTRY.histogram("raspiled_request_seconds", "Time taken to render a web request, by endpoint", ("endpoint",))
 
 
 RASPBERRY_PI_DIR = os.path.dirname(os.path.realpath(__file__)) #The directory we're running in
@@ -77,34 +86,43 @@ class RaspberryPiWebResource(Resource):
         ("capabilities", "capabilities"),  # Docs
         ("capability", "capabilities"),  # Docs
         ("status", "status"),  # Status
+        ("whoami", "whoami"),  # Device descriptor, fetched by peers who discover us
+        ("peers", "peers"),  # Other devices discovered on the network
     )
     PARAM_TO_ACTION_MAPPING = (
     )
     TEMPLATE_INDEX = "index.html"
     TEMPLATES_DIRECTORY = "templates"
     STATIC_DIRECTORY = "static"  # Always at http://whatever.your.ip.is:port/static/
-    BROADCAST_INTERVAL_SECONDS = 15  # Number of seconds between each broadcast
-    BROADCAST_PORT = 1900  # Port to broadcast to other devices on (SSDP = 1900)
-    BROADCAST_ADDR = "239.255.255.250"  # IP to broadcast to other devices
+    BROADCAST_INTERVAL_SECONDS = 15  # Number of seconds between each announcement of our presence
+    SERVICE_NAME = "raspiled"  # What sort of device we are, in our descriptor
 
-    broadcaster = None  # How we tell the world about our existence
-    broadcast_task = None  # Where we store our broadcasting task (looping task)
+    discovery = None  # <discovery.Discovery> How we tell the world about our existence and hear about everyone else's
+    _discovery_shutdown_trigger = None  # Stops discovery as the reactor shuts down
     ip_address = None  # I can be told where I lurk!
+    rate_limiter = None  # <TokenBucketLimiter> for actions requested over the web. None = unlimited
 
     _cached_capabilities = None  # Saves us regenerating the resource dict every time
-    _cached_json = None
+    _cached_whoami = None  # Saves us regenerating the device descriptor every time
 
     isLeaf = False  # Allows us to go into dirs
     _path = None  # If a user wants to hit a dynamic subpage, the path appears here
+    _information_dispatch = None  # PARAM_TO_INFORMATION_MAPPING compiled by compile_dispatch()
+    _action_dispatch = None  # PARAM_TO_ACTION_MAPPING compiled by compile_dispatch()
 
     def __init__(self, *args, **kwargs):
         """
         Sets this web responding engine up
         """
+        from twisted.web.static import File  # Heavy, and only needed once we're serving
         Resource.__init__(self, *args, **kwargs)  # Super
+        self._information_dispatch = self.compile_dispatch(self.PARAM_TO_INFORMATION_MAPPING)
+        self._action_dispatch = self.compile_dispatch(self.PARAM_TO_ACTION_MAPPING)
         # Add in the static folder.
         static_folder = os.path.join(RASPBERRY_PI_DIR, self.STATIC_DIRECTORY)
         self.putChild(b"static", File(static_folder))  # Any requests to /static serve from the filesystem.
+        self.putChild(b"metrics", MetricsResource(REGISTRY))  # Prometheus scrapes http://whatever.your.ip.is:port/metrics
+        self.putChild(b"profile", ProfilingResource(self, is_admin=self.is_admin))  # Admins only
 
     def getChild(self, path, request, *args, **kwargs):
         """
@@ -137,7 +155,14 @@ class RaspberryPiWebResource(Resource):
         Provides a clean version of the path
         :return: <str>
         """
-        return six.text_type(self._path or u"").rstrip("/")
+        return six.ensure_text(self._path or u"", encoding="utf-8").rstrip("/")
+
+    def is_admin(self, request):
+        """
+        Whether the request comes from someone allowed to use the admin endpoints (e.g. /profile)
+        By default that's only this machine. Override this to let others in
+        """
+        return request.getClientAddress().host in ("127.0.0.1", "::1")
 
     def before_action(self, *args, **kwargs):
         """
@@ -190,6 +215,37 @@ class RaspberryPiWebResource(Resource):
         "returns": "<JSON> A JSON object for its status"
     }
 
+    def information__whoami(self, request, *args, **kwargs):
+        """
+        Reports what this device is, for other devices on the network
+        """
+        return self.whoami()
+
+    information__whoami__capability = {
+        "param": "whoami",
+        "description": "Describes this device: its name, port, strips and capabilities. Other devices fetch this when they discover it.",
+        "value": "",
+        "returns": "<JSON> A JSON object describing this device"
+    }
+
+    def information__peers(self, request, *args, **kwargs):
+        """
+        Reports the other devices discovered on the network
+        """
+        peers = self.discovery.directory.peers() if self.discovery is not None else []
+        return {
+            "discovery": self.discovery is not None,
+            "peers": peers,
+            "total": len(peers),
+        }
+
+    information__peers__capability = {
+        "param": "peers",
+        "description": "Lists the other Raspiled devices discovered on your network, from the cache (no network round trips).",
+        "value": "",
+        "returns": "<JSON> A JSON object with a list of peers"
+    }
+
     @classmethod
     def outcome(cls, action="", successful=True, message="", message_args=None, message_kwargs=None):
         """
@@ -300,14 +356,84 @@ class RaspberryPiWebResource(Resource):
 
     def render_network(self, request, context=None):
         """
-        Renders links to other devices discovered on your network
-        By default, just returns your local controls
+        Renders links to other devices discovered on your network, straight from the peer directory
+        By default, just lists your local controls
 
         :param request: <SmartRequest>
-        :keyword context: {} A dict of data to push into the template file
-        :return: A rendered HTML template
+        :keyword context: {} Unused
+        :return: HTML, utf8 encoded
+        """
+        me = self.whoami()
+        links = ['<li><a href="/">{}</a> (this device)</li>'.format(html_escape(me["name"]))]
+        for peer in self.information__peers(request)["peers"]:
+            links.append('<li><a href="{}">{}</a></li>'.format(html_escape(peer["url"]), html_escape(peer["name"] or peer["url"])))
+        request.setHeader("Content-Type", "text/html; charset=utf-8")
+        request.setResponseCode(200)
+        return '<div class="network"><h1>Devices on your network</h1><ul>{}</ul></div>'.format("".join(links)).encode("utf-8")
+
+    @staticmethod
+    def compile_dispatch(mapping):
+        """
+        Compiles a PARAM_TO_..._MAPPING into a dict, so a request is routed by looking up the params it supplies
+        rather than by testing for every param we know about
+
+        :param mapping: ((<str> param or path name, <str> information / action name), ) in order of precedence
+        :return: {<str> param or path name: (<int> precedence, <str> information / action name)}
+        """
+        dispatch = {}
+        for precedence, (key_name, target_name) in enumerate(mapping):
+            dispatch.setdefault(key_name, (precedence, target_name))  # The first mention of a name wins
+        return dispatch
+
+    @staticmethod
+    def match_dispatch(dispatch, request, clean_path=""):
+        """
+        :param dispatch: {} from compile_dispatch()
+        :param request: <SmartRequest> or anything with the same param methods
+        :keyword clean_path: <str> The path, which can also name what is wanted
+        :return: <str> The information / action name of the highest precedence param (or path) the request supplies, or None
+        """
+        best = dispatch.get(clean_path) if clean_path else None
+        for name in request.param_names():
+            match = dispatch.get(name)
+            if match is not None and (best is None or match < best):
+                best = match
+        if best is None:
+            return None
+        return best[1]
+
+    def run_action(self, request, clean_path=""):
+        """
+        Runs the first action the request asks for. Also used to run actions without a web request (e.g. scheduled jobs)
+        :param request: <SmartRequest> or anything with the same param methods
+        :keyword clean_path: <str> The path, which can also name the action
+        :return: {} The outcome context, or None if the request doesn't ask for an action
         """
-        # TODO: Write this!
+        action_name = self.match_dispatch(self._action_dispatch, request, clean_path)
+        if action_name is None:
+            return None
+        return self.perform_action(action_name, request)
+
+    def perform_action(self, action_name, request):
+        """
+        Runs the named action, with the before / after hooks round it
+        :param action_name: <str> e.g. "fade"
+        :param request: <SmartRequest> or anything with the same param methods
+        :return: {} The outcome context
+        """
+        self.before_action(action_name)  # Inheriting classes can do stuff before the action
+        func_name = "action__%s" % action_name
+        try:
+            output_context = getattr(self, func_name)(request)
+        except Exception as e:
+            output_context = self.outcome(
+                action=action_name,
+                successful=False,
+                message="{}: {}".format(e.__class__.__name__, e)
+            )
+            logger.exception(e)
+        self.after_action(action_name)  # Inheriting classes can do stuff after the action
+        return output_context
 
     def render_GET(self, request):
         """
@@ -315,102 +441,113 @@ class RaspberryPiWebResource(Resource):
         :param request:
         :return: HTML or JSON for serving via Twisted web browser
         """
-        clean_path = six.text_type(self._path or u"").rstrip("/")
+        started = monotonic()
+        endpoint = "error"
+        try:
+            endpoint, output = self.dispatch_GET(request)
+            return output
+        finally:
+            elapsed = monotonic() - started
+            REQUEST_SECONDS.observe(elapsed, (endpoint,))
+            REQUESTS.inc(labels=(endpoint, getattr(request, "code", 200) if endpoint != "error" else 500))
+
+    def dispatch_GET(self, request):
+        """
+        Works out what the request wants and renders it
+        :param request:
+        :return: (<str> name of the endpoint which served it, HTML or JSON output)
+        """
+        clean_path = self.clean_path
 
         # First see if we're being asked for an informational resource
-        for key_name, information_name in self.PARAM_TO_INFORMATION_MAPPING:
-            if request.has_param(key_name) or clean_path == key_name:
-                func_name = "information__%s" % information_name
-                try:
-                    output_context = getattr(self, func_name)(request)
-                except Exception as e:
-                    output_context = self.outcome(
-                        action=information_name,
-                        successful=False,
-                        message="{}: {}".format(e.__class__.__name__, e)
-                    )
-                    logger.exception(e)
-                return self.render_json(request, context=output_context)
+        information_name = self.match_dispatch(self._information_dispatch, request, clean_path)
+        if information_name is not None:
+            func_name = "information__%s" % information_name
+            try:
+                output_context = getattr(self, func_name)(request)
+            except Exception as e:
+                output_context = self.outcome(
+                    action=information_name,
+                    successful=False,
+                    message="{}: {}".format(e.__class__.__name__, e)
+                )
+                logger.exception(e)
+            return information_name, self.render_json(request, context=output_context)
 
         # Next see if we're being asked for an action resource
-        for key_name, action_name in self.PARAM_TO_ACTION_MAPPING:  # This gets set on child classes
-            if request.has_param(key_name) or clean_path == key_name:
-                self.before_action(action_name)  # Inheriting classes can do stuff before the action
-                func_name = "action__%s" % action_name
-                try:
-                    output_context = getattr(self, func_name)(request)
-                except Exception as e:
-                    output_context = self.outcome(
-                        action=action_name,
-                        successful=False,
-                        message="{}: {}".format(e.__class__.__name__, e)
-                    )
-                    logger.exception(e)
-                self.after_action(action_name)  # Inheriting classes can do stuff after the action
-                return self.render_json_with_status(request, context=output_context)
+        action_name = self.match_dispatch(self._action_dispatch, request, clean_path)
+        if action_name is not None:
+            if self.rate_limiter is not None:
+                allowed, retry_after = self.rate_limiter.allow(request.getClientAddress().host)
+                if not allowed:
+                    request.setHeader("Retry-After", "{}".format(int(math.ceil(retry_after))))
+                    output_context = self.outcome(action=action_name, successful=False, message="Too many requests, slow down")
+                    return "rate_limited", self.render_json(request, context=output_context, http_code=429)
+            output_context = self.perform_action(action_name, request)
+            endpoint = (output_context.get("action") if isinstance(output_context, dict) else None) or "action"
+            return endpoint, self.render_json_with_status(request, context=output_context)
 
         # Finally, assume the user wants to retrieve an HTML page
         # This may be to see what's on their network
         if request.has_param("network") or clean_path == "network":
-            return self.render_network(request)
+            return "network", self.render_network(request)
 
         # Or it's to show the controls
-        return self.render_controls(request)
+        return "page", self.render_controls(request)
 
     def setup_broadcasting(self, reactor):
         """
-        Hooks the reactor up to a transport to permit broadcasting
+        Starts announcing ourselves on the network, and listening for the other devices
         :param reactor:
-        :return:
-        """
-        self.broadcaster = BroadcastCapabilitiesProtocol()  # For broadcasting my presence
-        reactor.listenUDP(0, self.broadcaster)
-        self.broadcast_task = task.LoopingCall(self.broadcast_presence)
-        self.broadcast_task.start(self.BROADCAST_INTERVAL_SECONDS)
-
-    def whoami(self):
-        """
-        Returns a dict saying who I am (what service I am, where I am etc)
-        :return: {}
+        :return: None
         """
-        my_ip = None
+        from discovery import Discovery, local_ip_address
+        whoami = self.whoami()
+        location = "http://{}:{}/whoami".format(local_ip_address(), whoami["port"])
+        self.discovery = Discovery(reactor, whoami, location, interval_seconds=self.BROADCAST_INTERVAL_SECONDS,
+                                   probe_concurrency=get_setting("discovery_probe_concurrency", 4))
+        if not self.discovery.start():
+            self.discovery = None
+            return
+        # Say goodbye before the reactor starts closing ports, by which time our multicast port would be gone
+        self._discovery_shutdown_trigger = reactor.addSystemEventTrigger("before", "shutdown", self.stop_broadcasting)
 
-    def broadcast_presence(self):
+    def stop_broadcasting(self):
         """
-        Simply announces own presence onto the network
-        See scheduling tasks in twisted: https://twistedmatrix.com/documents/13.1.0/core/howto/time.html
-        :return: None
+        Tells the network we're going
         """
-        try:
-            cached_json = getattr(self, "_cached_json", None)
-            if cached_json is None:
-                whoami = "WHOAMI"
-                cached_json = json.dumps(whoami)
-                self._cached_json = cached_json
-            self.broadcaster.broadcast_message(message_json=cached_json, broadcast_address=self.BROADCAST_ADDR, broadcast_port=self.BROADCAST_PORT)
-        except Exception as e:
-            print(e)
-
+        if self._discovery_shutdown_trigger is not None:
+            try:
+                self.discovery.reactor.removeSystemEventTrigger(self._discovery_shutdown_trigger)
+            except (ValueError, KeyError, AttributeError):  # It's the trigger calling us
+                pass
+            self._discovery_shutdown_trigger = None
+        if self.discovery is not None:
+            self.discovery.stop()
+            self.discovery = None
 
-class BroadcastCapabilitiesProtocol(DatagramProtocol):
-    """
-    Allows a RaspberryPi resource to broadcast its presence on the network, including what it can do.
-    Other protocols will use this to discover other devices on the network.
-    """
-    def startProtocol(self):
+    def describe_strips(self):
         """
-        Sets up the broadcast protocol
-        :return: None
+        Describes the lights this device drives, for whoami()
+        Override this in your device
+        :return: [{}, ]
         """
-        self.transport.socket.setsockopt(SOL_SOCKET, SO_BROADCAST, True)
+        return []
 
-    def broadcast_message(self, message_json, broadcast_address="235.255.255.250", broadcast_port=1900):
+    def whoami(self):
         """
-        Takes the WebResourceClass, tells everyone else on the network that it's here and what it can do
-        :return: None
+        Returns a dict saying who I am (what service I am, where I am etc). Worked out once then kept
+        :return: {}
         """
-        self.transport.write(message_json, (broadcast_address, broadcast_port))
-        print("Broadcast: {}".format(message_json))
-
-
-
+        if self._cached_whoami is None:
+            name = socket.gethostname()
+            port = int(get_setting("pi_port", 9090))
+            self._cached_whoami = {
+                "service": self.SERVICE_NAME,
+                "usn": "uuid:{}::urn:raspiled:device:1".format(uuid.uuid5(uuid.NAMESPACE_DNS, "{:012x}:{}".format(uuid.getnode(), port))),  # MAC, as Pis often share a host name
+                "name": name,
+                "port": port,
+                "strips": self.describe_strips(),
+                "capabilities": [capability["param"] for capability in self.information__capabilities()],
+            }
+        return self._cached_whoami